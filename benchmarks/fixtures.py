@@ -0,0 +1,92 @@
+"""
+Deterministic synthetic fixtures for the benchmarks: text-like and photo-like
+images at several sizes, and born-digital or scanned PDFs of any page count.
+"""
+import io
+import random
+
+import fitz  # PyMuPDF
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+
+IMAGE_SIZES = {
+    "small": (1024, 768),
+    "medium": (2048, 1536),
+    "large": (4032, 3024),  # typical phone camera photo
+}
+
+_WORDS = (
+    "invoice total amount due date account number reference payment terms the of and to in for "
+    "section figure table equation result analysis method data value page report summary"
+).split()
+
+
+def _sentence(rng, words=12):
+    return " ".join(rng.choice(_WORDS) for _ in range(words))
+
+
+def text_image(size, seed=0):
+    """Black text on white, like a scanned or photographed document page."""
+    rng = random.Random(seed)
+    width, height = size
+    image = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(image)
+    font_size = max(12, height // 60)
+    font = ImageFont.load_default(size=font_size)
+    margin = width // 12
+    y = margin
+    while y < height - margin:
+        draw.text((margin, y), _sentence(rng, words=max(6, width // (font_size * 6))), fill="black", font=font)
+        y += int(font_size * 1.6)
+    return image
+
+
+def photo_image(size, seed=0):
+    """Smooth gradients with noise and soft shapes, like a camera photo."""
+    rng = random.Random(seed)
+    width, height = size
+    small = (max(1, width // 8), max(1, height // 8))
+    gradient = Image.linear_gradient("L").resize(small).convert("RGB")
+    noise = Image.effect_noise(small, 40).convert("RGB")
+    image = Image.blend(gradient, noise, 0.35)
+    draw = ImageDraw.Draw(image)
+    for _ in range(25):
+        x, y = rng.randrange(small[0]), rng.randrange(small[1])
+        r = rng.randrange(4, max(5, small[0] // 6))
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=color)
+    return image.filter(ImageFilter.GaussianBlur(2)).resize(size, Image.BICUBIC)
+
+
+def encode_image(image, fmt):
+    """Image bytes and MIME type as an upload would arrive ("PNG" or "JPEG")."""
+    buffer = io.BytesIO()
+    image.save(buffer, fmt, quality=92) if fmt == "JPEG" else image.save(buffer, fmt)
+    return buffer.getvalue(), f"image/{fmt.lower()}"
+
+
+def digital_pdf(pages, seed=0):
+    """Born-digital PDF: real text layer, no images."""
+    rng = random.Random(seed)
+    doc = fitz.open()
+    for number in range(pages):
+        page = doc.new_page()
+        page.insert_text((72, 72), f"Section {number + 1}", fontsize=20)
+        y = 110
+        while y < page.rect.height - 72:
+            page.insert_text((72, y), _sentence(rng, words=10), fontsize=10)
+            y += 14
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def scanned_pdf(pages, seed=0):
+    """Scanned PDF: every page is one full-page JPEG of text, no text layer."""
+    doc = fitz.open()
+    for number in range(pages):
+        page_image, _ = encode_image(text_image((1275, 1650), seed=seed + number), "JPEG")
+        page = doc.new_page()
+        page.insert_image(page.rect, stream=page_image)
+    data = doc.tobytes()
+    doc.close()
+    return data
@@ -0,0 +1,207 @@
+"""
+Local stand-in for OpenRouter's /chat/completions endpoint, for benchmarks and
+offline testing. Supports configurable latency, injected errors and rate
+limits, and SSE streaming, and counts the bytes that cross the wire.
+
+Run standalone and point the app or CLI at it:
+    python benchmarks/mock_openrouter.py --port 8765 --latency 0.2 --error-rate 0.05
+    OPENROUTER_API_URL=http://127.0.0.1:8765/api/v1/chat/completions streamlit run ocr_app.py
+
+GET /stats returns the counters as JSON; POST /reset clears them.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from dataclasses import asdict, dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+@dataclass
+class MockConfig:
+    latency: float = 0.15  # seconds before the first byte of every reply
+    jitter: float = 0.05  # uniform extra latency in [0, jitter]
+    per_image_latency: float = 0.02  # extra seconds per attached image
+    error_rate: float = 0.0  # share of requests answered with 503
+    rate_limit_rate: float = 0.0  # share of requests answered with 429 + Retry-After
+    retry_after: float = 1.0
+    reply_words: int = 150
+    words_per_second: float = 400.0  # streaming pace
+    seed: int = 0
+
+
+class MockStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = self.errors = self.rate_limited = self.images = 0
+            self.request_bytes = self.response_bytes = 0
+
+    def add(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "requests": self.requests, "errors": self.errors, "rate_limited": self.rate_limited,
+                "images": self.images, "request_bytes": self.request_bytes, "response_bytes": self.response_bytes,
+            }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+
+    def log_message(self, *args):
+        pass
+
+    def end_headers(self):
+        self.server.stats.add(response_bytes=sum(len(chunk) for chunk in self._headers_buffer) + 2)
+        super().end_headers()
+
+    def _write(self, data):
+        self.server.stats.add(response_bytes=len(data))
+        self.wfile.write(data)
+
+    def _send_json(self, status, payload, extra_headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (extra_headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self._write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/stats"):
+            self._send_json(200, self.server.stats.snapshot())
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if self.path.rstrip("/").endswith("/reset"):
+            self.server.stats.reset()
+            self._send_json(200, {"ok": True})
+            return
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": "not found"})
+            return
+
+        request_line_bytes = len(self.requestline) + 2
+        header_bytes = len(str(self.headers).encode())
+        self.server.stats.add(requests=1, request_bytes=request_line_bytes + header_bytes + length)
+        config = self.server.config
+        payload = json.loads(body)
+        images = sum(
+            1
+            for message in payload.get("messages", [])
+            if isinstance(message.get("content"), list)
+            for part in message["content"]
+            if part.get("type") == "image_url"
+        )
+        self.server.stats.add(images=images)
+
+        with self.server.rng_lock:
+            roll = self.server.rng.random()
+            delay = config.latency + self.server.rng.uniform(0, config.jitter) + images * config.per_image_latency
+        time.sleep(delay)
+        if roll < config.rate_limit_rate:
+            self.server.stats.add(rate_limited=1)
+            self._send_json(429, {"error": {"message": "Rate limit exceeded"}}, {"Retry-After": f"{config.retry_after:g}"})
+            return
+        if roll < config.rate_limit_rate + config.error_rate:
+            self.server.stats.add(errors=1)
+            self._send_json(503, {"error": {"message": "Service unavailable"}})
+            return
+
+        words = [f"word{i % 97}" for i in range(config.reply_words)]
+        model = payload.get("model", "mock")
+        if payload.get("stream"):
+            self._stream_reply(model, words, config)
+        else:
+            self._send_json(200, {
+                "id": "mock-completion",
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)}}],
+                "usage": {"prompt_tokens": 100 + images * 1000, "completion_tokens": len(words),
+                          "total_tokens": 100 + images * 1000 + len(words)},
+            })
+
+    def _stream_reply(self, model, words, config):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def _chunk(text):
+            data = text.encode()
+            self._write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        _chunk(": OPENROUTER PROCESSING\n\n")
+        step = 5
+        for start in range(0, len(words), step):
+            delta = " ".join(words[start:start + step]) + " "
+            event = {"model": model, "choices": [{"index": 0, "delta": {"content": delta}}]}
+            _chunk(f"data: {json.dumps(event)}\n\n")
+            time.sleep(step / config.words_per_second)
+        _chunk("data: [DONE]\n\n")
+        self._write(b"0\r\n\r\n")
+
+
+class MockOpenRouterServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, config=None):
+        super().__init__((host, port), _Handler)
+        self.config = config or MockConfig()
+        self.stats = MockStats()
+        self.rng = random.Random(self.config.seed)
+        self.rng_lock = threading.Lock()
+
+    def handle_error(self, request, client_address):
+        pass  # clients closing idle keep-alive connections is expected, not worth a traceback
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/api/v1/chat/completions"
+
+    def configure(self, config):
+        """Swap the behavior for the next requests and reset the counters."""
+        self.config = config
+        with self.rng_lock:
+            self.rng = random.Random(config.seed)
+        self.stats.reset()
+
+    def start_in_background(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mock OpenRouter chat completions server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    defaults = MockConfig()
+    for name, value in asdict(defaults).items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(value), default=value)
+    args = parser.parse_args(argv)
+    config = MockConfig(**{name: getattr(args, name) for name in asdict(defaults)})
+    server = MockOpenRouterServer(args.host, args.port, config)
+    print(f"Mock OpenRouter listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,463 @@
+"""
+Benchmarks for the rasterize → encode → request pipeline.
+
+    python benchmarks/run_benchmarks.py                    # full suite
+    python benchmarks/run_benchmarks.py --quick            # smaller fixtures, fewer repetitions
+    python benchmarks/run_benchmarks.py -k pipeline        # only scenarios whose name contains "pipeline"
+    python benchmarks/run_benchmarks.py --json base.json   # save results
+    python benchmarks/run_benchmarks.py --baseline base.json --tolerance 15   # flag regressions
+
+Each scenario runs in a fresh process, so the peak RSS reported is that
+scenario's own (fixtures included). Requests go to the local mock server in
+mock_openrouter.py, never to OpenRouter. Reported per scenario:
+throughput, p50/p95/p99 latency per item, peak RSS, and bytes sent and
+received (HTTP totals for request scenarios, payload bytes produced for the
+local-only ones). The peak RSS of render pool scenarios (-procsN) excludes the
+render worker processes.
+
+The startup and app scenarios time the Streamlit app itself: importing the
+engine in a fresh interpreter, a new session's first script run, a full rerun,
+and the script time of each tab's fragment, which is all that reruns when a
+widget in that tab changes. App runs use Streamlit's AppTest harness, without
+a browser or server.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import subprocess
+import sys
+import time
+import types
+import urllib.request
+from dataclasses import replace
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+APP_PATH = os.path.join(REPO_DIR, "ocr_app.py")
+sys.path.insert(0, BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from mock_openrouter import MockConfig, MockOpenRouterServer  # noqa: E402
+
+# Metrics compared against a baseline, and whether higher is better
+COMPARED_METRICS = {
+    "throughput": True,
+    "p95_ms": False,
+    "peak_rss_mb": False,
+    "bytes_sent": False,
+}
+
+
+def render_worker_counts():
+    """Render pool sizes to benchmark: powers of two up to the number of cores, plus the core count."""
+    cores = os.cpu_count() or 1
+    return sorted({1, cores} | {2 ** i for i in range(1, cores.bit_length()) if 2 ** i <= cores})
+
+
+def build_scenarios(quick):
+    """The benchmark matrix. Each scenario is a plain dict so it can cross process boundaries."""
+    reps = 3 if quick else 10
+    pdf_pages = 8 if quick else 30
+    pipeline_pages = 12 if quick else 40
+    sizes = ("small", "large") if quick else ("small", "medium", "large")
+    scenarios = []
+    for size in sizes:
+        for kind, fmt in (("text", "PNG"), ("photo", "JPEG")):
+            for preprocess in (False, True):
+                scenarios.append({
+                    "name": f"encode-image-{kind}-{size}-{'opt' if preprocess else 'raw'}",
+                    "kind": "encode_image", "image_kind": kind, "size": size, "format": fmt,
+                    "preprocess": preprocess, "reps": reps,
+                })
+    for pdf_kind in ("digital", "scanned"):
+        for preprocess in (False, True):
+            scenarios.append({
+                "name": f"render-pdf-{pdf_kind}-{pdf_pages}p-{'opt' if preprocess else 'raw'}",
+                "kind": "render_pdf", "pdf_kind": pdf_kind, "pages": pdf_pages, "preprocess": preprocess,
+            })
+    for workers in render_worker_counts():  # process-pool scaling; the -opt scenario above is the in-process baseline
+        scenarios.append({
+            "name": f"render-pdf-scanned-{pdf_pages}p-opt-procs{workers}",
+            "kind": "render_pdf", "pdf_kind": "scanned", "pages": pdf_pages, "preprocess": True,
+            "render_workers": workers,
+        })
+    for stream in (False, True):
+        scenarios.append({
+            "name": f"request-image-{'stream' if stream else 'json'}",
+            "kind": "request_image", "stream": stream, "reps": reps * 2,
+            "mock": {"latency": 0.05, "jitter": 0.02},
+        })
+    for max_in_flight in (1, 4, 8):
+        scenarios.append({
+            "name": f"pipeline-scanned-{pipeline_pages}p-inflight{max_in_flight}",
+            "kind": "pipeline", "pages": pipeline_pages, "max_in_flight": max_in_flight,
+            "pages_per_request": 1, "stream": False,
+        })
+    scenarios.append({
+        "name": f"pipeline-scanned-{pipeline_pages}p-inflight8-procs{max(render_worker_counts())}",
+        "kind": "pipeline", "pages": pipeline_pages, "max_in_flight": 8, "pages_per_request": 1, "stream": False,
+        "render_workers": max(render_worker_counts()),
+    })
+    scenarios.append({
+        "name": f"pipeline-scanned-{pipeline_pages}p-inflight4-stream",
+        "kind": "pipeline", "pages": pipeline_pages, "max_in_flight": 4, "pages_per_request": 1, "stream": True,
+    })
+    scenarios.append({
+        "name": f"pipeline-scanned-{pipeline_pages}p-inflight4-batch3",
+        "kind": "pipeline", "pages": pipeline_pages, "max_in_flight": 4, "pages_per_request": 3, "stream": False,
+    })
+    scenarios.append({
+        "name": f"pipeline-scanned-{pipeline_pages}p-inflight4-flaky",
+        "kind": "pipeline", "pages": pipeline_pages, "max_in_flight": 4, "pages_per_request": 1, "stream": False,
+        "mock": {"error_rate": 0.05, "rate_limit_rate": 0.05, "retry_after": 0.5},
+    })
+    scenarios.append({"name": "startup-import-engine", "kind": "import", "module": "ocr_engine", "reps": reps})
+    scenarios.append({"name": "app-first-run", "kind": "app_run", "measure": "first_run", "reps": reps})
+    scenarios.append({"name": "app-rerun", "kind": "app_run", "measure": "rerun", "reps": reps * 2})
+    for tab, fragment in (("tab1", "_extract_and_convert_tab"), ("tab2", "_ask_analyze_chat_tab"), ("tab3", "_pdf_scan_tab")):
+        scenarios.append({
+            "name": f"app-rerun-{tab}-fragment", "kind": "app_run", "measure": fragment, "reps": reps * 2,
+        })
+    return scenarios
+
+
+def _percentile(samples, percent):
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, round(percent / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+
+def _peak_rss_mb():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024  # bytes on macOS, KiB on Linux
+
+
+def _timed_requests(ocr_engine, latencies):
+    """Record the client-side duration of every chat completion the engine makes."""
+    post, stream = ocr_engine.post_chat_completion, ocr_engine.stream_chat_completion
+
+    def timed_post(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return post(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - started)
+
+    def timed_stream(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            yield from stream(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - started)
+
+    ocr_engine.post_chat_completion, ocr_engine.stream_chat_completion = timed_post, timed_stream
+
+
+def _run_encode_image(scenario, ocr_engine, fixtures):
+    make = fixtures.text_image if scenario["image_kind"] == "text" else fixtures.photo_image
+    image_bytes, mime_type = fixtures.encode_image(make(fixtures.IMAGE_SIZES[scenario["size"]]), scenario["format"])
+    options = ocr_engine.default_preprocess_options(list(ocr_engine.AVAILABLE_MODELS.values())[0], enabled=scenario["preprocess"])
+    latencies, payload_bytes = [], 0
+    for _ in range(scenario["reps"]):
+        started = time.perf_counter()
+        data_url, _ = ocr_engine.encode_image_bytes(image_bytes, mime_type, options)
+        latencies.append(time.perf_counter() - started)
+        payload_bytes += len(data_url)
+    return {"items": scenario["reps"], "unit": "images", "latencies": latencies, "seconds": sum(latencies),
+            "bytes_sent": payload_bytes, "bytes_received": 0}
+
+
+def _warm_render_pool(ocr_engine, fixtures, workers, options):
+    """Start the render processes before timing, so process startup is not counted as rendering."""
+    if workers:
+        ocr_engine.pdf_pages_to_data_urls(fixtures.scanned_pdf(workers, seed=999), range(workers), options,
+                                          render_workers=workers)
+
+
+def _run_render_pdf(scenario, ocr_engine, fixtures):
+    make = fixtures.digital_pdf if scenario["pdf_kind"] == "digital" else fixtures.scanned_pdf
+    pdf_bytes = make(scenario["pages"])
+    options = ocr_engine.default_preprocess_options(list(ocr_engine.AVAILABLE_MODELS.values())[0], enabled=scenario["preprocess"])
+    workers = scenario.get("render_workers", 0)
+    _warm_render_pool(ocr_engine, fixtures, workers, options)
+    latencies, payload_bytes = [], 0
+    started = time.perf_counter()
+    for _, data_url in ocr_engine.iter_pdf_page_data_urls(
+        pdf_bytes, range(scenario["pages"]), options, render_workers=workers
+    ):
+        now = time.perf_counter()
+        latencies.append(now - started)
+        started = now
+        payload_bytes += len(data_url)
+    return {"items": scenario["pages"], "unit": "pages", "latencies": latencies, "seconds": sum(latencies),
+            "bytes_sent": payload_bytes, "bytes_received": 0}
+
+
+def _run_request_image(scenario, ocr_engine, fixtures):
+    image_bytes, mime_type = fixtures.encode_image(fixtures.text_image(fixtures.IMAGE_SIZES["small"]), "PNG")
+    data_url, _ = ocr_engine.encode_image_bytes(image_bytes, mime_type)
+    messages = [{"role": "user", "content": [
+        {"type": "text", "text": ocr_engine.IMAGE_PROMPTS["General Text Extraction"]},
+        {"type": "image_url", "image_url": {"url": data_url}},
+    ]}]
+    model_id = list(ocr_engine.AVAILABLE_MODELS.values())[0]
+    latencies = []
+    for _ in range(scenario["reps"]):
+        started = time.perf_counter()
+        if scenario["stream"]:
+            "".join(ocr_engine.stream_chat_completion("benchmark-key", model_id, messages))
+        else:
+            ocr_engine.post_chat_completion("benchmark-key", model_id, messages)
+        latencies.append(time.perf_counter() - started)
+    return {"items": scenario["reps"], "unit": "requests", "latencies": latencies, "seconds": sum(latencies)}
+
+
+def _run_pipeline(scenario, ocr_engine, fixtures):
+    pdf_bytes = fixtures.scanned_pdf(scenario["pages"])
+    model_id = list(ocr_engine.AVAILABLE_MODELS.values())[0]
+    options = ocr_engine.default_preprocess_options(model_id)
+    workers = scenario.get("render_workers", 0)
+    _warm_render_pool(ocr_engine, fixtures, workers, options)
+    latencies = []
+    _timed_requests(ocr_engine, latencies)
+    started = time.perf_counter()
+    chunk_results = ocr_engine.ocr_pdf(
+        lambda: "benchmark-key", model_id, pdf_bytes, "General Text Extraction", list(range(scenario["pages"])),
+        pages_per_request=scenario["pages_per_request"], max_in_flight=scenario["max_in_flight"],
+        preprocess_options=options,
+        on_stream_update=(lambda partial_texts: None) if scenario["stream"] else None,
+        render_workers=workers,
+    )
+    seconds = time.perf_counter() - started
+    failed = sum(1 for chunk in chunk_results if chunk["error"] is not None)
+    return {"items": scenario["pages"], "unit": "pages", "latencies": latencies, "seconds": seconds,
+            "failed_batches": failed}
+
+
+def _run_import(scenario, ocr_engine, fixtures):
+    """Import a module in fresh interpreters, so nothing is already loaded."""
+    snippet = f"import time; started = time.perf_counter(); import {scenario['module']}; print(time.perf_counter() - started)"
+    latencies = []
+    for _ in range(scenario["reps"]):
+        output = subprocess.run(
+            [sys.executable, "-c", snippet], cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout
+        latencies.append(float(output.split()[-1]))
+    return {"items": scenario["reps"], "unit": "imports", "latencies": latencies, "seconds": sum(latencies),
+            "bytes_sent": 0, "bytes_received": 0}
+
+
+# Runs ocr_app.py under AppTest, timing the whole script and, by wrapping
+# st.fragment, the body of every fragment in it
+_APP_RUN_SCRIPT = """
+import functools, sys, time
+import streamlit as st
+
+timings = sys.modules["_app_run_timings"]
+real_fragment = st.fragment
+
+def timed_fragment(func=None, **kwargs):
+    if func is None:
+        return lambda func: timed_fragment(func, **kwargs)
+
+    @functools.wraps(func)
+    def timed(*args, **func_kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **func_kwargs)
+        finally:
+            timings.fragments.setdefault(func.__qualname__, []).append(time.perf_counter() - started)
+
+    return real_fragment(timed, **kwargs)
+
+st.fragment = timed_fragment
+started = time.perf_counter()
+try:
+    exec(timings.code, {"__name__": "__main__", "__file__": timings.path})
+finally:
+    timings.runs.append(time.perf_counter() - started)
+    st.fragment = real_fragment
+"""
+
+
+def _run_app(scenario, ocr_engine, fixtures):
+    from streamlit.testing.v1 import AppTest
+
+    timings = sys.modules["_app_run_timings"] = types.ModuleType("_app_run_timings")
+    timings.path = APP_PATH
+    with open(APP_PATH, encoding="utf-8") as f:
+        timings.code = compile(f.read(), APP_PATH, "exec")  # like Streamlit's script cache
+    latencies = []
+    for _ in range(scenario["reps"] if scenario["measure"] == "first_run" else 1):
+        timings.runs, timings.fragments = [], {}
+        app = AppTest.from_string(_APP_RUN_SCRIPT, default_timeout=60)
+        app.run()  # a new session's first run
+        if app.exception:
+            raise RuntimeError(app.exception[0].message)
+        if scenario["measure"] == "first_run":
+            latencies.append(timings.runs[0])
+            continue
+        for _ in range(scenario["reps"]):
+            app.run()
+        latencies = timings.runs[1:] if scenario["measure"] == "rerun" else timings.fragments[scenario["measure"]][1:]
+    return {"items": len(latencies), "unit": "runs", "latencies": latencies, "seconds": sum(latencies),
+            "bytes_sent": 0, "bytes_received": 0}
+
+
+_RUNNERS = {
+    "encode_image": _run_encode_image,
+    "render_pdf": _run_render_pdf,
+    "request_image": _run_request_image,
+    "pipeline": _run_pipeline,
+    "import": _run_import,
+    "app_run": _run_app,
+}
+
+
+def _scenario_process(scenario, result_queue):
+    """
+    Child process entry point: build fixtures, run one scenario, report its
+    metrics. Fixture generation is excluded from the timings.
+    """
+    import fixtures
+    import ocr_engine
+    try:
+        result = _RUNNERS[scenario["kind"]](scenario, ocr_engine, fixtures)
+        result["peak_rss_mb"] = _peak_rss_mb()
+        result_queue.put(result)
+    except Exception as e:  # report instead of hanging the parent
+        result_queue.put({"error": f"{type(e).__name__}: {e}"})
+    finally:
+        ocr_engine.shutdown_render_pool()
+
+
+def _server_stats(server):
+    with urllib.request.urlopen(server.url.replace("/chat/completions", "/stats")) as response:
+        return json.load(response)
+
+
+def run_scenario(scenario, server, context):
+    """Run one scenario in a fresh process against the mock server and summarize it."""
+    server.configure(replace(MockConfig(), **scenario.get("mock", {})))
+    result_queue = context.Queue()
+    process = context.Process(target=_scenario_process, args=(scenario, result_queue))
+    process.start()
+    result = result_queue.get()
+    process.join()
+    if "error" in result:
+        return {"name": scenario["name"], "error": result["error"]}
+
+    summary = {
+        "name": scenario["name"],
+        "items": result["items"],
+        "unit": result["unit"],
+        "seconds": round(result["seconds"], 3),
+        "throughput": round(result["items"] / result["seconds"], 2) if result["seconds"] else 0.0,
+        "peak_rss_mb": round(result["peak_rss_mb"], 1),
+    }
+    latencies_ms = [seconds * 1000 for seconds in result["latencies"]]
+    if latencies_ms:
+        summary.update({
+            "p50_ms": round(_percentile(latencies_ms, 50), 1),
+            "p95_ms": round(_percentile(latencies_ms, 95), 1),
+            "p99_ms": round(_percentile(latencies_ms, 99), 1),
+            "mean_ms": round(statistics.fmean(latencies_ms), 1),
+        })
+    if "bytes_sent" in result:
+        summary["bytes_sent"], summary["bytes_received"] = result["bytes_sent"], result["bytes_received"]
+    else:
+        stats = _server_stats(server)
+        summary.update({
+            "bytes_sent": stats["request_bytes"],
+            "bytes_received": stats["response_bytes"],
+            "http_requests": stats["requests"],
+            "injected_errors": stats["errors"] + stats["rate_limited"],
+        })
+    if "failed_batches" in result:
+        summary["failed_batches"] = result["failed_batches"]
+    return summary
+
+
+def format_table(summaries):
+    headers = ("scenario", "thru/s", "p50 ms", "p95 ms", "p99 ms", "RSS MB", "sent KB", "recv KB")
+    rows = []
+    for summary in summaries:
+        if "error" in summary:
+            rows.append((summary["name"], "error: " + summary["error"], "", "", "", "", "", ""))
+            continue
+        rows.append((
+            summary["name"],
+            f"{summary['throughput']:.1f} {summary['unit']}",
+            f"{summary.get('p50_ms', 0):.1f}",
+            f"{summary.get('p95_ms', 0):.1f}",
+            f"{summary.get('p99_ms', 0):.1f}",
+            f"{summary['peak_rss_mb']:.0f}",
+            f"{summary['bytes_sent'] / 1024:,.0f}",
+            f"{summary['bytes_received'] / 1024:,.0f}",
+        ))
+    widths = [max(len(str(row[i])) for row in rows + [headers]) for i in range(len(headers))]
+    lines = ["  ".join(str(value).ljust(width) for value, width in zip(headers, widths))]
+    lines.append("  ".join("-" * width for width in widths))
+    lines.extend("  ".join(str(value).ljust(width) for value, width in zip(row, widths)) for row in rows)
+    return "\n".join(lines)
+
+
+def find_regressions(summaries, baseline, tolerance_percent):
+    """Compare against a saved run; returns human-readable regression lines."""
+    previous = {summary["name"]: summary for summary in baseline if "error" not in summary}
+    regressions = []
+    for summary in summaries:
+        old = previous.get(summary["name"])
+        if old is None or "error" in summary:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            if metric not in summary or metric not in old or not old[metric]:
+                continue
+            change = 100 * (summary[metric] - old[metric]) / old[metric]
+            if (-change if higher_is_better else change) > tolerance_percent:
+                regressions.append(f"{summary['name']}: {metric} {old[metric]} → {summary[metric]} ({change:+.0f}%)")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the rasterize → encode → request pipeline.")
+    parser.add_argument("--quick", action="store_true", help="Smaller fixtures and fewer repetitions.")
+    parser.add_argument("-k", "--filter", default="", help="Only run scenarios whose name contains this text.")
+    parser.add_argument("--json", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="Earlier --json output to compare against.")
+    parser.add_argument("--tolerance", type=float, default=10.0,
+                        help="Percent change that counts as a regression (default: %(default)s).")
+    args = parser.parse_args(argv)
+
+    scenarios = [scenario for scenario in build_scenarios(args.quick) if args.filter in scenario["name"]]
+    server = MockOpenRouterServer().start_in_background()
+    os.environ["OPENROUTER_API_URL"] = server.url  # inherited by the scenario processes
+    context = multiprocessing.get_context("spawn")
+
+    summaries = []
+    for scenario in scenarios:
+        summary = run_scenario(scenario, server, context)
+        summaries.append(summary)
+        status = summary.get("error") or f"{summary['throughput']:.1f} {summary['unit']}/s"
+        print(f"{scenario['name']}: {status}", file=sys.stderr)
+    server.shutdown()
+
+    print(format_table(summaries))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summaries, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = find_regressions(summaries, json.load(f), args.tolerance)
+        if regressions:
+            print("\nRegressions:\n" + "\n".join(f"  {line}" for line in regressions))
+            return 1
+        print("\nNo regressions beyond the tolerance.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,12 +1,71 @@
 import streamlit as st
 import requests
-import base64
+import collections
+import functools
 import json
-import re
-from PIL import Image
-import io
-import fitz  # PyMuPDF
+import os
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 from streamlit_cookies_controller import CookieController
+from ocr_engine import (
+    AUTO_HEDGED_MODEL_ID,
+    AUTO_MODEL_ID,
+    AUTO_MODEL_NAME,
+    AVAILABLE_MODELS,
+    CONTENT_TYPES,
+    CheckpointStore,
+    DEFAULT_MAX_IMAGE_SIDE,
+    IMAGE_BATCH_DEFAULT_MAX_IN_FLIGHT,
+    IMAGE_PROMPTS,
+    MODEL_MAX_IMAGE_SIDE,
+    OUTPUT_FORMATS,
+    PDF_DEFAULT_MAX_IN_FLIGHT,
+    PDF_DEFAULT_PAGES_PER_REQUEST,
+    PDF_PROMPTS,
+    PDF_RENDER_WORKERS,
+    PDF_TEXT_LAYER_CONTENT_TYPES,
+    RateLimitedKey,
+    StageMetrics,
+    batch_results_to_jsonl,
+    batch_results_to_markdown,
+    batch_results_to_zip,
+    build_chat_messages,
+    default_preprocess_options,
+    encode_image_bytes,
+    encode_image_strips,
+    extract_structured_batch,
+    find_repeated_pages,
+    format_page_ranges,
+    get_checkpoint_store,
+    get_job_manager,
+    get_metrics_registry,
+    get_model_router,
+    get_output_store,
+    get_pdf_document_cache,
+    get_rate_limiter,
+    get_result_cache,
+    get_single_flight,
+    image_cache_digests,
+    merge_chunk_results,
+    ocr_image_batch,
+    ocr_pdf,
+    parse_field_schema,
+    parse_page_selection,
+    pdf_page_count,
+    pdf_page_digest,
+    pdf_pages_to_data_urls,
+    plan_pdf_chunks,
+    plan_pdf_page_resolutions,
+    post_chat_completion,
+    preprocess_signature,
+    read_pdf_text_layers,
+    repeated_page_results,
+    request_image_strips,
+    result_cache_key,
+    sha256_hex,
+    stream_chat_completion,
+    structured_results_to_csv,
+    structured_results_to_jsonl,
+)
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -61,20 +120,49 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # --- Global Variables and Helper Functions ---
-# OpenRouter API Endpoint
-OPENROUTER_API_URL = "https://openrouter.ai/api/v1/chat/completions"
-
-# Available free vision models on OpenRouter
-AVAILABLE_MODELS = {
-    "NVIDIA: Nemotron Nano 12B 2 VL": "nvidia/nemotron-nano-12b-v2-vl:free",
-    "Google: Gemma 3 27B": "google/gemma-3-27b-it:free",
-    "Mistral: Mistral Small 3.1 24B": "mistralai/mistral-small-3.1-24b-instruct:free",
-}
-
 # Maximum number of API calls allowed using the built-in fallback key per session
 FALLBACK_API_MAX_USES = 5
 FALLBACK_API_COOKIE_KEY = "ocr_fallback_api_uses"
 FALLBACK_API_COOKIE_EXPIRES_DAYS = 30
+# Server-wide pacing of the fallback key across all sessions (OpenRouter's free tier allows ~20 requests/minute)
+FALLBACK_RATE_LIMIT_PER_MINUTE = 20
+FALLBACK_RATE_LIMIT_BURST = 5
+FALLBACK_RATE_LIMIT_MAX_WAIT_SECONDS = 120
+
+# PDF processing modes for Tab 3
+PDF_MODE_SINGLE_REQUEST = "Single Request"
+PDF_MODE_CONCURRENT = "Concurrent Page Batches"
+PDF_MAX_PAGES_PER_REQUEST = 10
+PDF_MAX_IN_FLIGHT_LIMIT = 8
+PDF_RENDER_WORKERS_LIMIT = min(8, os.cpu_count() or 1)
+
+# How each PDF page was handled, as shown in the page routing table
+PAGE_ROUTE_LABELS = {
+    "text_layer": "⚡ Text layer",
+    "vision": "👁️ Vision model",
+    "blank": "⬜ Blank, skipped",
+    "duplicate": "🔁 Repeated page, reused",
+}
+
+# Tab 3 results are kept on disk (see OutputStore) and shown this many page sections at a time;
+# the live preview of a running scan shows only the most recently finished sections
+RESULT_SECTIONS_PER_VIEW = 20
+RESULT_PREVIEW_SECTIONS = 5
+DOWNLOAD_FORMAT_LABELS = {"markdown": "Markdown", "jsonl": "JSONL", "text": "Text"}
+
+# Structured JSON extraction in Tab 2's Document Intelligence scope
+DOCUMENT_ANSWER_FORMATS = ("Markdown", "Structured JSON")
+STRUCTURED_DEFAULT_FIELDS = """invoice_number: string  # as printed
+invoice_date: date
+total: number
+currency?: string
+line_items?: list"""
+
+# Multi-image batches in Tab 1
+IMAGE_BATCH_MAX_IN_FLIGHT_LIMIT = 8
+
+# Tab 2 answers and Tab 3 scans run as background jobs; their panel refreshes this often while they run
+JOB_POLL_INTERVAL_SECONDS = 1.0
 
 cookie_manager = CookieController()
 
@@ -102,7 +190,25 @@ def _set_fallback_api_uses(uses):
         max_age=FALLBACK_API_COOKIE_EXPIRES_DAYS * 24 * 3600,
     )
 
-def _make_openrouter_call(api_key, messages, site_url="", site_name="OCR Text Vision Pro"):
+def _lookup_cached_result(cache_key):
+    """Return a cached result if the result cache is enabled for this session."""
+    if not st.session_state.get("use_result_cache", True):
+        return None
+    return get_result_cache().get(cache_key)
+
+def _store_cached_result(cache_key, content):
+    """Store a successful result if the result cache is enabled for this session."""
+    if st.session_state.get("use_result_cache", True) and content:
+        get_result_cache().put(cache_key, content)
+
+def _selected_model_id():
+    """Returns the OpenRouter model ID for the model selected in the sidebar (or an Auto model ID)."""
+    selected = st.session_state.get("selected_model", list(AVAILABLE_MODELS)[0])
+    if selected == AUTO_MODEL_NAME:
+        return AUTO_HEDGED_MODEL_ID if st.session_state.get("hedge_requests", False) else AUTO_MODEL_ID
+    return AVAILABLE_MODELS.get(selected, list(AVAILABLE_MODELS.values())[0])
+
+def _make_openrouter_call(api_key, messages, site_url="", site_name="OCR Text Vision Pro", metrics=None):
     """
     Makes an API call to OpenRouter with the given messages.
 
@@ -111,6 +217,7 @@ def _make_openrouter_call(api_key, messages, site_url="", site_name="OCR Text Vi
         messages (list): A list of message dictionaries for the chat completion API.
         site_url (str): Optional. Site URL for rankings on openrouter.ai.
         site_name (str): Optional. Site title for rankings on openrouter.ai.
+        metrics (StageMetrics): Optional. Collects request timings and token usage.
 
     Returns:
         dict: The JSON response from the OpenRouter API.
@@ -119,23 +226,8 @@ def _make_openrouter_call(api_key, messages, site_url="", site_name="OCR Text Vi
         st.error("OpenRouter API Key is missing. Please provide it in the sidebar.")
         return None
 
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-        "HTTP-Referer": site_url, # Optional. Site URL for rankings on openrouter.ai.
-        "X-Title": "OCR Text Vision Pro", # Optional. Site title for rankings on openrouter.ai.
-    }
-    selected = st.session_state.get("selected_model", list(AVAILABLE_MODELS)[0])
-    model_id = AVAILABLE_MODELS.get(selected, list(AVAILABLE_MODELS.values())[0])
-    payload = json.dumps({
-        "model": model_id,
-        "messages": messages,
-    })
-
     try:
-        response = requests.post(OPENROUTER_API_URL, headers=headers, data=payload)
-        response.raise_for_status() # Raise an exception for HTTP errors (4xx or 5xx)
-        return response.json()
+        return post_chat_completion(api_key, _selected_model_id(), messages, site_url=site_url, metrics=metrics)
     except requests.exceptions.RequestException as e:
         st.error(f"API Error: {e}")
         st.error("Please check your OpenRouter API key and network connection.")
@@ -144,109 +236,930 @@ def _make_openrouter_call(api_key, messages, site_url="", site_name="OCR Text Vi
         st.error("Failed to decode JSON response from API. The response might be malformed.")
         return None
 
-def _resolve_api_key():
+def _stream_openrouter_call(api_key, messages, site_url="", metrics=None):
+    """
+    Streaming counterpart of `_make_openrouter_call`, meant for `st.write_stream`.
+    Errors are shown in the UI and end the stream early.
+
+    Yields:
+        str: The next piece of the assistant's reply.
+    """
+    if not api_key:
+        st.error("OpenRouter API Key is missing. Please provide it in the sidebar.")
+        return
+
+    try:
+        yield from stream_chat_completion(api_key, _selected_model_id(), messages, site_url=site_url, metrics=metrics)
+    except requests.exceptions.RequestException as e:
+        st.error(f"API Error: {e}")
+        st.error("Please check your OpenRouter API key and network connection.")
+    except json.JSONDecodeError:
+        st.error("Failed to decode the streamed response from API. The response might be malformed.")
+
+def _complete_openrouter_call(api_key, messages, output_container=None, metrics=None):
+    """
+    Run a chat completion and return the reply text, or None on failure.
+
+    When response streaming is enabled and `output_container` is given, the reply
+    is rendered progressively into it as tokens arrive.
+    """
+    if st.session_state.get("stream_responses", True) and output_container is not None:
+        with output_container:
+            streamed = st.write_stream(_stream_openrouter_call(api_key, messages, metrics=metrics))
+        return streamed if isinstance(streamed, str) and streamed else None
+    response_json = _make_openrouter_call(api_key, messages, metrics=metrics)
+    if response_json:
+        return response_json['choices'][0]['message']['content']
+    return None
+
+def _run_coalesced(cache_key, request, metrics=None):
+    """
+    Run request() unless an identical request (same cache key) from any session
+    is already in flight; then wait for that one and reuse its reply instead of
+    calling the model again and spending another free API call.
+
+    request() returns the reply text, "" when the model gave no usable reply, or
+    None when no API key was available. Another session's None is not shared:
+    this session then makes its own request.
+    """
+    waiting_notice = st.empty()
+    reply, shared = get_single_flight().do(
+        cache_key,
+        request,
+        on_wait=lambda: waiting_notice.info("⏳ An identical request is already running. Waiting for its result..."),
+        metrics=metrics,
+    )
+    waiting_notice.empty()
+    if shared and reply is None:
+        reply, shared = get_single_flight().do(cache_key, request, metrics=metrics)
+    if shared:
+        st.toast("🔗 Shared the result of an identical request that was already running.")
+    return reply
+
+def _fallback_rate_limiter():
+    """Process-wide limiter that paces and fairly queues every request made with the fallback key."""
+    return get_rate_limiter(
+        "fallback", FALLBACK_RATE_LIMIT_PER_MINUTE, FALLBACK_RATE_LIMIT_BURST, FALLBACK_RATE_LIMIT_MAX_WAIT_SECONDS
+    )
+
+def _session_client_id():
+    """This browser session's ID, which the fallback limiter uses to share capacity fairly between sessions."""
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else "default"
+
+def _rate_limit_note():
+    """Short queue status for progress texts while this session waits for the fallback key, else ""."""
+    if st.session_state.get("openrouter_api_key", "").strip():
+        return ""
+    status = _fallback_rate_limiter().status(_session_client_id())
+    if not status["waiting"]:
+        return ""
+    return f" · ⏳ #{status['position'] + 1} in the shared-key queue (~{status['eta_seconds']:.0f}s)"
+
+def _resolve_api_key(request_count=1, for_job=False):
     """
     Returns the API key to use for an OpenRouter call.
     Priority: user-provided key > built-in fallback key (capped at FALLBACK_API_MAX_USES per session).
+    The fallback key is returned as a RateLimitedKey, so its requests are paced
+    server-wide and queued fairly between sessions, with the queue position shown.
     Shows appropriate error messages and returns None when no key is available.
+
+    `request_count` is how many requests the key is for (one per image of a
+    batch): that many free calls are counted, and the fallback key is only
+    handed out while that many are left.
+
+    With for_job=True nothing is shown or counted: returns (api_key or None, error
+    message or None) for a background job, and `_submit_job` counts the calls
+    when it starts the job.
     """
     # 1. User-provided key takes priority
     user_key = st.session_state.get("openrouter_api_key", "").strip()
     if user_key:
-        return user_key
+        return (user_key, None) if for_job else user_key
 
     # 2. Fallback developer key from Streamlit Secrets
     uses = st.session_state.get("fallback_api_uses", 0)
+    error = None
     if uses >= FALLBACK_API_MAX_USES:
-        st.error(
+        error = (
             f"You have used all {FALLBACK_API_MAX_USES} free API calls for this session. "
             "Please enter your own OpenRouter API key in the sidebar to continue."
         )
+    elif uses + request_count > FALLBACK_API_MAX_USES:
+        error = (
+            f"This needs {request_count} API calls, but only {FALLBACK_API_MAX_USES - uses} free call(s) are left "
+            "for this session. Please enter your own OpenRouter API key in the sidebar, or send fewer files."
+        )
+    else:
+        try:
+            fallback_key = st.secrets["OPENROUTER_API_KEY"]
+        except (KeyError, FileNotFoundError):
+            error = "No API key provided and no fallback key is configured. Please enter your OpenRouter API key in the sidebar."
+    if error:
+        if for_job:
+            return None, error
+        st.error(error)
         return None
 
+    if for_job:
+        return RateLimitedKey(fallback_key, _fallback_rate_limiter(), _session_client_id()), None
+
+    _set_fallback_api_uses(uses + request_count)
+    queue_notice = st.empty()
+
+    def _show_queue_position(position, eta_seconds):
+        if get_script_run_ctx(suppress_warning=True) is None:
+            return  # worker thread of a batch: its progress text shows the queue instead
+        if position is None:
+            queue_notice.empty()
+        else:
+            queue_notice.info(
+                f"⏳ The shared API key is busy. Your request is #{position + 1} in line, about {eta_seconds:.0f}s to go."
+            )
+
+    return RateLimitedKey(fallback_key, _fallback_rate_limiter(), _session_client_id(), _show_queue_position)
+
+def _settle_fallback_uses(snapshot):
+    """
+    Give back the free calls `_submit_job` counted for a finished job that the
+    job did not make: all of its results were cached, or it failed or was
+    cancelled before sending a request.
+    """
+    unused = snapshot["meta"].get("fallback_reserved", 0) - snapshot["meta"].get("api_calls", 0)
+    if unused > 0:
+        _set_fallback_api_uses(st.session_state.get("fallback_api_uses", 0) - unused)
+
+def _job_api_key(api_key, job):
+    """
+    The key to use inside a background job: while a fallback-key request waits
+    in the shared queue, its position is shown as the job's progress text.
+    """
+    if not isinstance(api_key, RateLimitedKey):
+        return api_key
+
+    def _report_queue_position(position, eta_seconds):
+        if position is None:
+            job.report(text="Request admitted, waiting for the model...")
+        else:
+            job.report(text=f"⏳ The shared API key is busy: #{position + 1} in line, about {eta_seconds:.0f}s to go.")
+
+    return RateLimitedKey(api_key, api_key.limiter, api_key.client_id, _report_queue_position)
+
+def _job_chat_completion(job, api_key, model_id, messages, stream, metrics=None):
+    """
+    Background-job counterpart of `_complete_openrouter_call`: returns the reply
+    text, or "" on failure (noted as errors on the job). Streamed replies are
+    previewed through the job as they arrive.
+    """
     try:
-        fallback_key = st.secrets["OPENROUTER_API_KEY"]
-    except (KeyError, FileNotFoundError):
-        st.error("No API key provided and no fallback key is configured. Please enter your OpenRouter API key in the sidebar.")
-        return None
+        if not stream:
+            response_json = post_chat_completion(api_key, model_id, messages, metrics=metrics)
+            return response_json['choices'][0]['message']['content'] or ""
+        reply = ""
+        for piece in stream_chat_completion(api_key, model_id, messages, metrics=metrics):
+            job.check_cancelled()
+            reply += piece
+            job.set_partial(reply)
+        return reply
+    except requests.exceptions.RequestException as e:
+        job.note("error", f"API Error: {e}")
+        job.note("error", "Please check your OpenRouter API key and network connection.")
+    except json.JSONDecodeError:
+        job.note("error", "Failed to decode JSON response from API. The response might be malformed.")
+    return ""
+
+def _submit_job(job_state_key, kind, label, fn, api_key=None, fallback_uses=1):
+    """
+    Run fn(job) in the background for this session and remember the job under `job_state_key`.
 
-    _set_fallback_api_uses(uses + 1)
-    return fallback_key
+    When `api_key` is the fallback key, its `fallback_uses` free calls are
+    counted before the job starts, so jobs started side by side cannot use more
+    calls than are left. The job records the calls it makes as its "api_calls"
+    meta value, and `_settle_fallback_uses` gives back the rest once it finishes.
+    """
+    reserved = fallback_uses if isinstance(api_key, RateLimitedKey) else 0
+    if reserved:
+        _set_fallback_api_uses(st.session_state.get("fallback_api_uses", 0) + reserved)
+    job = get_job_manager().submit(_session_client_id(), kind, label, fn)
+    job.set_meta("fallback_reserved", reserved)
+    st.session_state[job_state_key] = job.id
+    return job
+
+def _job_is_active(job_state_key):
+    job_id = st.session_state.get(job_state_key)
+    job = get_job_manager().get(job_id) if job_id else None
+    return job is not None and job.active
+
+def _show_job_notes(notes):
+    """Show (level, message) notes kept by a background job."""
+    for level, message in notes or []:
+        if level == "toast":
+            st.toast(message)
+        else:
+            getattr(st, level)(message)
 
-def _get_base64_image_data_url(uploaded_file):
+def _poll_job(job_state_key, collect):
     """
-    Converts an uploaded Streamlit file to a base64 data URL.
+    Show the background job remembered under `job_state_key`: its progress,
+    partial output and a Cancel button, refreshed every JOB_POLL_INTERVAL_SECONDS
+    by a fragment without rerunning the rest of the app. Once the job is over,
+    collect(snapshot) stores its outcome in session state and the app reruns to show it.
+    """
+    job_id = st.session_state.get(job_state_key)
+    if not job_id:
+        return
+    job = get_job_manager().get(job_id)
+    if job is None:  # pruned, or lost with a server restart
+        st.session_state[job_state_key] = None
+        return
+
+    @st.fragment(run_every=JOB_POLL_INTERVAL_SECONDS if job.active else None)
+    def _job_panel():
+        snapshot = job.snapshot()
+        if snapshot["status"] in ("queued", "running"):
+            if snapshot["status"] == "queued":
+                text = "Waiting for a free worker..."
+            else:
+                text = snapshot["progress_text"] or snapshot["label"]
+            fraction = snapshot["completed"] / snapshot["total"] if snapshot["total"] else 0.0
+            st.progress(min(fraction, 1.0), text=f"{text} ({snapshot['elapsed_seconds']:.0f}s)")
+            if snapshot["partial"]:
+                with st.container(height=300):
+                    st.markdown(snapshot["partial"])
+            if snapshot["cancel_requested"] or st.button("Cancel", key=f"{job_state_key}_cancel_button"):
+                job.cancel()
+                st.caption("Cancelling after the requests already running...")
+            st.caption("🔄 Runs in the background: you can keep using the app while it works.")
+            return
+        st.session_state[job_state_key] = None
+        get_job_manager().forget(job_id)
+        collect(snapshot)
+        st.rerun()
+
+    _job_panel()
+
+def _get_base64_image_data_url(uploaded_file, preprocess_options=None):
+    """
+    Converts an uploaded Streamlit file to a base64 data URL, preprocessing it
+    first when preprocessing is enabled.
 
     Args:
         uploaded_file (streamlit.runtime.uploaded_file_manager.UploadedFile): The uploaded file object.
+        preprocess_options (dict): Optional. Settings from `_image_preprocessing_options`.
 
     Returns:
-        str: A base64 encoded data URL string.
+        tuple: (base64 encoded data URL string, stats dict with original/sent bytes and sizes)
     """
     if uploaded_file is None:
-        return None
-    image_bytes = uploaded_file.getvalue()
-    base64_image = base64.b64encode(image_bytes).decode('utf-8')
-    return f"data:{uploaded_file.type};base64,{base64_image}"
-
-def _parse_page_selection(selection_str, total_pages):
-    """
-    Parse a comma-separated page selection string like '1-5, 8, 12, 34' into
-    a sorted list of 0-based page indices. Returns (list, error_msg).
-    """
-    if not selection_str or not selection_str.strip():
-        return [], "Please enter at least one page number."
-    pages = set()
-    for part in selection_str.split(","):
-        part = part.strip()
-        if not part:
-            continue
-        range_match = re.match(r"^(\d+)\s*-\s*(\d+)$", part)
-        if range_match:
-            start, end = int(range_match.group(1)), int(range_match.group(2))
-            if start < 1 or end < 1:
-                return [], f"Page numbers must be positive (got '{part}')."
-            if start > end:
-                return [], f"Invalid range '{part}' — start must be ≤ end."
-            if end > total_pages:
-                return [], f"Page {end} exceeds the PDF's {total_pages} page(s)."
-            pages.update(range(start, end + 1))
-        elif re.match(r"^\d+$", part):
-            p = int(part)
-            if p < 1:
-                return [], "Page numbers must be positive."
-            if p > total_pages:
-                return [], f"Page {p} exceeds the PDF's {total_pages} page(s)."
-            pages.add(p)
+        return None, None
+    return encode_image_bytes(uploaded_file.getvalue(), uploaded_file.type, preprocess_options)
+
+def _get_tab2_encoded_image(preprocess_options):
+    """
+    Encoded data URL, payload stats and content digest for the Tab 2 image,
+    memoized per image signature and preprocessing settings so chat turns and
+    repeated questions don't re-read, re-preprocess and re-encode the image.
+
+    Returns:
+        dict: {"data_url", "stats", "digest"}
+    """
+    memo_key = (st.session_state.tab2_image_signature, preprocess_signature(preprocess_options))
+    encoded = st.session_state.get("tab2_encoded_image")
+    if encoded is None or encoded["key"] != memo_key:
+        uploaded_file = st.session_state.tab2_uploaded_file
+        data_url, stats = _get_base64_image_data_url(uploaded_file, preprocess_options)
+        encoded = {"key": memo_key, "data_url": data_url, "stats": stats, "digest": sha256_hex(uploaded_file.getvalue())}
+        st.session_state.tab2_encoded_image = encoded
+    return encoded
+
+def _uploaded_pdf_digest(uploaded_file):
+    """
+    Content hash of an uploaded PDF, computed once per upload instead of on
+    every rerun. It keys the PDF document cache, result cache and checkpoints.
+    """
+    memo = st.session_state.get("tab3_pdf_digest")
+    if memo is None or memo[0] != uploaded_file.file_id:
+        memo = (uploaded_file.file_id, sha256_hex(uploaded_file.getvalue()))
+        st.session_state.tab3_pdf_digest = memo
+    return memo[1]
+
+def _image_preprocessing_options():
+    """
+    Collect the session's image preprocessing settings for the selected model.
+    Returned as a plain dict so it can be handed to worker threads.
+    """
+    return default_preprocess_options(
+        _selected_model_id(),
+        enabled=st.session_state.get("preprocess_images", True),
+        grayscale=st.session_state.get("preprocess_grayscale", False),
+        autocrop=st.session_state.get("preprocess_autocrop", True),
+    )
+
+def _format_payload_stats(stats):
+    """One-line summary of original vs transmitted image size."""
+    original_kb = stats["original_bytes"] / 1024
+    sent_kb = stats["sent_bytes"] / 1024
+    change = 100 * (stats["sent_bytes"] / stats["original_bytes"] - 1) if stats["original_bytes"] else 0
+    summary = (
+        f"📦 Upload payload: {original_kb:,.0f} KB → {sent_kb:,.0f} KB ({change:+.0f}%), "
+        f"{stats['original_size'][0]}×{stats['original_size'][1]} → {stats['sent_size'][0]}×{stats['sent_size'][1]} px"
+    )
+    if stats.get("strips", 1) > 1:
+        summary += f" in {stats['strips']} strips"
+    return summary
+
+def _page_route_rows(chunk_results):
+    """Per-page table rows showing whether each page was read locally, skipped, reused or sent to the model."""
+    rows = []
+    for chunk in chunk_results:
+        path = PAGE_ROUTE_LABELS[chunk.get("method", "vision")]
+        for page in chunk["pages"]:
+            rows.append({"Page": page, "Path": path, "Reason": chunk.get("reason", "")})
+    return sorted(rows, key=lambda row: row["Page"])
+
+def _show_page_routes(rows):
+    """Summarize which pages took the text-layer fast path and which went to the model."""
+    summaries = {
+        "text_layer": "read from the text layer",
+        "vision": "sent to the vision model",
+        "blank": "blank and skipped",
+        "duplicate": "repeated, results reused",
+    }
+    parts = []
+    for method, summary in summaries.items():
+        pages = [row["Page"] for row in rows if row["Path"] == PAGE_ROUTE_LABELS[method]]
+        if pages:
+            parts.append(f"{PAGE_ROUTE_LABELS[method].split()[0]} {len(pages)} page(s) {summary} ({format_page_ranges(pages)})")
+    st.caption(" · ".join(parts))
+    with st.expander("Page routing details"):
+        st.table(rows)
+
+def _show_diagnostics(run_summary):
+    """Collapsible per-stage timing breakdown for the last run, with metric exports."""
+    with st.expander("🩺 Diagnostics"):
+        tokens = run_summary["tokens"]
+        col_wall, col_prompt, col_completion = st.columns(3)
+        col_wall.metric("Wall time", f"{run_summary['wall_seconds']:.2f} s")
+        col_prompt.metric("Prompt tokens", f"{tokens.get('prompt_tokens', 0):,}")
+        col_completion.metric("Completion tokens", f"{tokens.get('completion_tokens', 0):,}")
+        if run_summary["stages"]:
+            st.table([
+                {
+                    "Stage": stage, "Calls": stats["count"], "Total (s)": f"{stats['total_s']:.3f}",
+                    "Mean (ms)": f"{stats['mean_ms']:.1f}", "p50 (ms)": f"{stats['p50_ms']:.1f}",
+                    "p95 (ms)": f"{stats['p95_ms']:.1f}", "Max (ms)": f"{stats['max_ms']:.1f}",
+                }
+                for stage, stats in run_summary["stages"].items()
+            ])
+            st.caption("Stages overlap when pages are rendered and requested concurrently, so totals can exceed the wall time.")
+        else:
+            st.caption("Nothing was rendered or sent; every page came from the cache or a checkpoint.")
+        page_cache = get_pdf_document_cache().stats()
+        st.caption(
+            f"Page cache: {page_cache['pages']} rendered pages ({page_cache['bytes'] / 1e6:.1f} MB) "
+            f"from {page_cache['documents']} open PDFs, {page_cache['hits']} hits / {page_cache['misses']} misses."
+        )
+        col_json, col_prometheus = st.columns(2)
+        with col_json:
+            st.download_button(
+                "Download run (JSON)",
+                data=json.dumps(run_summary, indent=2),
+                file_name="ocr_run_metrics.json",
+                mime="application/json",
+                key="tab3_download_metrics_json",
+            )
+        with col_prometheus:
+            st.download_button(
+                "Download Prometheus metrics",
+                data=get_metrics_registry().prometheus_text(),
+                file_name="ocr_metrics.prom",
+                mime="text/plain",
+                key="tab3_download_metrics_prometheus",
+                help="Stage duration histograms and token counters for all runs since the app started.",
+            )
+
+def _batch_result_row(item_result):
+    """Progress/summary table row for one image of a Tab 1 batch."""
+    if item_result["error"] is not None:
+        status, preview = "❌ Failed", item_result["error"]
+    else:
+        status = "⚡ Cached" if item_result["cached"] else "🔗 Shared" if item_result["shared"] else "✅ Done"
+        preview = " ".join(item_result["content"].split())
+    return {
+        "File": item_result["name"],
+        "Status": status,
+        "Time (s)": f"{item_result['seconds']:.1f}",
+        "Preview": preview[:80] + ("…" if len(preview) > 80 else ""),
+    }
+
+def _show_ocr_result(content, content_type):
+    """Render one extraction result the way its content type reads best."""
+    if content_type == "LaTeX Equation Conversion":
+        st.code(content, language='latex')
+        st.markdown("#### Rendered LaTeX:")
+        cleaned_latex = content.replace(r"\[", "").replace(r"\]", "")
+        st.latex(cleaned_latex)
+    elif content_type == "Code Snippet Extraction":
+        st.code(content, language='python') # Assuming Python, can be adjusted
+    else:
+        st.markdown(content)
+
+def _show_batch_results(batch):
+    """Summary table, combined downloads and per-image results of a Tab 1 batch."""
+    results, content_type, model_id = batch["results"], batch["content_type"], batch["model_id"]
+    failed = sum(result["error"] is not None for result in results)
+    cached = sum(result["cached"] for result in results)
+    st.markdown("### Results:")
+    st.caption(
+        f"{len(results)} images in {batch['seconds']:.1f} s ({len(results) / max(batch['seconds'], 1e-6):.1f} images/s), "
+        f"{cached} from the result cache, {failed} failed."
+    )
+    st.table([_batch_result_row(result) for result in results])
+    col_zip, col_jsonl, col_markdown = st.columns(3)
+    with col_zip:
+        st.download_button(
+            "Download ZIP",
+            data=batch_results_to_zip(results, content_type, model_id),
+            file_name="ocr_batch_results.zip",
+            mime="application/zip",
+            key="tab1_download_zip",
+        )
+    with col_jsonl:
+        st.download_button(
+            "Download JSONL",
+            data=batch_results_to_jsonl(results, content_type, model_id),
+            file_name="ocr_batch_results.jsonl",
+            mime="application/jsonl",
+            key="tab1_download_jsonl",
+        )
+    with col_markdown:
+        st.download_button(
+            "Download Markdown",
+            data=batch_results_to_markdown(results, content_type),
+            file_name="ocr_batch_results.md",
+            mime="text/markdown",
+            key="tab1_download_markdown",
+        )
+    for result in results:
+        with st.expander(f"{'❌' if result['error'] else '📄'} {result['name']}"):
+            if result["error"]:
+                st.error(result["error"])
+            else:
+                _show_ocr_result(result["content"], content_type)
+
+def _show_result_file(result_file):
+    """
+    A Tab 3 result kept on disk: downloads of the whole document, and its page
+    sections RESULT_SECTIONS_PER_VIEW at a time, read from the file only for the
+    view on screen.
+    """
+    section_count = result_file.section_count()
+    st.markdown("### Result:")
+    columns = st.columns(len(OUTPUT_FORMATS))
+    for column, (output_format, (extension, mime)) in zip(columns, OUTPUT_FORMATS.items()):
+        with column:
+            st.download_button(
+                f"Download {DOWNLOAD_FORMAT_LABELS[output_format]}",
+                # built only when clicked, straight from the result file
+                data=functools.partial(result_file.export, output_format),
+                file_name=f"ocr_pdf_result{extension}",
+                mime=mime,
+                on_click="ignore",
+                key=f"tab3_download_{output_format}",
+            )
+    view_count = max(1, -(-section_count // RESULT_SECTIONS_PER_VIEW))
+    start = 0
+    if view_count > 1:
+        view = st.number_input(f"Result part (of {view_count})", min_value=1, max_value=view_count, key="tab3_result_view")
+        start = (min(view, view_count) - 1) * RESULT_SECTIONS_PER_VIEW
+        st.caption(
+            f"Showing page sections {start + 1}–{min(start + RESULT_SECTIONS_PER_VIEW, section_count)} of "
+            f"{section_count}. The downloads contain the whole document."
+        )
+    sections = result_file.sections(start, RESULT_SECTIONS_PER_VIEW)
+    _show_ocr_result(merge_chunk_results(sections, result_file.content_type), result_file.content_type)
+
+def _answer_job(job, api_key, model_id, messages, cache_key, stream, use_cache, image_signature):
+    """Background job for a one-time answer in Tab 2. Runs without Streamlit calls."""
+    job.set_meta("api_calls", 1)
+    answer = _job_chat_completion(job, _job_api_key(api_key, job), model_id, messages, stream)
+    if answer and use_cache:
+        get_result_cache().put(cache_key, answer)
+    return {"answer": answer, "image_signature": image_signature}
+
+def _collect_answer_job(snapshot):
+    """Store a finished Tab 2 answer job's outcome in session state."""
+    result = snapshot["result"]
+    notes = snapshot["notes"]
+    if snapshot["status"] == "failed":
+        notes = notes + [("error", f"The request failed: {snapshot['error']}")]
+    elif snapshot["status"] == "cancelled":
+        notes = notes + [("info", "The request was cancelled.")]
+    _settle_fallback_uses(snapshot)
+    if result is not None:
+        if result["image_signature"] == st.session_state.tab2_image_signature:
+            st.session_state.tab2_result = result["answer"] or "Error: Could not get a response from the model."
+    st.session_state.tab2_notes = notes
+
+def _structured_job(job, api_key, key_error, documents, fields, instructions, model_id, preprocess_options,
+                    max_in_flight, use_cache):
+    """Background job for a Tab 2 structured extraction over one or more documents. Runs without Streamlit calls."""
+    run_metrics = StageMetrics("structured_extraction")
+
+    def _get_api_key(request_count):
+        if api_key is None:
+            job.note("error", key_error)
+            return None
+        job.set_meta("api_calls", request_count)
+        return _job_api_key(api_key, job)
+
+    def _on_document_done(completed, total, result):
+        job.report(completed, total, f"Extracted fields from {completed} of {total} document(s)")
+        job.check_cancelled()
+
+    job.report(0, len(documents), f"Extracting fields from {len(documents)} document(s)...")
+    results = extract_structured_batch(
+        _get_api_key, model_id, documents, fields, instructions, max_in_flight, preprocess_options,
+        get_result_cache() if use_cache else None, _on_document_done, run_metrics,
+    )
+    if results is not None:
+        repaired = sum(1 for result in results if result["repaired"])
+        if repaired:
+            job.note(
+                "caption",
+                f"🩹 {repaired} document(s) had missing or invalid fields, which were asked for again on their own.",
+            )
+        incomplete = sum(1 for result in results if result["error"] or result["problems"])
+        if incomplete:
+            job.note("warning", f"⚠️ {incomplete} of {len(results)} document(s) failed or still have invalid fields.")
+        elif all(result["cached"] for result in results):
+            job.note("toast", "⚡ Served from the result cache.")
+    return {
+        "results": results, "fields": fields, "model_id": model_id, "metrics": run_metrics.finish().to_dict(),
+    }
+
+def _collect_structured_job(snapshot):
+    """Store a finished Tab 2 structured extraction job's outcome in session state."""
+    notes = snapshot["notes"]
+    if snapshot["status"] == "failed":
+        notes = notes + [("error", f"The extraction failed: {snapshot['error']}")]
+    elif snapshot["status"] == "cancelled":
+        notes = notes + [("info", "The extraction was cancelled.")]
+    _settle_fallback_uses(snapshot)
+    if snapshot["result"] is not None and snapshot["result"]["results"] is not None:
+        st.session_state.tab2_structured = snapshot["result"]
+    st.session_state.tab2_notes = notes
+
+def _structured_result_row(result, fields):
+    """One table row of a structured extraction: the file, its status and its field values."""
+    if result["error"]:
+        status = "❌ Failed"
+    elif result["problems"]:
+        status = f"⚠️ {len(result['problems'])} invalid"
+    elif result["cached"]:
+        status = "⚡ Cached"
+    else:
+        status = "✅ Done" + (f" ({len(result['repaired'])} retried)" if result["repaired"] else "")
+    row = {"File": result["name"], "Status": status}
+    for field in fields:
+        value = (result["values"] or {}).get(field["name"])
+        row[field["name"]] = "; ".join(map(str, value)) if isinstance(value, list) else "" if value is None else str(value)
+    return row
+
+def _show_structured_results(structured):
+    """Table, downloads and per-document JSON of a Tab 2 structured extraction."""
+    results, fields, model_id = structured["results"], structured["fields"], structured["model_id"]
+    st.markdown("### Result:")
+    st.dataframe([_structured_result_row(result, fields) for result in results], hide_index=True)
+    col_jsonl, col_csv = st.columns(2)
+    with col_jsonl:
+        st.download_button(
+            "Download JSONL",
+            data=structured_results_to_jsonl(results, model_id),
+            file_name="structured_extraction.jsonl",
+            mime="application/jsonl",
+            key="tab2_download_structured_jsonl",
+        )
+    with col_csv:
+        st.download_button(
+            "Download CSV",
+            data=structured_results_to_csv(results, fields),
+            file_name="structured_extraction.csv",
+            mime="text/csv",
+            key="tab2_download_structured_csv",
+        )
+    for result in results:
+        with st.expander(f"{'❌' if result['error'] else '🧾'} {result['name']}", expanded=len(results) == 1):
+            if result["error"]:
+                st.error(result["error"])
+                continue
+            for name, problem in result["problems"].items():
+                st.warning(f"`{name}`: {problem}")
+            st.json(result["values"])
+
+def _structured_extraction_section():
+    """Tab 2's Structured JSON answer format: fields from a schema, for the uploaded image and any bulk documents."""
+    st.session_state.tab2_fields = st.text_area(
+        "Fields to extract:",
+        value=st.session_state.tab2_fields,
+        height=150,
+        key="tab2_fields_input",
+        help="One field per line as `name: type`, where type is one of string, number, integer, boolean, date or "
+             "list. Add `?` after the name for optional fields and `# description` to guide the model. A JSON Schema "
+             "object with \"properties\" works too.",
+    )
+    fields, schema_error = parse_field_schema(st.session_state.tab2_fields)
+    st.session_state.tab2_instructions = st.text_input(
+        "Additional instructions (optional):",
+        value=st.session_state.tab2_instructions,
+        placeholder="e.g., 'Amounts are in EUR', 'Use the billing address, not the shipping address'",
+        key="tab2_instructions_input",
+    )
+    bulk_files = st.file_uploader(
+        "More documents for bulk extraction (optional):",
+        type=['png', 'jpg', 'jpeg', 'pdf'],
+        accept_multiple_files=True,
+        key="tab2_bulk_uploader",
+        help="Every document gets the same fields; PDFs are read as a whole, so keep them to a few pages.",
+    )
+    uploads = ([st.session_state.tab2_uploaded_file] if st.session_state.tab2_uploaded_file else []) + list(bulk_files)
+    if len(uploads) > 1:
+        st.slider(
+            "Parallel requests",
+            min_value=1,
+            max_value=IMAGE_BATCH_MAX_IN_FLIGHT_LIMIT,
+            key="tab2_max_in_flight",
+            help="How many documents are extracted at the same time.",
+        )
+
+    label = f"Extract Fields from {len(uploads)} Documents 🧾" if len(uploads) > 1 else "Extract Fields 🧾"
+    if st.button(label, key="tab2_extract_fields_button", disabled=_job_is_active("tab2_job_id")):
+        if not uploads:
+            st.error("Please upload an image first.")
+        elif schema_error:
+            st.error(schema_error)
         else:
-            return [], f"Invalid entry '{part}'. Use numbers or ranges like '1-5'."
-    sorted_pages = sorted(pages)
-    indices = [p - 1 for p in sorted_pages]  # convert to 0-based
-    return indices, None
-
-def _pdf_pages_to_data_urls(pdf_bytes, page_indices):
-    """
-    Convert specific pages of a PDF to base64 PNG data URLs.
-    """
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-    data_urls = []
-    for idx in page_indices:
-        page = doc.load_page(idx)
-        pix = page.get_pixmap(dpi=150)
-        png_bytes = pix.tobytes("png")
-        b64 = base64.b64encode(png_bytes).decode("utf-8")
-        data_urls.append(f"data:image/png;base64,{b64}")
-    doc.close()
-    return data_urls
+            api_key, key_error = _resolve_api_key(len(uploads), for_job=True)
+            st.session_state.tab2_structured = None
+            _submit_job(
+                "tab2_job_id",
+                "structured",
+                f"Extracting fields from {len(uploads)} document(s)...",
+                functools.partial(
+                    _structured_job,
+                    api_key=api_key,
+                    key_error=key_error,
+                    documents=[(upload.name, upload.getvalue(), upload.type) for upload in uploads],
+                    fields=fields,
+                    instructions=st.session_state.tab2_instructions,
+                    model_id=_selected_model_id(),
+                    preprocess_options=_image_preprocessing_options(),
+                    max_in_flight=st.session_state.tab2_max_in_flight,
+                    use_cache=st.session_state.use_result_cache,
+                ),
+                api_key=api_key,
+                fallback_uses=len(uploads),
+            )
+    elif schema_error:
+        st.caption(f"⚠️ {schema_error}")
+
+    _poll_job("tab2_job_id", _collect_structured_job)
+    if st.session_state.tab2_notes:
+        _show_job_notes(st.session_state.tab2_notes)
+        st.session_state.tab2_notes = None
+    if st.session_state.tab2_structured:
+        _show_structured_results(st.session_state.tab2_structured)
+
+def _scan_pdf_job(job, api_key, key_error, pdf_bytes, pdf_digest, page_indices, content_type, model_id,
+                  preprocess_options, concurrent, pages_per_request, max_in_flight, render_workers,
+                  use_text_layer, skip_repeated_pages, adaptive_resolution, use_cache, stream):
+    """
+    Background job for a Tab 3 scan. Runs without Streamlit calls: progress,
+    previews and messages go through `job`, and the outcome is returned for
+    `_collect_pdf_scan_job`. Single Request scans whose pages exceed the model's
+    request budget, or that include a page split into strips, are sent as packed
+    batches one after another. A cancelled
+    batched scan keeps its checkpoints, so scanning again resumes with the
+    missing pages.
+
+    Page results are appended to a per-job result file as they arrive, and only
+    its handle is returned, so large documents are never held as one string.
+    """
+    run_metrics = StageMetrics("pdf_scan")
+    prompt_text = PDF_PROMPTS[content_type]
+    output = get_output_store().create(content_type)
+    output_handle, page_route_rows = None, None
+
+    def _get_api_key():
+        if api_key is None:
+            job.note("error", key_error)
+            return None
+        job.set_meta("api_calls", 1)
+        return _job_api_key(api_key, job)
+
+    if not concurrent:
+        text_layer_chunks = []
+        vision_indices = page_indices
+        if use_text_layer:
+            page_routes = read_pdf_text_layers(pdf_bytes, page_indices, run_metrics, pdf_digest)
+            text_layer_chunks = [
+                {"pages": [idx + 1], "content": route["content"], "error": None,
+                 "method": "text_layer", "reason": route["reason"]}
+                for idx, route in page_routes.items() if route["method"] == "text_layer"
+            ]
+            vision_indices = [idx for idx in page_indices if page_routes[idx]["method"] == "vision"]
+        duplicate_of, blank_pages = {}, []
+        if skip_repeated_pages:
+            duplicate_of, blank_pages = find_repeated_pages(pdf_bytes, vision_indices, run_metrics, pdf_digest)
+            vision_indices = [idx for idx in vision_indices if idx not in duplicate_of and idx not in blank_pages]
+        page_resolutions = None
+        if adaptive_resolution:
+            page_resolutions = plan_pdf_page_resolutions(
+                pdf_bytes, vision_indices, content_type, preprocess_options["max_side"], run_metrics, pdf_digest
+            )
+        packed_chunks = plan_pdf_chunks(
+            pdf_bytes, vision_indices, model_id, None, preprocess_options, pdf_digest, page_resolutions
+        )
+        has_strips = any(resolution["clips"] for resolution in (page_resolutions or {}).values())
+        if len(packed_chunks) > 1 or has_strips:
+            # Too much for one request to this model, or pages whose strips are sent and stitched on their own:
+            # send the planned batches one after another instead
+            if has_strips:
+                reason = "include pages with print too small to read in one image"
+            else:
+                reason = "exceed one request's budget for this model"
+            job.note(
+                "info",
+                f"📐 The {len(vision_indices)} page(s) for the vision model {reason}, so they were sent as "
+                f"{len(packed_chunks)} batch(es) and merged in page order.",
+            )
+            concurrent, pages_per_request, max_in_flight = True, None, 1
+
+    if concurrent:
+        job.report(0, 1, "Starting page batches...")
+        completed_chunks = collections.deque(maxlen=RESULT_PREVIEW_SECTIONS)
+
+        def _update_progress(completed, total, chunk_result):
+            job.report(completed, total, f"Completed {completed} of {total} batch(es)")
+            completed_chunks.append(chunk_result)
+            _show_partial_preview({})
+
+        def _show_partial_preview(partial_texts):
+            job.check_cancelled()
+            in_progress = [
+                {"pages": [first_page], "content": f"{text} ⏳", "error": None}
+                for first_page, text in partial_texts.items()
+            ]
+            preview_chunks = sorted([*completed_chunks, *in_progress], key=lambda chunk: chunk["pages"][0])
+            job.set_partial(merge_chunk_results(preview_chunks, content_type))
+
+        chunk_results = ocr_pdf(
+            _get_api_key,
+            model_id,
+            pdf_bytes,
+            content_type,
+            page_indices,
+            pages_per_request=pages_per_request,
+            max_in_flight=max_in_flight,
+            preprocess_options=preprocess_options,
+            cache=get_result_cache() if use_cache else None,
+            checkpoints=get_checkpoint_store(),
+            on_chunk_done=_update_progress,
+            on_stream_update=_show_partial_preview if stream else None,
+            text_layer=use_text_layer,
+            metrics=run_metrics,
+            pdf_digest=pdf_digest,
+            render_workers=render_workers,
+            skip_repeated_pages=skip_repeated_pages,
+            adaptive_resolution=adaptive_resolution,
+            output=output,
+        )
+
+        if chunk_results is not None:
+            vision_chunks = [chunk for chunk in chunk_results if chunk["method"] == "vision"]
+            sent_chunks = [chunk for chunk in vision_chunks if not chunk["cached"]]
+            if sent_chunks:
+                sent_bytes = sum(chunk["sent_bytes"] for chunk in sent_chunks)
+                sent_pages = sum(len(chunk["pages"]) for chunk in sent_chunks)
+                job.note("caption", f"📦 Sent {sent_pages} page image(s), {sent_bytes / 1024:,.0f} KB of image data.")
+                split_chunks = [chunk for chunk in sent_chunks if chunk.get("strips", 1) > 1]
+                if split_chunks:
+                    job.note(
+                        "caption",
+                        f"🔬 Dense print: page(s) {format_page_ranges([chunk['pages'][0] for chunk in split_chunks])} "
+                        f"were split into {sum(chunk['strips'] for chunk in split_chunks)} strips, read in parallel "
+                        "and stitched back together.",
+                    )
+            elif vision_chunks:
+                job.note("toast", "⚡ All page batches were served from the result cache.")
+            if use_text_layer or skip_repeated_pages:
+                page_route_rows = _page_route_rows(chunk_results)
+            failed = [chunk for chunk in chunk_results if chunk["error"] is not None]
+            if failed:
+                job.note("warning", f"⚠️ {len(failed)} of {len(chunk_results)} batch(es) failed. See the errors inline below.")
+            output_handle = output.handle()
+    else:
+        job.report(0, 1, f"Scanning {len(page_indices)} page(s)...")
+        scan_result = None
+        if vision_indices:
+            cache_key = result_cache_key(
+                [pdf_page_digest(pdf_digest, idx, preprocess_options, adaptive_resolution) for idx in vision_indices],
+                model_id, prompt_text,
+            )
+            scan_result = get_result_cache().get(cache_key) if use_cache else None
+            if scan_result is not None:
+                job.note("toast", "⚡ Served from the result cache.")
+            else:
+                def _scan_pages():
+                    scan_key = _get_api_key()
+                    if not scan_key:
+                        return None
+                    data_urls = pdf_pages_to_data_urls(
+                        pdf_bytes, vision_indices, preprocess_options, run_metrics, pdf_digest, render_workers,
+                        page_resolutions,
+                    )
+                    job.check_cancelled()
+                    job.note("caption", f"📦 Sent {len(data_urls)} page image(s), {sum(len(url) for url in data_urls) / 1024:,.0f} KB of image data.")
+                    content_parts: list[dict] = [{"type": "text", "text": prompt_text}]
+                    for url in data_urls:
+                        content_parts.append({"type": "image_url", "image_url": {"url": url}})
+
+                    messages = [{"role": "user", "content": content_parts}]
+                    return _job_chat_completion(job, scan_key, model_id, messages, stream, metrics=run_metrics)
+
+                scan_result, shared = get_single_flight().do(
+                    cache_key,
+                    _scan_pages,
+                    on_wait=lambda: job.report(text="⏳ An identical request is already running. Waiting for its result..."),
+                    metrics=run_metrics,
+                )
+                if shared:
+                    job.note("toast", "🔗 Shared the result of an identical request that was already running.")
+                if scan_result:
+                    if use_cache:
+                        get_result_cache().put(cache_key, scan_result)
+                elif scan_result is not None:
+                    scan_result = "Error: Could not get a response from the model."
+                else:
+                    # no key: nothing to show
+                    text_layer_chunks, duplicate_of, blank_pages = [], {}, []
+
+        if scan_result is not None or not vision_indices:
+            chunk_results = list(text_layer_chunks)
+            if vision_indices:
+                failed = scan_result.startswith("Error:")
+                chunk_results.append({
+                    "pages": [idx + 1 for idx in vision_indices],
+                    "content": None if failed else scan_result,
+                    "error": scan_result[len("Error: "):] if failed else None,
+                    "method": "vision",
+                    "reason": "; ".join(sorted({page_routes[idx]["reason"] for idx in vision_indices})) if use_text_layer else "",
+                })
+            chunk_results += repeated_page_results(duplicate_of, blank_pages, chunk_results, content_type)
+            chunk_results.sort(key=lambda chunk: chunk["pages"][0])
+            for chunk_result in chunk_results:
+                output.append(chunk_result)
+            output_handle = output.handle()
+            if text_layer_chunks or duplicate_of or blank_pages:
+                page_route_rows = _page_route_rows(chunk_results)
+            if not vision_indices:
+                job.note("toast", "⚡ No page needed the vision model, so no API call was made.")
+
+    if output_handle is None:
+        get_output_store().delete(output.handle())
+    return {"output": output_handle, "page_routes": page_route_rows, "metrics": run_metrics.finish().to_dict()}
+
+def _collect_pdf_scan_job(snapshot):
+    """Store a finished Tab 3 scan job's outcome in session state."""
+    notes = snapshot["notes"]
+    if snapshot["status"] == "failed":
+        notes = notes + [("error", f"The scan failed: {snapshot['error']}")]
+    elif snapshot["status"] == "cancelled":
+        notes = notes + [(
+            "info",
+            "The scan was cancelled. In Concurrent Page Batches mode, finished batches are checkpointed, "
+            "so scanning again resumes from there.",
+        )]
+    _settle_fallback_uses(snapshot)
+    if snapshot["result"] is not None:
+        st.session_state.tab3_output = snapshot["result"]["output"]
+        st.session_state.tab3_page_routes = snapshot["result"]["page_routes"]
+        st.session_state.tab3_metrics = snapshot["result"]["metrics"]
+    st.session_state.tab3_notes = notes
 
 def _clear_all_results():
     """
-    Resets all session state variables related to inputs and outputs across all tabs.
+    Resets all session state variables related to inputs and outputs across all tabs,
+    and cancels this session's background jobs.
     """
+    for job in get_job_manager().jobs_for(_session_client_id()):
+        job.cancel()
     # Tab 1
     st.session_state.tab1_uploaded_file = None
     st.session_state.tab1_content_type = "General Text Extraction"
     st.session_state.tab1_ocr_result = None
+    st.session_state.tab1_batch = None
+    st.session_state.tab1_max_in_flight = IMAGE_BATCH_DEFAULT_MAX_IN_FLIGHT
     # Tab 2 (Ask, Analyze & Chat)
     st.session_state.tab2_uploaded_file = None
     st.session_state.tab2_mode = "One-time Answer"
@@ -255,17 +1168,54 @@ def _clear_all_results():
     st.session_state.tab2_result = None
     st.session_state.tab2_chat_history = []
     st.session_state.tab2_image_signature = None
+    st.session_state.tab2_encoded_image = None
+    st.session_state.tab2_job_id = None
+    st.session_state.tab2_notes = None
+    st.session_state.tab2_answer_format = "Markdown"
+    st.session_state.tab2_fields = STRUCTURED_DEFAULT_FIELDS
+    st.session_state.tab2_instructions = ""
+    st.session_state.tab2_max_in_flight = IMAGE_BATCH_DEFAULT_MAX_IN_FLIGHT
+    st.session_state.tab2_structured = None
     # Tab 3 (PDF Scan & Extract)
     st.session_state.tab3_uploaded_file = None
     st.session_state.tab3_content_type = "General Text Extraction"
     st.session_state.tab3_page_mode = "All Pages"
     st.session_state.tab3_page_selection = ""
-    st.session_state.tab3_result = None
+    st.session_state.tab3_processing_mode = PDF_MODE_SINGLE_REQUEST
+    st.session_state.tab3_pages_per_request = PDF_DEFAULT_PAGES_PER_REQUEST
+    st.session_state.tab3_auto_pack = False
+    st.session_state.tab3_max_in_flight = PDF_DEFAULT_MAX_IN_FLIGHT
+    st.session_state.tab3_render_workers = min(PDF_RENDER_WORKERS, PDF_RENDER_WORKERS_LIMIT)
+    st.session_state.tab3_use_text_layer = True
+    st.session_state.tab3_skip_repeated_pages = False
+    get_output_store().delete(st.session_state.get("tab3_output"))
+    st.session_state.tab3_output = None
+    st.session_state.tab3_result_view = 1
+    st.session_state.tab3_page_routes = None
+    st.session_state.tab3_metrics = None
+    st.session_state.tab3_job_id = None
+    st.session_state.tab3_notes = None
     for legacy_key in ["tab4_uploaded_file", "tab4_chat_history"]:
         if legacy_key in st.session_state:
             del st.session_state[legacy_key]
     st.rerun() # Rerun to clear inputs and outputs on the UI
 
+def _tab_fragment(render_tab):
+    """
+    Run a tab as a fragment, so its widgets rerun only that tab. A tab run that
+    spent a use of the fallback key reruns the whole app once, so the count in
+    the sidebar stays current.
+    """
+    @st.fragment
+    @functools.wraps(render_tab)
+    def _render():
+        uses_before = st.session_state.fallback_api_uses
+        render_tab()
+        if st.session_state.fallback_api_uses != uses_before:
+            st.rerun()
+
+    return _render
+
 # --- Title and Global Sidebar Content ---
 col_title, col_clear = st.columns([6, 1])
 with col_title:
@@ -288,8 +1238,23 @@ st.markdown("---")
 # Initialize session state defaults
 if 'openrouter_api_key' not in st.session_state:
     st.session_state.openrouter_api_key = ""
-if 'selected_model' not in st.session_state or st.session_state.selected_model not in AVAILABLE_MODELS:
+MODEL_OPTIONS = list(AVAILABLE_MODELS) + [AUTO_MODEL_NAME]
+if 'selected_model' not in st.session_state or st.session_state.selected_model not in MODEL_OPTIONS:
     st.session_state.selected_model = list(AVAILABLE_MODELS)[0]
+if 'hedge_requests' not in st.session_state:
+    st.session_state.hedge_requests = False
+if 'stream_responses' not in st.session_state:
+    st.session_state.stream_responses = True
+if 'preprocess_images' not in st.session_state:
+    st.session_state.preprocess_images = True
+if 'preprocess_autocrop' not in st.session_state:
+    st.session_state.preprocess_autocrop = True
+if 'preprocess_grayscale' not in st.session_state:
+    st.session_state.preprocess_grayscale = False
+if 'adaptive_resolution' not in st.session_state:
+    st.session_state.adaptive_resolution = False
+if 'use_result_cache' not in st.session_state:
+    st.session_state.use_result_cache = True
 if 'fallback_api_uses' not in st.session_state:
     cookie_uses = _read_fallback_uses_from_cookie()
     st.session_state.fallback_api_uses = cookie_uses if cookie_uses is not None else 0
@@ -311,6 +1276,9 @@ with st.sidebar:
         remaining = max(0, FALLBACK_API_MAX_USES - st.session_state.fallback_api_uses)
         if remaining > 0:
             st.info(f"🔑 No key entered — {remaining} free use(s) remaining this session.")
+            queued = _fallback_rate_limiter().stats()["queued"]
+            if queued:
+                st.caption(f"🚦 The shared key is busy: {queued} request(s) queued across all users.")
         else:
             st.warning(f"⚠️ All {FALLBACK_API_MAX_USES} free uses exhausted. Please enter your own API key.")
 
@@ -319,11 +1287,77 @@ with st.sidebar:
     # Model selector dropdown
     st.session_state.selected_model = st.selectbox(
         "Select Vision Model:",
-        options=list(AVAILABLE_MODELS.keys()),
-        index=list(AVAILABLE_MODELS.keys()).index(st.session_state.selected_model),
-        help="Choose which free vision model to use for OCR and image understanding.",
+        options=MODEL_OPTIONS,
+        index=MODEL_OPTIONS.index(st.session_state.selected_model),
+        help="Choose which free vision model to use for OCR and image understanding. "
+             "Auto sends each request to the currently fastest healthy model and falls back to the others on errors.",
     )
-    st.caption(f"Model ID: `{AVAILABLE_MODELS[st.session_state.selected_model]}`")
+    if st.session_state.selected_model == AUTO_MODEL_NAME:
+        st.session_state.hedge_requests = st.toggle(
+            "Hedge slow requests",
+            value=st.session_state.hedge_requests,
+            help="If a model hasn't answered within its usual (p95) latency, also ask the next model and use "
+                 "whichever answers first. Can cost an extra request. Not applied to streamed replies.",
+        )
+        with st.expander("📡 Model health"):
+            st.table(get_model_router().health())
+    else:
+        st.caption(f"Model ID: `{AVAILABLE_MODELS[st.session_state.selected_model]}`")
+
+    st.markdown("---")
+
+    st.session_state.stream_responses = st.toggle(
+        "Stream responses",
+        value=st.session_state.stream_responses,
+        help="Show the model's reply token by token as it is generated instead of waiting for the full answer.",
+    )
+
+    # Image preprocessing settings
+    with st.expander("🖼️ Image Optimization"):
+        st.session_state.preprocess_images = st.toggle(
+            "Optimize images before upload",
+            value=st.session_state.preprocess_images,
+            help="Downscale to the model's useful resolution, strip EXIF, and pick PNG for text/line art or JPEG for photos.",
+        )
+        st.session_state.preprocess_autocrop = st.checkbox(
+            "Auto-crop blank margins",
+            value=st.session_state.preprocess_autocrop,
+            disabled=not st.session_state.preprocess_images,
+        )
+        st.session_state.preprocess_grayscale = st.checkbox(
+            "Convert to grayscale",
+            value=st.session_state.preprocess_grayscale,
+            disabled=not st.session_state.preprocess_images,
+        )
+        st.session_state.adaptive_resolution = st.toggle(
+            "Adaptive resolution",
+            value=st.session_state.adaptive_resolution,
+            help="Size images and PDF pages by their text: large print is sent at a lower resolution, and print too "
+                 "small to read at the model's max side is split into overlapping strips that are read in parallel "
+                 "and stitched back together.",
+        )
+        st.caption(f"Max image side for this model: {MODEL_MAX_IMAGE_SIDE.get(_selected_model_id(), DEFAULT_MAX_IMAGE_SIDE)} px")
+
+    # Result cache controls and counters
+    st.session_state.use_result_cache = st.toggle(
+        "Use result cache",
+        value=st.session_state.use_result_cache,
+        help="Reuse earlier results for the same image, model and prompt. Cache hits are instant and don't use free API calls.",
+    )
+    cache_stats = get_result_cache().stats()
+    col_hits, col_misses = st.columns(2)
+    col_hits.metric("Cache hits", cache_stats["hits"])
+    col_misses.metric("Cache misses", cache_stats["misses"])
+    st.caption(f"{cache_stats['entries']} cached result(s), {cache_stats['bytes'] / 1024:.1f} KB on disk.")
+    flight_stats = get_single_flight().stats()
+    if flight_stats["shared"]:
+        st.caption(f"🔗 {flight_stats['shared']} duplicate request(s) joined an identical request already in flight.")
+    job_stats = get_job_manager().stats()
+    if job_stats["running"] or job_stats["queued"]:
+        st.caption(f"⚙️ {job_stats['running']} background job(s) running, {job_stats['queued']} queued on the server.")
+    if st.button("Clear Result Cache", key="clear_result_cache_button"):
+        get_result_cache().clear()
+        st.rerun()
 
     st.markdown("---")
     st.header("💻 About This App")
@@ -354,11 +1388,14 @@ with st.sidebar:
 
 
 # --- Main Application Tabs ---
-st.subheader("Select an Optical Character Recognition (OCR) Functionality:")
-tab1, tab2, tab3 = st.tabs(["📈 Extract & Convert", "🎯 Ask, Analyze & Chat", "📑 PDF Scan & Extract"])
+# Each tab is a fragment: interacting with one tab reruns only that tab, not the
+# header, the sidebar or the other two tabs. Anything that changes shared state
+# (Clear All, the sidebar settings, a finished background job) reruns the whole app.
 
 # --- Tab 1: Extract & Convert ---
-with tab1:
+@_tab_fragment
+def _extract_and_convert_tab():
+    """Tab 1: one image, or a batch of images, to text, LaTeX, code or a description."""
     st.header("General OCR & Content Recognition")
     st.markdown("Upload an image and select the type of content you want to extract or describe.")
 
@@ -369,74 +1406,163 @@ with tab1:
         st.session_state.tab1_content_type = "General Text Extraction"
     if 'tab1_ocr_result' not in st.session_state:
         st.session_state.tab1_ocr_result = None
+    if 'tab1_batch' not in st.session_state:
+        st.session_state.tab1_batch = None
+    if 'tab1_max_in_flight' not in st.session_state:
+        st.session_state.tab1_max_in_flight = IMAGE_BATCH_DEFAULT_MAX_IN_FLIGHT
 
-    uploaded_file_tab1 = st.file_uploader("Choose an image...", type=['png', 'jpg', 'jpeg'], key="tab1_uploader")
-    if uploaded_file_tab1:
-        st.session_state.tab1_uploaded_file = uploaded_file_tab1
+    uploaded_files_tab1 = st.file_uploader(
+        "Choose one or more images...", type=['png', 'jpg', 'jpeg'], accept_multiple_files=True, key="tab1_uploader"
+    )
+    batch_files_tab1 = uploaded_files_tab1 if len(uploaded_files_tab1) > 1 else []
+    if len(uploaded_files_tab1) == 1:
+        st.session_state.tab1_uploaded_file = uploaded_files_tab1[0]
         # Display image in a smaller, responsive column
         col_img1, _ = st.columns([0.4, 0.6]) # Allocate 40% of the width to the image column
         with col_img1:
-            st.image(uploaded_file_tab1, caption="Uploaded Image", use_container_width=True)
+            st.image(uploaded_files_tab1[0], caption="Uploaded Image", use_container_width=True)
+    elif batch_files_tab1:
+        st.caption(f"🗂️ {len(batch_files_tab1)} images selected. They are processed as one batch with parallel requests.")
+        with st.expander("Preview images"):
+            st.image(batch_files_tab1, caption=[f.name for f in batch_files_tab1], width=160)
+        st.slider(
+            "Parallel requests",
+            min_value=1,
+            max_value=IMAGE_BATCH_MAX_IN_FLIGHT_LIMIT,
+            key="tab1_max_in_flight",
+            help="How many images are encoded and sent at the same time. Higher values finish large batches sooner but may hit rate limits on free models.",
+        )
 
     content_type = st.radio(
         "Select Content Type:",
-        ("General Text Extraction", "LaTeX Equation Conversion", "Code Snippet Extraction", "Chart/Diagram Description"),
+        CONTENT_TYPES,
         key="tab1_content_type_radio"
     )
     st.session_state.tab1_content_type = content_type
 
-    if st.button("Process Image 🚀", key="tab1_process_button"):
-        api_key = _resolve_api_key()
-        if not api_key:
-            pass  # _resolve_api_key already showed the error
+    process_label = "Process Images 🚀" if batch_files_tab1 else "Process Image 🚀"
+    if st.button(process_label, key="tab1_process_button"):
+        if batch_files_tab1:
+            preprocess_options = _image_preprocessing_options()
+            images = [(f.name, f.getvalue(), f.type) for f in batch_files_tab1]
+            batch_progress = st.progress(0.0, text=f"Processing {len(images)} images...")
+            batch_table = st.empty()
+            batch_rows = [{"File": name, "Status": "⏳ Queued", "Time (s)": "", "Preview": ""} for name, _, _ in images]
+            batch_table.table(batch_rows)
+
+            def _on_image_done(completed, total, item_result):
+                batch_rows[item_result["index"]] = _batch_result_row(item_result)
+                batch_progress.progress(completed / total, text=f"Processed {completed} of {total} images{_rate_limit_note()}")
+                batch_table.table(batch_rows)
+
+            run_metrics = StageMetrics("image_batch")
+            batch_results = ocr_image_batch(
+                _resolve_api_key,
+                _selected_model_id(),
+                images,
+                st.session_state.tab1_content_type,
+                max_in_flight=st.session_state.tab1_max_in_flight,
+                preprocess_options=preprocess_options,
+                cache=get_result_cache() if st.session_state.get("use_result_cache", True) else None,
+                on_item_done=_on_image_done,
+                metrics=run_metrics,
+                adaptive_resolution=st.session_state.adaptive_resolution,
+            )
+            run_metrics.finish()
+            batch_progress.empty()
+            batch_table.empty()
+            if batch_results is not None:  # None: _resolve_api_key already showed the error
+                st.session_state.tab1_ocr_result = None
+                st.session_state.tab1_batch = {
+                    "results": batch_results,
+                    "content_type": st.session_state.tab1_content_type,
+                    "model_id": _selected_model_id(),
+                    "seconds": run_metrics.wall_seconds,
+                }
         elif st.session_state.tab1_uploaded_file is None:
             st.error("Please upload an image first.")
         else:
             with st.spinner("Processing image..."):
-                image_data_url = _get_base64_image_data_url(st.session_state.tab1_uploaded_file)
-                prompt_text = ""
-
-                if st.session_state.tab1_content_type == "General Text Extraction":
-                    prompt_text = """Analyze the text in the provided image. Extract all readable content and present it in a structured Markdown format that is clear, concise, and well-organized. Ensure proper formatting (e.g., headings, lists, or code blocks) as necessary to represent the content effectively."""
-                elif st.session_state.tab1_content_type == "LaTeX Equation Conversion":
-                    prompt_text = """Understand the mathematical equation in the provided image and output the corresponding LaTeX code. NEVER include any additional text or explanations. DON'T add dollar signs ($) around the LaTeX code. DO NOT extract simplified versions of the equations. NEVER add documentclass, packages or begindocument. DO NOT explain the symbols used in the equation. Output only the LaTeX code corresponding to the mathematical equations in the image."""
-                elif st.session_state.tab1_content_type == "Code Snippet Extraction":
-                    prompt_text = """Extract all code from the provided image. Present the code in a formatted code block suitable for direct use. Do not include any additional text or explanations."""
-                elif st.session_state.tab1_content_type == "Chart/Diagram Description":
-                    prompt_text = """Describe the chart or diagram in the provided image. Explain its key elements, data, and any trends or insights it presents in a clear, concise manner."""
-
-                messages = [
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt_text},
-                            {"type": "image_url", "image_url": {"url": image_data_url}}
+                preprocess_options = _image_preprocessing_options()
+                prompt_text = IMAGE_PROMPTS[st.session_state.tab1_content_type]
+                adaptive_resolution = st.session_state.adaptive_resolution
+
+                cache_key = result_cache_key(
+                    image_cache_digests(
+                        st.session_state.tab1_uploaded_file.getvalue(), preprocess_options, adaptive_resolution
+                    ),
+                    _selected_model_id(),
+                    prompt_text,
+                )
+                cached_result = _lookup_cached_result(cache_key)
+                if cached_result is not None:
+                    st.session_state.tab1_ocr_result = cached_result
+                    st.session_state.tab1_batch = None
+                    st.toast("⚡ Served from the result cache.")
+                else:
+                    def _extract_image():
+                        api_key = _resolve_api_key()
+                        if not api_key:  # _resolve_api_key already showed the error
+                            return None
+                        uploaded_file = st.session_state.tab1_uploaded_file
+                        if adaptive_resolution:
+                            data_urls, payload_stats = encode_image_strips(
+                                uploaded_file.getvalue(), uploaded_file.type, st.session_state.tab1_content_type,
+                                preprocess_options,
+                            )
+                            image_data_url = data_urls[0]
+                        else:
+                            image_data_url, payload_stats = _get_base64_image_data_url(uploaded_file, preprocess_options)
+                            data_urls = [image_data_url]
+                        st.caption(_format_payload_stats(payload_stats))
+                        if len(data_urls) > 1:
+                            # Dense print: the strips are read in parallel and stitched, so the reply is not streamed
+                            try:
+                                return request_image_strips(api_key, _selected_model_id(), prompt_text, data_urls)
+                            except requests.exceptions.RequestException as e:
+                                st.error(f"API Error: {e}")
+                                st.error("Please check your OpenRouter API key and network connection.")
+                            except json.JSONDecodeError:
+                                st.error("Failed to decode JSON response from API. The response might be malformed.")
+                            except (KeyError, IndexError, TypeError):
+                                st.error("Unexpected response format from API.")
+                            return ""
+                        messages = [
+                            {
+                                "role": "user",
+                                "content": [
+                                    {"type": "text", "text": prompt_text},
+                                    {"type": "image_url", "image_url": {"url": image_data_url}}
+                                ]
+                            }
                         ]
-                    }
-                ]
-
-                response_json = _make_openrouter_call(api_key, messages)
 
-                if response_json:
-                    extracted_content = response_json['choices'][0]['message']['content']
-                    st.session_state.tab1_ocr_result = extracted_content
-                else:
-                    st.session_state.tab1_ocr_result = "Error: Could not get a response from the model."
+                        stream_preview = st.empty()
+                        reply = _complete_openrouter_call(api_key, messages, stream_preview.container())
+                        stream_preview.empty()
+                        return reply or ""
+
+                    extracted_content = _run_coalesced(cache_key, _extract_image)
+                    if extracted_content is not None:
+                        st.session_state.tab1_batch = None
+                        if extracted_content:
+                            st.session_state.tab1_ocr_result = extracted_content
+                            _store_cached_result(cache_key, extracted_content)
+                        else:
+                            st.session_state.tab1_ocr_result = "Error: Could not get a response from the model."
 
     if st.session_state.tab1_ocr_result:
         st.markdown("### Result:")
-        if st.session_state.tab1_content_type == "LaTeX Equation Conversion":
-            st.code(st.session_state.tab1_ocr_result, language='latex')
-            st.markdown("#### Rendered LaTeX:")
-            cleaned_latex = st.session_state.tab1_ocr_result.replace(r"\[", "").replace(r"\]", "")
-            st.latex(cleaned_latex)
-        elif st.session_state.tab1_content_type == "Code Snippet Extraction":
-            st.code(st.session_state.tab1_ocr_result, language='python') # Assuming Python, can be adjusted
-        else:
-            st.markdown(st.session_state.tab1_ocr_result)
+        _show_ocr_result(st.session_state.tab1_ocr_result, st.session_state.tab1_content_type)
+
+
+    if st.session_state.tab1_batch:
+        _show_batch_results(st.session_state.tab1_batch)
 
 # --- Tab 2: Ask, Analyze & Chat ---
-with tab2:
+@_tab_fragment
+def _ask_analyze_chat_tab():
+    """Tab 2: one-time answers, Document Intelligence and multi-turn chat about an image."""
     st.header("Ask, Analyze & Chat")
     st.markdown("Upload an image and interact with the AI — ask a one-time question, extract document data, or hold a multi-turn conversation.")
 
@@ -455,6 +1581,22 @@ with tab2:
         st.session_state.tab2_chat_history = []
     if 'tab2_image_signature' not in st.session_state:
         st.session_state.tab2_image_signature = None
+    if 'tab2_encoded_image' not in st.session_state:
+        st.session_state.tab2_encoded_image = None
+    if 'tab2_job_id' not in st.session_state:
+        st.session_state.tab2_job_id = None
+    if 'tab2_notes' not in st.session_state:
+        st.session_state.tab2_notes = None
+    if 'tab2_answer_format' not in st.session_state:
+        st.session_state.tab2_answer_format = "Markdown"
+    if 'tab2_fields' not in st.session_state:
+        st.session_state.tab2_fields = STRUCTURED_DEFAULT_FIELDS
+    if 'tab2_instructions' not in st.session_state:
+        st.session_state.tab2_instructions = ""
+    if 'tab2_max_in_flight' not in st.session_state:
+        st.session_state.tab2_max_in_flight = IMAGE_BATCH_DEFAULT_MAX_IN_FLIGHT
+    if 'tab2_structured' not in st.session_state:
+        st.session_state.tab2_structured = None
 
     uploaded_file_tab2 = st.file_uploader("Choose an image...", type=['png', 'jpg', 'jpeg'], key="tab2_uploader")
     if uploaded_file_tab2:
@@ -462,6 +1604,7 @@ with tab2:
         new_sig = f"{uploaded_file_tab2.name}:{uploaded_file_tab2.size}:{uploaded_file_tab2.type}"
         if new_sig != st.session_state.tab2_image_signature:
             st.session_state.tab2_image_signature = new_sig
+            st.session_state.tab2_encoded_image = None
             st.session_state.tab2_chat_history = []
             st.session_state.tab2_result = None
         col_img2, _ = st.columns([0.4, 0.6])
@@ -485,54 +1628,98 @@ with tab2:
         )
         st.session_state.tab2_analysis_scope = analysis_scope
 
+        answer_format = "Markdown"
         if analysis_scope == "Document Intelligence":
-            placeholder = "e.g., 'Extract invoice number and total amount', 'What is the date on this contract?'"
-        else:
-            placeholder = "e.g., 'What is the main subject?', 'Describe the scene'"
+            answer_format = st.radio(
+                "Answer Format:",
+                DOCUMENT_ANSWER_FORMATS,
+                key="tab2_answer_format_radio",
+                horizontal=True,
+                help="Structured JSON extracts the fields you list, checks every value and asks again only for "
+                     "fields that came back missing or invalid. It also works across many documents at once.",
+            )
+        st.session_state.tab2_answer_format = answer_format
 
-        user_question = st.text_area(
-            "Enter your question or extraction request:",
-            value=st.session_state.tab2_question,
-            placeholder=placeholder,
-            key="tab2_question_input",
-        )
-        st.session_state.tab2_question = user_question
-
-        btn_label = "Extract / Answer 🔍" if analysis_scope == "Document Intelligence" else "Get Answer 🤔"
-        if st.button(btn_label, key="tab2_process_button"):
-            api_key = _resolve_api_key()
-            if not api_key:
-                pass
-            elif st.session_state.tab2_uploaded_file is None:
-                st.error("Please upload an image first.")
-            elif not st.session_state.tab2_question.strip():
-                st.error("Please enter a question or extraction request.")
+        if answer_format == "Structured JSON":
+            _structured_extraction_section()
+        else:
+            if analysis_scope == "Document Intelligence":
+                placeholder = "e.g., 'Extract invoice number and total amount', 'What is the date on this contract?'"
             else:
-                with st.spinner("Processing..."):
-                    image_data_url = _get_base64_image_data_url(st.session_state.tab2_uploaded_file)
-                    if analysis_scope == "Document Intelligence":
-                        prompt_text = f"Analyze the provided document image and respond to the following request: {st.session_state.tab2_question}. Present the answer in a clear, structured Markdown format."
-                    else:
-                        prompt_text = f"Based on the provided image, answer the following question: {st.session_state.tab2_question}"
-
-                    messages = [
-                        {
-                            "role": "user",
-                            "content": [
-                                {"type": "text", "text": prompt_text},
-                                {"type": "image_url", "image_url": {"url": image_data_url}},
-                            ],
-                        }
-                    ]
-                    response_json = _make_openrouter_call(api_key, messages)
-                    if response_json:
-                        st.session_state.tab2_result = response_json['choices'][0]['message']['content']
-                    else:
-                        st.session_state.tab2_result = "Error: Could not get a response from the model."
+                placeholder = "e.g., 'What is the main subject?', 'Describe the scene'"
 
-        if st.session_state.tab2_result:
-            st.markdown("### Result:")
-            st.markdown(st.session_state.tab2_result)
+            user_question = st.text_area(
+                "Enter your question or extraction request:",
+                value=st.session_state.tab2_question,
+                placeholder=placeholder,
+                key="tab2_question_input",
+            )
+            st.session_state.tab2_question = user_question
+
+            btn_label = "Extract / Answer 🔍" if analysis_scope == "Document Intelligence" else "Get Answer 🤔"
+            if st.button(btn_label, key="tab2_process_button", disabled=_job_is_active("tab2_job_id")):
+                if st.session_state.tab2_uploaded_file is None:
+                    st.error("Please upload an image first.")
+                elif not st.session_state.tab2_question.strip():
+                    st.error("Please enter a question or extraction request.")
+                else:
+                    with st.spinner("Processing..."):
+                        preprocess_options = _image_preprocessing_options()
+                        if analysis_scope == "Document Intelligence":
+                            prompt_text = f"Analyze the provided document image and respond to the following request: {st.session_state.tab2_question}. Present the answer in a clear, structured Markdown format."
+                        else:
+                            prompt_text = f"Based on the provided image, answer the following question: {st.session_state.tab2_question}"
+
+                        cache_key = result_cache_key(
+                            [sha256_hex(st.session_state.tab2_uploaded_file.getvalue()), preprocess_signature(preprocess_options)],
+                            _selected_model_id(),
+                            prompt_text,
+                        )
+                        cached_result = _lookup_cached_result(cache_key)
+                        if cached_result is not None:
+                            st.session_state.tab2_result = cached_result
+                            st.toast("⚡ Served from the result cache.")
+                        else:
+                            api_key, key_error = _resolve_api_key(for_job=True)
+                            if key_error:
+                                st.error(key_error)
+                            else:
+                                encoded_image = _get_tab2_encoded_image(preprocess_options)
+                                st.caption(_format_payload_stats(encoded_image["stats"]))
+                                messages = [
+                                    {
+                                        "role": "user",
+                                        "content": [
+                                            {"type": "text", "text": prompt_text},
+                                            {"type": "image_url", "image_url": {"url": encoded_image["data_url"]}},
+                                        ],
+                                    }
+                                ]
+                                st.session_state.tab2_result = None
+                                _submit_job(
+                                    "tab2_job_id",
+                                    "answer",
+                                    "Waiting for the model's answer...",
+                                    functools.partial(
+                                        _answer_job,
+                                        api_key=api_key,
+                                        model_id=_selected_model_id(),
+                                        messages=messages,
+                                        cache_key=cache_key,
+                                        stream=st.session_state.stream_responses,
+                                        use_cache=st.session_state.use_result_cache,
+                                        image_signature=st.session_state.tab2_image_signature,
+                                    ),
+                                    api_key=api_key,
+                                )
+
+            _poll_job("tab2_job_id", _collect_answer_job)
+            if st.session_state.tab2_notes:
+                _show_job_notes(st.session_state.tab2_notes)
+                st.session_state.tab2_notes = None
+            if st.session_state.tab2_result:
+                st.markdown("### Result:")
+                st.markdown(st.session_state.tab2_result)
 
     else:  # Chat Session
         for message in st.session_state.tab2_chat_history:
@@ -540,47 +1727,53 @@ with tab2:
                 st.markdown(message["content"])
 
         if user_prompt := st.chat_input("Type your message here..."):
-            api_key = _resolve_api_key()
-            if not api_key:
-                pass
-            elif st.session_state.tab2_uploaded_file is None:
+            if st.session_state.tab2_uploaded_file is None:
                 st.error("Please upload an image to start the chat.")
             else:
                 with st.spinner("Thinking..."):
-                    image_data_url = _get_base64_image_data_url(st.session_state.tab2_uploaded_file)
-
-                    st.session_state.tab2_chat_history.append({"role": "user", "content": user_prompt})
-
-                    # Build API messages — attach image to the first user message
-                    api_messages = []
-                    first_user_done = False
-                    for msg in st.session_state.tab2_chat_history:
-                        if msg["role"] == "user" and not first_user_done:
-                            api_messages.append({
-                                "role": "user",
-                                "content": [
-                                    {"type": "text", "text": msg["content"]},
-                                    {"type": "image_url", "image_url": {"url": image_data_url}},
-                                ],
-                            })
-                            first_user_done = True
-                        else:
-                            api_messages.append({"role": msg["role"], "content": msg["content"]})
-
-                    response_json = _make_openrouter_call(api_key, api_messages)
-                    if response_json:
-                        assistant_response = response_json['choices'][0]['message']['content']
+                    preprocess_options = _image_preprocessing_options()
+                    encoded_image = _get_tab2_encoded_image(preprocess_options)
+
+                    conversation = st.session_state.tab2_chat_history + [{"role": "user", "content": user_prompt}]
+
+                    # Image goes with the first user message; older turns are condensed to fit the context budget
+                    api_messages, condensed_turns = build_chat_messages(conversation, encoded_image["data_url"])
+
+                    cache_key = result_cache_key(
+                        [encoded_image["digest"], preprocess_signature(preprocess_options)],
+                        _selected_model_id(),
+                        json.dumps(conversation),
+                    )
+                    assistant_response = _lookup_cached_result(cache_key)
+                    if assistant_response is not None:
+                        with st.chat_message("user"):
+                            st.markdown(user_prompt)
+                        with st.chat_message("assistant"):
+                            st.markdown(assistant_response)
                     else:
-                        assistant_response = "Error: Could not get a response from the model."
-
-                    st.session_state.tab2_chat_history.append({"role": "assistant", "content": assistant_response})
-                    with st.chat_message("user"):
-                        st.markdown(user_prompt)
-                    with st.chat_message("assistant"):
-                        st.markdown(assistant_response)
+                        api_key = _resolve_api_key()
+                        if api_key:
+                            with st.chat_message("user"):
+                                st.markdown(user_prompt)
+                            if condensed_turns:
+                                st.caption(f"🗜️ {condensed_turns} earlier message(s) condensed to keep the request small.")
+                            assistant_message = st.chat_message("assistant")
+                            assistant_response = _complete_openrouter_call(api_key, api_messages, assistant_message)
+                            if assistant_response:
+                                _store_cached_result(cache_key, assistant_response)
+                            else:
+                                assistant_response = "Error: Could not get a response from the model."
+                            if not st.session_state.get("stream_responses", True) or assistant_response.startswith("Error:"):
+                                with assistant_message:
+                                    st.markdown(assistant_response)
+
+                    if assistant_response is not None:
+                        st.session_state.tab2_chat_history = conversation + [{"role": "assistant", "content": assistant_response}]
 
 # --- Tab 3: PDF Scan & Extract ---
-with tab3:
+@_tab_fragment
+def _pdf_scan_tab():
+    """Tab 3: PDF page scans, run as background jobs."""
     st.header("PDF Scan & Extract")
     st.markdown("Upload a PDF file to extract text, equations, code, or descriptions from its pages using vision AI.")
 
@@ -593,16 +1786,37 @@ with tab3:
         st.session_state.tab3_page_mode = "All Pages"
     if 'tab3_page_selection' not in st.session_state:
         st.session_state.tab3_page_selection = ""
-    if 'tab3_result' not in st.session_state:
-        st.session_state.tab3_result = None
+    if 'tab3_processing_mode' not in st.session_state:
+        st.session_state.tab3_processing_mode = PDF_MODE_SINGLE_REQUEST
+    if 'tab3_pages_per_request' not in st.session_state:
+        st.session_state.tab3_pages_per_request = PDF_DEFAULT_PAGES_PER_REQUEST
+    if 'tab3_auto_pack' not in st.session_state:
+        st.session_state.tab3_auto_pack = False
+    if 'tab3_max_in_flight' not in st.session_state:
+        st.session_state.tab3_max_in_flight = PDF_DEFAULT_MAX_IN_FLIGHT
+    if 'tab3_render_workers' not in st.session_state:
+        st.session_state.tab3_render_workers = min(PDF_RENDER_WORKERS, PDF_RENDER_WORKERS_LIMIT)
+    if 'tab3_use_text_layer' not in st.session_state:
+        st.session_state.tab3_use_text_layer = True
+    if 'tab3_skip_repeated_pages' not in st.session_state:
+        st.session_state.tab3_skip_repeated_pages = False
+    if 'tab3_output' not in st.session_state:
+        st.session_state.tab3_output = None
+    if 'tab3_result_view' not in st.session_state:
+        st.session_state.tab3_result_view = 1
+    if 'tab3_page_routes' not in st.session_state:
+        st.session_state.tab3_page_routes = None
+    if 'tab3_metrics' not in st.session_state:
+        st.session_state.tab3_metrics = None
+    if 'tab3_job_id' not in st.session_state:
+        st.session_state.tab3_job_id = None
+    if 'tab3_notes' not in st.session_state:
+        st.session_state.tab3_notes = None
 
     uploaded_pdf = st.file_uploader("Choose a PDF file...", type=['pdf'], key="tab3_uploader")
     if uploaded_pdf:
         st.session_state.tab3_uploaded_file = uploaded_pdf
-        pdf_bytes = uploaded_pdf.getvalue()
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-        total_pages = doc.page_count
-        doc.close()
+        total_pages = pdf_page_count(uploaded_pdf.getvalue(), _uploaded_pdf_digest(uploaded_pdf))
         st.info(f"📄 PDF loaded: **{total_pages}** page(s)")
 
         page_mode = st.radio(
@@ -623,74 +1837,181 @@ with tab3:
 
     content_type_pdf = st.radio(
         "Select Content Type:",
-        ("General Text Extraction", "LaTeX Equation Conversion", "Code Snippet Extraction", "Chart/Diagram Description"),
+        CONTENT_TYPES,
         key="tab3_content_type_radio",
     )
     st.session_state.tab3_content_type = content_type_pdf
 
-    if st.button("Scan PDF 🔍", key="tab3_process_button"):
-        api_key = _resolve_api_key()
-        if not api_key:
-            pass
-        elif st.session_state.tab3_uploaded_file is None:
+    if content_type_pdf in PDF_TEXT_LAYER_CONTENT_TYPES:
+        st.session_state.tab3_use_text_layer = st.toggle(
+            "⚡ Read born-digital pages from the PDF's text layer",
+            value=st.session_state.tab3_use_text_layer,
+            key="tab3_use_text_layer_toggle",
+            help="Pages with a good embedded text layer are extracted locally, without an API call. "
+                 "Scanned and image-heavy pages are still sent to the vision model.",
+        )
+
+    st.session_state.tab3_skip_repeated_pages = st.toggle(
+        "🔁 Skip blank and repeated pages",
+        value=st.session_state.tab3_skip_repeated_pages,
+        key="tab3_skip_repeated_pages_toggle",
+        help="Blank pages are not sent, and of pages that are pixel-for-pixel repeats (separator pages, repeated "
+             "slides or blank forms) only the first is sent; its result is reused for the others.",
+    )
+
+    processing_mode = st.radio(
+        "Processing Mode:",
+        (PDF_MODE_SINGLE_REQUEST, PDF_MODE_CONCURRENT),
+        key="tab3_processing_mode_radio",
+        horizontal=True,
+        help="Single Request sends all selected pages at once, or as few requests as the model's "
+             "budget allows when they don't fit in one. Concurrent Page Batches sends small groups "
+             "of pages in parallel requests and reassembles them in page order.",
+    )
+    st.session_state.tab3_processing_mode = processing_mode
+
+    if processing_mode == PDF_MODE_CONCURRENT:
+        col_batch, col_inflight = st.columns(2)
+        with col_batch:
+            st.session_state.tab3_auto_pack = st.toggle(
+                "📐 Pack pages to fit the model",
+                value=st.session_state.tab3_auto_pack,
+                key="tab3_auto_pack_toggle",
+                help="Group as many pages per request as fit the selected model's estimated image-token "
+                     "and payload budget, instead of a fixed number of pages.",
+            )
+            if not st.session_state.tab3_auto_pack:
+                st.session_state.tab3_pages_per_request = st.number_input(
+                    "Pages per request:",
+                    min_value=1,
+                    max_value=PDF_MAX_PAGES_PER_REQUEST,
+                    value=st.session_state.tab3_pages_per_request,
+                    key="tab3_pages_per_request_input",
+                )
+        with col_inflight:
+            st.session_state.tab3_max_in_flight = st.slider(
+                "Max requests in flight:",
+                min_value=1,
+                max_value=PDF_MAX_IN_FLIGHT_LIMIT,
+                value=st.session_state.tab3_max_in_flight,
+                key="tab3_max_in_flight_slider",
+            )
+
+    if PDF_RENDER_WORKERS_LIMIT > 1:
+        st.session_state.tab3_render_workers = st.slider(
+            "Render processes:",
+            min_value=0,
+            max_value=PDF_RENDER_WORKERS_LIMIT,
+            value=min(st.session_state.tab3_render_workers, PDF_RENDER_WORKERS_LIMIT),
+            key="tab3_render_workers_slider",
+            help="Render and encode pages in this many worker processes to use more CPU cores on large scanned PDFs. "
+                 "0 renders pages in the app process.",
+        )
+
+    # Show resumable progress from earlier (interrupted) scans of this PDF
+    if uploaded_pdf and processing_mode == PDF_MODE_CONCURRENT:
+        checkpoint_job_id = CheckpointStore.job_id(
+            _uploaded_pdf_digest(uploaded_pdf),
+            _selected_model_id(),
+            PDF_PROMPTS[content_type_pdf],
+            _image_preprocessing_options(),
+            st.session_state.adaptive_resolution,
+        )
+        checkpointed_chunks = get_checkpoint_store().completed_chunks(checkpoint_job_id)
+        if checkpointed_chunks:
+            checkpointed_pages = sum(len(chunk["pages"]) for chunk in checkpointed_chunks)
+            st.info(
+                f"♻️ {checkpointed_pages} of {total_pages} page(s) of this PDF are already checkpointed for the "
+                "current model and content type. Scanning resumes and only processes the missing pages."
+            )
+            col_show, col_discard = st.columns([3, 1])
+            with col_show:
+                with st.expander("Show checkpointed results"):
+                    st.markdown(merge_chunk_results(checkpointed_chunks, content_type_pdf))
+            with col_discard:
+                if st.button("Discard Checkpoint", key="tab3_discard_checkpoint_button"):
+                    get_checkpoint_store().discard_job(checkpoint_job_id)
+                    st.rerun()
+
+    if st.button("Scan PDF 🔍", key="tab3_process_button", disabled=_job_is_active("tab3_job_id")):
+        if st.session_state.tab3_uploaded_file is None:
             st.error("Please upload a PDF file first.")
         else:
             pdf_bytes = st.session_state.tab3_uploaded_file.getvalue()
-            doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-            total_pages = doc.page_count
-            doc.close()
+            pdf_digest = _uploaded_pdf_digest(st.session_state.tab3_uploaded_file)
+            total_pages = pdf_page_count(pdf_bytes, pdf_digest)
 
             # Determine which pages to process
             if st.session_state.tab3_page_mode == "All Pages":
                 page_indices = list(range(total_pages))
             else:
-                page_indices, parse_error = _parse_page_selection(
+                page_indices, parse_error = parse_page_selection(
                     st.session_state.tab3_page_selection, total_pages
                 )
                 if parse_error:
                     st.error(parse_error)
                     st.stop()
 
-            if len(page_indices) > 15:
-                st.warning(
-                    f"⚠️ You selected {len(page_indices)} pages. Processing many pages at once "
-                    "may affect response quality with free-tier models."
-                )
-
-            with st.spinner(f"Scanning {len(page_indices)} page(s)..."):
-                data_urls = _pdf_pages_to_data_urls(pdf_bytes, page_indices)
-
-                prompt_text = ""
-                if st.session_state.tab3_content_type == "General Text Extraction":
-                    prompt_text = """Analyze ALL the provided PDF page images. Extract all readable text from every page and present it in a structured Markdown format that is clear, concise, and well-organized. Ensure proper formatting (e.g., headings, lists, or code blocks) as necessary. Clearly indicate page boundaries."""
-                elif st.session_state.tab3_content_type == "LaTeX Equation Conversion":
-                    prompt_text = """Examine ALL the provided PDF page images. Extract every mathematical equation and output the corresponding LaTeX code. NEVER include any additional text or explanations. DON'T add dollar signs ($) around the LaTeX code. DO NOT extract simplified versions of the equations. NEVER add documentclass, packages or begindocument. Output only the LaTeX code."""
-                elif st.session_state.tab3_content_type == "Code Snippet Extraction":
-                    prompt_text = """Examine ALL the provided PDF page images. Extract all code from every page. Present the code in formatted code blocks suitable for direct use. Do not include any additional text or explanations."""
-                elif st.session_state.tab3_content_type == "Chart/Diagram Description":
-                    prompt_text = """Examine ALL the provided PDF page images. Describe every chart or diagram found across the pages. Explain key elements, data, and any trends or insights in a clear, concise manner. Indicate which page each chart appears on."""
-
-                content_parts: list[dict] = [{"type": "text", "text": prompt_text}]
-                for url in data_urls:
-                    content_parts.append({"type": "image_url", "image_url": {"url": url}})
-
-                messages = [{"role": "user", "content": content_parts}]
-                response_json = _make_openrouter_call(api_key, messages)
+            concurrent_mode = st.session_state.tab3_processing_mode == PDF_MODE_CONCURRENT
+            use_text_layer = (
+                st.session_state.tab3_use_text_layer
+                and st.session_state.tab3_content_type in PDF_TEXT_LAYER_CONTENT_TYPES
+            )
+            api_key, key_error = _resolve_api_key(for_job=True)
+            get_output_store().delete(st.session_state.tab3_output)
+            st.session_state.tab3_output = None
+            st.session_state.tab3_result_view = 1
+            st.session_state.tab3_page_routes = None
+            st.session_state.tab3_metrics = None
+            _submit_job(
+                "tab3_job_id",
+                "pdf_scan",
+                f"Scanning {len(page_indices)} page(s)...",
+                functools.partial(
+                    _scan_pdf_job,
+                    api_key=api_key,
+                    key_error=key_error,
+                    pdf_bytes=pdf_bytes,
+                    pdf_digest=pdf_digest,
+                    page_indices=page_indices,
+                    content_type=st.session_state.tab3_content_type,
+                    model_id=_selected_model_id(),
+                    preprocess_options=_image_preprocessing_options(),
+                    concurrent=concurrent_mode,
+                    pages_per_request=None if st.session_state.tab3_auto_pack else st.session_state.tab3_pages_per_request,
+                    max_in_flight=st.session_state.tab3_max_in_flight,
+                    render_workers=st.session_state.tab3_render_workers,
+                    use_text_layer=use_text_layer,
+                    skip_repeated_pages=st.session_state.tab3_skip_repeated_pages,
+                    adaptive_resolution=st.session_state.adaptive_resolution,
+                    use_cache=st.session_state.use_result_cache,
+                    stream=st.session_state.stream_responses,
+                ),
+                api_key=api_key,
+            )
 
-                if response_json:
-                    st.session_state.tab3_result = response_json['choices'][0]['message']['content']
-                else:
-                    st.session_state.tab3_result = "Error: Could not get a response from the model."
+    _poll_job("tab3_job_id", _collect_pdf_scan_job)
+    if st.session_state.tab3_notes:
+        _show_job_notes(st.session_state.tab3_notes)
+        st.session_state.tab3_notes = None
 
-    if st.session_state.tab3_result:
-        st.markdown("### Result:")
-        if st.session_state.tab3_content_type == "LaTeX Equation Conversion":
-            st.code(st.session_state.tab3_result, language='latex')
-            st.markdown("#### Rendered LaTeX:")
-            cleaned_latex = st.session_state.tab3_result.replace(r"\[", "").replace(r"\]", "")
-            st.latex(cleaned_latex)
-        elif st.session_state.tab3_content_type == "Code Snippet Extraction":
-            st.code(st.session_state.tab3_result, language='python')
+    if st.session_state.tab3_output:
+        result_file = get_output_store().open(st.session_state.tab3_output)
+        if result_file is None:
+            st.info("This result has expired from the server. Scan the PDF again to see it.")
+            st.session_state.tab3_output = None
         else:
-            st.markdown(st.session_state.tab3_result)
+            if st.session_state.tab3_page_routes:
+                _show_page_routes(st.session_state.tab3_page_routes)
+            if st.session_state.tab3_metrics:
+                _show_diagnostics(st.session_state.tab3_metrics)
+            _show_result_file(result_file)
 
+st.subheader("Select an Optical Character Recognition (OCR) Functionality:")
+tab1, tab2, tab3 = st.tabs(["📈 Extract & Convert", "🎯 Ask, Analyze & Chat", "📑 PDF Scan & Extract"])
+with tab1:
+    _extract_and_convert_tab()
+with tab2:
+    _ask_analyze_chat_tab()
+with tab3:
+    _pdf_scan_tab()
@@ -0,0 +1,317 @@
+"""
+Headless batch OCR over images and PDFs, using the same engine as the Streamlit app.
+
+Examples:
+    python ocr_cli.py scans/ --content-type text --output results.jsonl
+    python ocr_cli.py "invoices/**/*.pdf" --pages "1-2" --workers 8 --format markdown -o invoices.md
+    python ocr_cli.py invoices/ --fields invoice_fields.txt --output invoices.jsonl
+
+The API key is read from --api-key or the OPENROUTER_API_KEY environment variable.
+"""
+import argparse
+import glob
+import json
+import mimetypes
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+from ocr_engine import (
+    AUTO_MODEL_ID,
+    AUTO_MODEL_NAME,
+    AVAILABLE_MODELS,
+    PDF_DEFAULT_MAX_IN_FLIGHT,
+    PDF_DEFAULT_PAGES_PER_REQUEST,
+    PDF_RENDER_WORKERS,
+    StageMetrics,
+    default_preprocess_options,
+    extract_structured_document,
+    get_metrics_registry,
+    get_checkpoint_store,
+    get_result_cache,
+    merge_chunk_results,
+    ocr_image,
+    ocr_pdf,
+    parse_field_schema,
+    parse_page_selection,
+    pdf_page_count,
+)
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
+PDF_EXTENSIONS = (".pdf",)
+
+# Short names for the app's content types
+CONTENT_TYPE_ALIASES = {
+    "text": "General Text Extraction",
+    "latex": "LaTeX Equation Conversion",
+    "code": "Code Snippet Extraction",
+    "chart": "Chart/Diagram Description",
+}
+
+
+def _is_supported(path):
+    return path.lower().endswith(IMAGE_EXTENSIONS + PDF_EXTENSIONS)
+
+
+def pages_per_request_arg(value):
+    """argparse type for --pages-per-request: a positive page count, or "auto" (None) to pack by model budget."""
+    if value == "auto":
+        return None
+    try:
+        pages = int(value)
+    except ValueError:
+        pages = 0
+    if pages < 1:
+        raise argparse.ArgumentTypeError(f"expected a positive number of pages or 'auto', got {value!r}")
+    return pages
+
+
+def collect_input_files(inputs):
+    """
+    Expand files, directories (searched recursively) and glob patterns into a
+    sorted, de-duplicated list of supported image and PDF paths.
+    """
+    found = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, _, files in os.walk(item):
+                found.update(os.path.join(root, name) for name in files if _is_supported(name))
+        elif os.path.isfile(item):
+            if _is_supported(item):
+                found.add(item)
+        else:
+            found.update(path for path in glob.glob(item, recursive=True) if os.path.isfile(path) and _is_supported(path))
+    return sorted(found)
+
+
+def resolve_model_id(model):
+    """
+    Accept a display name from AVAILABLE_MODELS, a raw OpenRouter model ID, or
+    "auto" / "auto:hedged" for the model router.
+    """
+    if model == AUTO_MODEL_NAME:
+        return AUTO_MODEL_ID
+    return AVAILABLE_MODELS.get(model, model)
+
+
+def process_structured_file(path, args, api_key, model_id, fields, cache):
+    """
+    Extract the --fields of one image or PDF as JSON. Errors are returned in
+    the record instead of raised, like `process_file`.
+
+    Returns:
+        dict: JSONL record for the file.
+    """
+    preprocess_options = default_preprocess_options(
+        model_id, enabled=not args.no_preprocess, grayscale=args.grayscale, autocrop=not args.no_autocrop
+    )
+    record = {"file": path, "kind": "structured", "model": model_id, "values": None, "problems": {}}
+    metrics = StageMetrics("cli_structured")
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        page_indices = None
+        if path.lower().endswith(PDF_EXTENSIONS):
+            mime_type = "application/pdf"
+            if args.pages:
+                page_indices, parse_error = parse_page_selection(args.pages, pdf_page_count(data))
+                if parse_error:
+                    return {**record, "error": parse_error}
+        else:
+            mime_type = mimetypes.guess_type(path)[0] or "image/png"
+        result = extract_structured_document(
+            api_key, model_id, data, mime_type, fields, args.instructions, preprocess_options, cache, metrics,
+            page_indices,
+        )
+        return {**record, **result, "error": None}
+    except (OSError, ValueError, RuntimeError, requests.exceptions.RequestException) as e:
+        return {**record, "error": f"{type(e).__name__}: {e}"}
+    finally:
+        metrics.finish()
+
+
+def process_file(path, args, api_key, model_id, cache, checkpoints):
+    """
+    OCR one image or PDF. Errors are returned in the record instead of raised,
+    so one bad file does not stop the batch.
+
+    Returns:
+        dict: JSONL record for the file.
+    """
+    content_type = CONTENT_TYPE_ALIASES[args.content_type]
+    preprocess_options = default_preprocess_options(
+        model_id, enabled=not args.no_preprocess, grayscale=args.grayscale, autocrop=not args.no_autocrop
+    )
+    record = {"file": path, "content_type": content_type, "model": model_id}
+    is_pdf = path.lower().endswith(PDF_EXTENSIONS)
+    metrics = StageMetrics("cli_pdf" if is_pdf else "cli_image")
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        if is_pdf:
+            total_pages = pdf_page_count(data)
+            if args.pages:
+                page_indices, parse_error = parse_page_selection(args.pages, total_pages)
+                if parse_error:
+                    return {**record, "kind": "pdf", "content": None, "error": parse_error}
+            else:
+                page_indices = list(range(total_pages))
+            chunks = ocr_pdf(
+                lambda: api_key,
+                model_id,
+                data,
+                content_type,
+                page_indices,
+                pages_per_request=args.pages_per_request,
+                max_in_flight=args.max_in_flight,
+                preprocess_options=preprocess_options,
+                cache=cache,
+                checkpoints=checkpoints,
+                text_layer=not args.no_text_layer,
+                skip_repeated_pages=args.skip_repeated_pages,
+                adaptive_resolution=args.adaptive_resolution,
+                metrics=metrics,
+                render_workers=args.render_workers,
+            )
+            failed = [chunk for chunk in chunks if chunk["error"] is not None]
+            return {
+                **record,
+                "kind": "pdf",
+                "pages": [idx + 1 for idx in page_indices],
+                "content": merge_chunk_results(chunks, content_type),
+                "chunks": [
+                    {"pages": c["pages"], "method": c["method"], "content": c["content"], "error": c["error"]}
+                    for c in chunks
+                ],
+                "error": f"{len(failed)} of {len(chunks)} batch(es) failed" if failed else None,
+            }
+        mime_type = mimetypes.guess_type(path)[0] or "image/png"
+        result = ocr_image(
+            api_key, model_id, data, mime_type, content_type, preprocess_options, cache, metrics,
+            adaptive_resolution=args.adaptive_resolution,
+        )
+        return {**record, "kind": "image", "content": result["content"], "cached": result["cached"], "error": None}
+    except (OSError, ValueError, KeyError, IndexError, requests.exceptions.RequestException) as e:
+        return {**record, "content": None, "error": f"{type(e).__name__}: {e}"}
+    finally:
+        metrics.finish()
+
+
+def format_record(record, output_format):
+    """Render one result record as a JSONL line or a Markdown section."""
+    if output_format == "jsonl":
+        return json.dumps(record, ensure_ascii=False) + "\n"
+    if record.get("kind") == "structured" and not record["error"]:
+        body = f"```json\n{json.dumps(record['values'], indent=2, ensure_ascii=False)}\n```"
+        body += "".join(f"\n\n- `{name}`: {problem}" for name, problem in record["problems"].items())
+    else:
+        body = record.get("content") or f"Error: {record['error']}"
+    return f"# {record['file']}\n\n{body.strip()}\n\n"
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Batch OCR images and PDFs through OpenRouter vision models.")
+    parser.add_argument("inputs", nargs="+", help="Image/PDF files, directories, or glob patterns.")
+    parser.add_argument("-t", "--content-type", choices=sorted(CONTENT_TYPE_ALIASES), default="text",
+                        help="What to extract (default: text).")
+    parser.add_argument("-m", "--model", default=list(AVAILABLE_MODELS)[0],
+                        help="Model display name, OpenRouter model ID, or 'auto' / 'auto:hedged' to route "
+                             "across the free models (default: %(default)s).")
+    parser.add_argument("-o", "--output", help="Output file (default: stdout).")
+    parser.add_argument("-f", "--format", choices=("jsonl", "markdown"), default="jsonl", help="Output format (default: jsonl).")
+    parser.add_argument("-w", "--workers", type=int, default=4, help="Files processed in parallel (default: 4).")
+    parser.add_argument("--pages", help="PDF page selection such as '1-5, 8' (default: all pages).")
+    parser.add_argument("--pages-per-request", type=pages_per_request_arg, default=PDF_DEFAULT_PAGES_PER_REQUEST,
+                        help="PDF pages sent per request, or 'auto' to pack as many pages as fit the model's "
+                             "image-token and payload budget (default: %(default)s).")
+    parser.add_argument("--max-in-flight", type=int, default=PDF_DEFAULT_MAX_IN_FLIGHT,
+                        help="Concurrent requests per PDF (default: %(default)s).")
+    parser.add_argument("--render-workers", type=int, default=PDF_RENDER_WORKERS,
+                        help="Processes that render and encode PDF pages, shared by all files; 0 renders in the "
+                             "CLI process (default: %(default)s, or $OCR_RENDER_WORKERS).")
+    parser.add_argument("--api-key", default=os.environ.get("OPENROUTER_API_KEY"),
+                        help="OpenRouter API key (default: $OPENROUTER_API_KEY).")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the result cache.")
+    parser.add_argument("--no-checkpoints", action="store_true",
+                        help="Do not resume PDFs from earlier interrupted runs or checkpoint new progress.")
+    parser.add_argument("--no-text-layer", action="store_true",
+                        help="Send every PDF page to the model, even pages with an embedded text layer.")
+    parser.add_argument("--skip-repeated-pages", action="store_true",
+                        help="Do not send blank PDF pages, and send pages that repeat an earlier page "
+                             "pixel for pixel only once, reusing the first page's result.")
+    parser.add_argument("--adaptive-resolution", action="store_true",
+                        help="Size images and PDF pages by their text: send large print at a lower resolution, and "
+                             "split print too small to read at the model's max side into strips that are OCR'd in "
+                             "parallel and stitched.")
+    parser.add_argument("--fields", metavar="PATH",
+                        help="Extract these fields as validated JSON instead of transcribing: a file with one "
+                             "'name: type' per line (types: string, number, integer, boolean, date, list; 'name?' "
+                             "for optional fields, '# description' to guide the model) or a JSON Schema. Missing "
+                             "or invalid fields are asked for again on their own.")
+    parser.add_argument("--instructions", default="",
+                        help="Extra instructions for --fields extraction, such as 'Amounts are in EUR'.")
+    parser.add_argument("--metrics", metavar="PATH",
+                        help="Write per-stage timing histograms and token counts for the batch in "
+                             "Prometheus text format. Set OCR_METRICS_LOG to also log every file as a JSON line.")
+    parser.add_argument("--no-preprocess", action="store_true", help="Send images without preprocessing.")
+    parser.add_argument("--no-autocrop", action="store_true", help="Do not auto-crop blank margins.")
+    parser.add_argument("--grayscale", action="store_true", help="Convert images to grayscale before upload.")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if not args.api_key:
+        print("error: no API key; pass --api-key or set OPENROUTER_API_KEY", file=sys.stderr)
+        return 2
+    paths = collect_input_files(args.inputs)
+    if not paths:
+        print("error: no supported image or PDF files found", file=sys.stderr)
+        return 2
+
+    fields = None
+    if args.fields:
+        try:
+            with open(args.fields, encoding="utf-8") as f:
+                fields, schema_error = parse_field_schema(f.read())
+        except OSError as e:
+            schema_error = str(e)
+        if schema_error:
+            print(f"error: --fields: {schema_error}", file=sys.stderr)
+            return 2
+
+    model_id = resolve_model_id(args.model)
+    cache = None if args.no_cache else get_result_cache()
+    checkpoints = None if args.no_checkpoints else get_checkpoint_store()
+    output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    failures = 0
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+            if fields:
+                futures = {
+                    executor.submit(process_structured_file, path, args, args.api_key, model_id, fields, cache): path
+                    for path in paths
+                }
+            else:
+                futures = {executor.submit(process_file, path, args, args.api_key, model_id, cache, checkpoints): path for path in paths}
+            for done, future in enumerate(as_completed(futures), start=1):
+                record = future.result()
+                failed = record["error"] is not None or bool(record.get("problems"))
+                failures += failed
+                output.write(format_record(record, args.format))
+                output.flush()
+                status = "failed" if failed else "ok"
+                print(f"[{done}/{len(paths)}] {status}: {record['file']}", file=sys.stderr)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    if args.metrics:
+        with open(args.metrics, "w", encoding="utf-8") as f:
+            f.write(get_metrics_registry().prometheus_text())
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
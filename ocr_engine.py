@@ -0,0 +1,3785 @@
+"""
+OCR engine shared by the Streamlit app (ocr_app.py) and the batch CLI (ocr_cli.py).
+
+Everything here is free of Streamlit: functions raise or return errors instead
+of rendering them, so they can run in worker threads and headless jobs.
+"""
+import base64
+import collections
+import contextlib
+import csv
+import datetime
+import difflib
+import hashlib
+import importlib
+import io
+import json
+import multiprocessing
+import os
+import queue
+import random
+import re
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class _LazyModule:
+    """
+    Stand-in for a module that is imported on first attribute access. PyMuPDF
+    and Pillow make up about half of this module's import time, and sessions
+    that never touch a PDF or an image should not pay for them.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)  # the import lock makes this thread-safe
+        return getattr(self._module, attribute)
+
+fitz = _LazyModule("fitz")  # PyMuPDF
+Image = _LazyModule("PIL.Image")
+ImageChops = _LazyModule("PIL.ImageChops")
+ImageOps = _LazyModule("PIL.ImageOps")
+ImageStat = _LazyModule("PIL.ImageStat")
+
+# OpenRouter API Endpoint (override to point at a proxy or the benchmark mock server)
+OPENROUTER_API_URL = os.environ.get("OPENROUTER_API_URL", "https://openrouter.ai/api/v1/chat/completions")
+
+# Available free vision models on OpenRouter
+AVAILABLE_MODELS = {
+    "NVIDIA: Nemotron Nano 12B 2 VL": "nvidia/nemotron-nano-12b-v2-vl:free",
+    "Google: Gemma 3 27B": "google/gemma-3-27b-it:free",
+    "Mistral: Mistral Small 3.1 24B": "mistralai/mistral-small-3.1-24b-instruct:free",
+}
+
+# "Auto" routes each request across AVAILABLE_MODELS; the hedged variant also races
+# a second model when the first is slower than its own p95 latency
+AUTO_MODEL_NAME = "Auto: Fastest Healthy Model"
+AUTO_MODEL_ID = "auto"
+AUTO_HEDGED_MODEL_ID = "auto:hedged"
+
+# Model router health tracking
+ROUTER_WINDOW_SIZE = 50  # most recent requests per model used for latency percentiles and error rate
+ROUTER_SAMPLE_MAX_AGE_SECONDS = 600  # older samples are forgotten, so recovered models get retried
+ROUTER_ERROR_PENALTY = 4.0  # score = p50 latency * (1 + penalty * error rate)
+ROUTER_RATE_LIMIT_COOLDOWN_SECONDS = 30.0  # used when a 429 has no Retry-After header
+ROUTER_HEDGE_MIN_SAMPLES = 5  # p95 is not trusted for hedging with fewer samples
+ROUTER_ATTEMPTS_PER_MODEL = 1  # failing over to the next model replaces same-model retries
+
+# HTTP client settings for OpenRouter calls
+HTTP_CONNECT_TIMEOUT_SECONDS = 10
+HTTP_READ_TIMEOUT_SECONDS = 180
+HTTP_POOL_MAXSIZE = 16
+HTTP_MAX_ATTEMPTS = 4
+HTTP_BACKOFF_BASE_SECONDS = 1.0
+HTTP_BACKOFF_MAX_SECONDS = 30.0
+HTTP_RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+# Longest image side (pixels) worth sending to each model; larger images are downscaled
+MODEL_MAX_IMAGE_SIDE = {
+    "nvidia/nemotron-nano-12b-v2-vl:free": 2048,
+    "google/gemma-3-27b-it:free": 1792,
+    "mistralai/mistral-small-3.1-24b-instruct:free": 1540,
+}
+# Auto requests may land on any model, so they use the smallest limit
+MODEL_MAX_IMAGE_SIDE[AUTO_MODEL_ID] = MODEL_MAX_IMAGE_SIDE[AUTO_HEDGED_MODEL_ID] = min(MODEL_MAX_IMAGE_SIDE.values())
+DEFAULT_MAX_IMAGE_SIDE = 2048
+
+# Image preprocessing before upload
+IMAGE_PHOTO_JPEG_QUALITIES = (85, 75, 65)  # tried in order until the photo fits the target size
+IMAGE_PHOTO_TARGET_BYTES = 1_500_000
+IMAGE_AUTOCROP_THRESHOLD = 24  # per-channel difference from the background that counts as content
+IMAGE_AUTOCROP_PADDING = 16
+IMAGE_LINE_ART_BACKGROUND_RATIO = 0.6  # share of near-background pixels that marks text/line art
+IMAGE_LINE_ART_GRAY_LEVELS = 16
+
+# Multi-image batches (Tab 1 and the CLI share the content-type prompts)
+IMAGE_BATCH_DEFAULT_MAX_IN_FLIGHT = 4
+IMAGE_BATCH_FILE_EXTENSIONS = {  # file extension of each result in the ZIP export (default .md)
+    "LaTeX Equation Conversion": ".tex",
+}
+IMAGE_BATCH_FENCE_LANGUAGES = {  # fence language for bare replies in the Markdown export
+    "LaTeX Equation Conversion": "latex",
+    "Code Snippet Extraction": "python",
+}
+CODE_FENCE_EXTENSIONS = {  # a code reply fenced as one of these is saved unfenced under its extension
+    "python": ".py", "py": ".py", "javascript": ".js", "js": ".js", "typescript": ".ts", "ts": ".ts",
+    "java": ".java", "c": ".c", "cpp": ".cpp", "c++": ".cpp", "csharp": ".cs", "cs": ".cs", "go": ".go",
+    "rust": ".rs", "ruby": ".rb", "php": ".php", "swift": ".swift", "kotlin": ".kt", "sql": ".sql",
+    "bash": ".sh", "sh": ".sh", "shell": ".sh", "html": ".html", "css": ".css", "json": ".json",
+    "yaml": ".yaml", "r": ".r", "latex": ".tex", "tex": ".tex",
+}
+
+# PDF batch defaults
+PDF_DEFAULT_PAGES_PER_REQUEST = 1
+PDF_DEFAULT_MAX_IN_FLIGHT = 4
+# Automatic packing (pages_per_request=None): pages are grouped in order until the next
+# page would push a request past its model's estimated image-token or payload budget.
+# Budgets stay well below the context windows, so every request leaves room for the
+# reply and takes about as long as the others.
+PDF_PACK_MAX_PAGES = 10
+PDF_PACK_BYTES_PER_PIXEL = 0.25  # data URL bytes per pixel of a preprocessed page (palette PNG of text, base64)
+PDF_PACK_RAW_BYTES_PER_PIXEL = 1.0  # same for pages sent as unprocessed PNG
+MODEL_IMAGE_TOKEN_COST = {  # (tile side in px, tokens per tile, max tiles per image or None)
+    "nvidia/nemotron-nano-12b-v2-vl:free": (512, 256, 12),
+    "google/gemma-3-27b-it:free": (896, 256, 1),  # every image is resized to one 896px tile
+    "mistralai/mistral-small-3.1-24b-instruct:free": (28, 1, None),  # 14px patches, merged 2x2
+}
+DEFAULT_IMAGE_TOKEN_COST = (28, 1, None)
+MODEL_REQUEST_BUDGETS = {  # per request: estimated image tokens, data URL bytes
+    "nvidia/nemotron-nano-12b-v2-vl:free": {"image_tokens": 16000, "payload_bytes": 8 * 1024 * 1024},
+    "google/gemma-3-27b-it:free": {"image_tokens": 4096, "payload_bytes": 8 * 1024 * 1024},
+    "mistralai/mistral-small-3.1-24b-instruct:free": {"image_tokens": 16000, "payload_bytes": 8 * 1024 * 1024},
+}
+DEFAULT_REQUEST_BUDGET = {"image_tokens": 16000, "payload_bytes": 6 * 1024 * 1024}
+# Number of rendered page chunks buffered ahead of the request stage
+PDF_RENDER_PREFETCH_CHUNKS = 2
+PDF_RENDER_DPI = 150
+# Worker processes that render and encode pages (0 renders in the calling process)
+PDF_RENDER_WORKERS = int(os.environ.get("OCR_RENDER_WORKERS", "0"))
+PDF_RENDER_WORKER_MAX_DOCUMENTS = 2  # documents each render worker keeps open
+# How often live previews of streamed page batches are refreshed
+PDF_STREAM_PREVIEW_INTERVAL_SECONDS = 0.5
+
+# Repeated and blank pages (opt-in): blank pages are skipped, and of near-identical pages
+# only the first is sent, with its result reused. Candidates are found with a difference
+# hash of a small grayscale render and confirmed pixel by pixel at a resolution where a
+# changed word or digit shows up, so filled-in copies of the same form stay separate.
+PDF_FINGERPRINT_SIDE = 256  # long side (px) of the grayscale render used for hashing and blank detection
+PDF_DHASH_SIZE = 16  # 16x16 difference hash = 256 bits
+PDF_DUPLICATE_MAX_HASH_DISTANCE = 24  # differing hash bits that still make a near-duplicate candidate
+PDF_DUPLICATE_CONFIRM_SIDE = 1024  # long side (px) of the renders compared to confirm a candidate
+PDF_DUPLICATE_PIXEL_DIFF = 64  # gray-level difference that counts as a mismatch (compression noise stays below)
+PDF_DUPLICATE_MAX_MISMATCHED_PIXELS = 16  # one changed digit at 11pt mismatches about 150 pixels
+PDF_BLANK_INK_LEVEL = 48  # gray levels away from the page background that count as ink
+PDF_BLANK_MAX_INK_RATIO = 0.0002  # pages with less ink than this share of pixels are blank
+
+# Adaptive resolution (opt-in): pages and images are sized by their text instead of a fixed
+# DPI. The typical line height is measured from the ink profile of a small grayscale render;
+# large print is sent at a lower resolution, and print too small to read at the model's max
+# side is split into overlapping full-width strips (so reading order is kept) that are OCR'd
+# concurrently and stitched back together.
+RESOLUTION_PROBE_DPI = 100  # grayscale render of PDF pages used to measure their text lines
+RESOLUTION_IMAGE_PROBE_SIDE = 1600  # long side (px) images are reduced to for the same measurement
+RESOLUTION_ROW_MIN_INK_RATIO = 0.004  # share of ink pixels that makes a pixel row part of a text line
+RESOLUTION_MIN_LINES = 3  # fewer measured text lines than this keeps the default resolution
+RESOLUTION_TARGET_LINE_PX = 22  # line height (px) the models read reliably
+RESOLUTION_MIN_LINE_PX = 14  # below this at the model's max side, a page or image is split into strips
+PDF_ADAPTIVE_MIN_DPI = 72
+PDF_ADAPTIVE_MAX_DPI = 300
+RESOLUTION_IMAGE_MIN_SIDE = 768  # images are never reduced below this long side
+RESOLUTION_TILE_CONTENT_TYPES = ("General Text Extraction", "Code Snippet Extraction")  # charts and equations stay whole
+RESOLUTION_TILE_OVERLAP_LINES = 2  # text lines each strip shares with the next
+RESOLUTION_MAX_TILES = 6
+RESOLUTION_TILE_MAX_IN_FLIGHT = 4  # strip requests of one page or image running at the same time
+RESOLUTION_STITCH_MAX_LINES = 12  # longest overlap (in lines) looked for when stitching strips
+RESOLUTION_STITCH_MIN_SIMILARITY = 0.85  # lines this similar count as the same line read twice
+RESOLUTION_STRIP_PROMPT = (
+    "This image is horizontal strip {position} of {count} of one page, top to bottom. Transcribe only what is "
+    "visible in this strip. Do not add page labels, and do not add any introduction or closing remarks."
+)
+
+# Born-digital pages are read from the PDF's own text layer instead of being sent to the model
+PDF_TEXT_LAYER_CONTENT_TYPES = ("General Text Extraction",)
+PDF_TEXT_LAYER_MIN_CHARS = 80  # fewer non-whitespace characters than this means a scan or a figure
+PDF_TEXT_LAYER_MIN_READABLE_RATIO = 0.95  # share of characters that are not U+FFFD or control characters
+PDF_TEXT_LAYER_MAX_IMAGE_COVERAGE = 0.35  # share of the page covered by images
+PDF_TEXT_LAYER_OCR_FONTS = ("GlyphLessFont",)  # invisible text layers added by OCR tools
+PDF_TEXT_LAYER_HEADING_SCALE = 1.25  # font size relative to body text that marks a heading
+
+# Persistent OCR result cache (results only, never the uploaded images)
+RESULT_CACHE_DIR = os.environ.get("OCR_CACHE_DIR", ".ocr_cache")
+RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+RESULT_CACHE_TTL_SECONDS = 7 * 24 * 3600
+
+# In-memory cache of parsed PDFs and rendered pages, shared by all sessions
+PDF_DOCUMENT_CACHE_MAX_DOCUMENTS = 4
+PDF_PAGE_CACHE_MAX_BYTES = 128 * 1024 * 1024
+
+# Per-page checkpoints that let long PDF jobs resume after a crash or rerun
+CHECKPOINT_DIR = os.environ.get("OCR_JOBS_DIR", ".ocr_jobs")
+CHECKPOINT_TTL_SECONDS = 7 * 24 * 3600
+
+# Per-job output files: scan results are appended page by page as they arrive, so a
+# session only keeps a handle, and results are read back and exported in page order
+OUTPUT_DIR = os.environ.get("OCR_OUTPUT_DIR", ".ocr_outputs")
+OUTPUT_TTL_SECONDS = 24 * 3600
+OUTPUT_FORMATS = {  # export format -> (file extension, MIME type)
+    "markdown": (".md", "text/markdown"),
+    "jsonl": (".jsonl", "application/jsonl"),
+    "text": (".txt", "text/plain"),
+}
+
+# Background jobs that keep running across Streamlit reruns
+JOB_WORKERS = int(os.environ.get("OCR_JOB_WORKERS", "4"))
+JOB_RETENTION_SECONDS = 3600  # finished jobs are forgotten after this long
+
+# Chat history sent with each follow-up question, in estimated text tokens.
+# Older turns beyond the budget are condensed into a short recap.
+CHAT_CONTEXT_MAX_TOKENS = 4000
+CHAT_SUMMARY_MAX_TOKENS = 400
+CHAT_SUMMARY_SNIPPET_CHARS = 160
+CHARS_PER_TOKEN = 4  # rough average for English text; good enough for budgeting
+
+# Structured extraction (Tab 2's Document Intelligence scope and `ocr_cli.py --fields`):
+# fields are requested as one JSON object, validated locally, and only the missing or
+# invalid fields are asked for again
+STRUCTURED_FIELD_TYPES = ("string", "number", "integer", "boolean", "date", "list")
+STRUCTURED_MAX_REPAIR_ROUNDS = 2  # follow-up requests for fields that are still missing or invalid
+STRUCTURED_PROMPT = (
+    "Extract the following fields from the provided document image(s) and reply with one JSON object and "
+    "nothing else, using exactly these keys:\n{field_lines}\n"
+    "Use null for a field that does not appear in the document. Write dates as YYYY-MM-DD, numbers without "
+    "currency symbols or thousands separators, and lists as JSON arrays of strings.{instructions}"
+)
+STRUCTURED_REPAIR_PROMPT = (
+    "An earlier extraction from this document got these fields wrong:\n{problem_lines}\n"
+    "Reply with one JSON object and nothing else, containing only these keys:\n{field_lines}\n"
+    "Use null for a field that does not appear in the document. Write dates as YYYY-MM-DD and numbers without "
+    "currency symbols or thousands separators."
+)
+
+# Per-stage timing metrics. When OCR_METRICS_LOG is set, every instrumented run
+# appends one JSON line with its stage timings and token usage to that file.
+METRICS_LOG_PATH = os.environ.get("OCR_METRICS_LOG")
+METRICS_HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRICS_STAGES = (
+    "fitz_open", "text_layer", "get_pixmap", "tobytes_png", "preprocess", "b64encode",
+    "http_post", "json_decode", "time_to_first_token", "stream_read", "coalesce_wait", "fingerprint",
+    "text_density", "stitch",
+)
+
+# Content types offered for images and PDFs, with their prompts
+CONTENT_TYPES = (
+    "General Text Extraction",
+    "LaTeX Equation Conversion",
+    "Code Snippet Extraction",
+    "Chart/Diagram Description",
+)
+
+IMAGE_PROMPTS = {
+    "General Text Extraction": """Analyze the text in the provided image. Extract all readable content and present it in a structured Markdown format that is clear, concise, and well-organized. Ensure proper formatting (e.g., headings, lists, or code blocks) as necessary to represent the content effectively.""",
+    "LaTeX Equation Conversion": """Understand the mathematical equation in the provided image and output the corresponding LaTeX code. NEVER include any additional text or explanations. DON'T add dollar signs ($) around the LaTeX code. DO NOT extract simplified versions of the equations. NEVER add documentclass, packages or begindocument. DO NOT explain the symbols used in the equation. Output only the LaTeX code corresponding to the mathematical equations in the image.""",
+    "Code Snippet Extraction": """Extract all code from the provided image. Present the code in a formatted code block suitable for direct use. Do not include any additional text or explanations.""",
+    "Chart/Diagram Description": """Describe the chart or diagram in the provided image. Explain its key elements, data, and any trends or insights it presents in a clear, concise manner.""",
+}
+
+PDF_PROMPTS = {
+    "General Text Extraction": """Analyze ALL the provided PDF page images. Extract all readable text from every page and present it in a structured Markdown format that is clear, concise, and well-organized. Ensure proper formatting (e.g., headings, lists, or code blocks) as necessary. Clearly indicate page boundaries.""",
+    "LaTeX Equation Conversion": """Examine ALL the provided PDF page images. Extract every mathematical equation and output the corresponding LaTeX code. NEVER include any additional text or explanations. DON'T add dollar signs ($) around the LaTeX code. DO NOT extract simplified versions of the equations. NEVER add documentclass, packages or begindocument. Output only the LaTeX code.""",
+    "Code Snippet Extraction": """Examine ALL the provided PDF page images. Extract all code from every page. Present the code in formatted code blocks suitable for direct use. Do not include any additional text or explanations.""",
+    "Chart/Diagram Description": """Examine ALL the provided PDF page images. Describe every chart or diagram found across the pages. Explain key elements, data, and any trends or insights in a clear, concise manner. Indicate which page each chart appears on.""",
+}
+
+# PyMuPDF is not thread-safe; every fitz call in this module holds this lock
+_FITZ_LOCK = threading.RLock()
+
+# Lazily created process-wide singletons
+_singleton_lock = threading.Lock()
+_http_session = None
+_result_cache = None
+_checkpoint_store = None
+_model_router = None
+_metrics_registry = None
+_pdf_document_cache = None
+_single_flight = None
+_render_pool = None  # (worker count, ProcessPoolExecutor)
+_rate_limiters = {}  # name -> FairRateLimiter
+_job_manager = None
+_output_store = None
+_models_without_response_format = set()  # models whose HTTP 400 named the JSON schema response_format
+_worker_documents = collections.OrderedDict()  # in render worker processes: path -> open fitz.Document
+
+class ResultCache:
+    """
+    SQLite-backed cache of model outputs keyed by content hash, model and prompt.
+    Entries expire after `ttl_seconds`; once the stored text exceeds `max_bytes`,
+    the least recently used entries are evicted. Safe to share across threads.
+    """
+
+    def __init__(self, directory, max_bytes, ttl_seconds):
+        os.makedirs(directory, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(directory, "results.sqlite3"), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, content TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS results_accessed_at ON results (accessed_at)")
+        self._conn.commit()
+
+    def get(self, key):
+        """Return the cached content for `key`, or None on a miss or expired entry."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT content, created_at FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None or row[1] + self.ttl_seconds < now:
+                if row is not None:
+                    self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                    self._conn.commit()
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE results SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, content):
+        """Store `content` under `key`, then evict expired and least recently used entries."""
+        now = time.time()
+        size = len(content.encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results (key, content, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, content, size, now, now),
+            )
+            self._conn.execute("DELETE FROM results WHERE created_at < ?", (now - self.ttl_seconds,))
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+            if total > self.max_bytes:
+                for old_key, old_size in self._conn.execute(
+                    "SELECT key, size FROM results ORDER BY accessed_at ASC"
+                ).fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    self._conn.execute("DELETE FROM results WHERE key = ?", (old_key,))
+                    total -= old_size
+            self._conn.commit()
+
+    def clear(self):
+        """Remove every entry and reset the hit/miss counters."""
+        with self._lock:
+            self._conn.execute("DELETE FROM results")
+            self._conn.commit()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Return a dict with entry count, stored bytes, hits and misses."""
+        with self._lock:
+            entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        return {"entries": entries, "bytes": size, "hits": self.hits, "misses": self.misses}
+
+def get_result_cache():
+    """Process-wide result cache shared by all sessions and batch runs."""
+    global _result_cache
+    with _singleton_lock:
+        if _result_cache is None:
+            _result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL_SECONDS)
+        return _result_cache
+
+class CheckpointStore:
+    """
+    SQLite record of completed page batches for PDF jobs. A job is identified by
+    the PDF hash, model, prompt and preprocessing settings (see `job_id`), and
+    each successful batch is stored under its page numbers as soon as it
+    finishes, so an interrupted job only has to redo the missing pages.
+    """
+
+    def __init__(self, directory, ttl_seconds):
+        os.makedirs(directory, exist_ok=True)
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(directory, "checkpoints.sqlite3"), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id TEXT PRIMARY KEY, pdf_sha256 TEXT NOT NULL, model_id TEXT NOT NULL, "
+            "content_type TEXT NOT NULL, status TEXT NOT NULL, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS job_pages ("
+            "job_id TEXT NOT NULL, first_page INTEGER NOT NULL, pages TEXT NOT NULL, content TEXT NOT NULL, "
+            "completed_at REAL NOT NULL, PRIMARY KEY (job_id, first_page))"
+        )
+        self._purge_expired()
+
+    @staticmethod
+    def job_id(pdf_digest, model_id, prompt_text, preprocess_options=None, adaptive_resolution=False):
+        """Identify a job by everything that affects its output."""
+        parts = [pdf_digest, model_id, prompt_text, preprocess_signature(preprocess_options)]
+        if adaptive_resolution:
+            parts.append("adaptive")
+        material = json.dumps(parts)
+        return sha256_hex(material.encode("utf-8"))
+
+    def _purge_expired(self):
+        cutoff = time.time() - self.ttl_seconds
+        with self._lock:
+            self._conn.execute("DELETE FROM job_pages WHERE job_id IN (SELECT job_id FROM jobs WHERE updated_at < ?)", (cutoff,))
+            self._conn.execute("DELETE FROM jobs WHERE updated_at < ?", (cutoff,))
+            self._conn.commit()
+
+    def start_job(self, job_id, pdf_digest, model_id, content_type):
+        """Create the job record, or mark an existing one as running again."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (job_id, pdf_sha256, model_id, content_type, status, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, 'running', ?, ?) "
+                "ON CONFLICT(job_id) DO UPDATE SET status = 'running', updated_at = excluded.updated_at",
+                (job_id, pdf_digest, model_id, content_type, now, now),
+            )
+            self._conn.commit()
+
+    def finish_job(self, job_id, status):
+        """Set the final job status ('complete' or 'incomplete')."""
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET status = ?, updated_at = ? WHERE job_id = ?", (status, time.time(), job_id))
+            self._conn.commit()
+
+    def record_chunk(self, job_id, page_numbers, content):
+        """Checkpoint one successful batch (1-based page numbers)."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO job_pages (job_id, first_page, pages, content, completed_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, page_numbers[0], json.dumps(page_numbers), content, now),
+            )
+            self._conn.execute("UPDATE jobs SET updated_at = ? WHERE job_id = ?", (now, job_id))
+            self._conn.commit()
+
+    def completed_chunks(self, job_id, page_indices=None):
+        """
+        Checkpointed batches for a job, in page order. With `page_indices`, only
+        batches whose pages all lie inside that 0-based selection are returned.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT pages, content FROM job_pages WHERE job_id = ? ORDER BY first_page", (job_id,)
+            ).fetchall()
+        wanted = None if page_indices is None else {idx + 1 for idx in page_indices}
+        chunks = []
+        for pages_json, content in rows:
+            pages = json.loads(pages_json)
+            if wanted is None or wanted.issuperset(pages):
+                chunks.append({"pages": pages, "content": content, "error": None, "sent_bytes": 0, "cached": True})
+        return chunks
+
+    def discard_job(self, job_id):
+        """Forget every checkpoint of a job so it starts from scratch."""
+        with self._lock:
+            self._conn.execute("DELETE FROM job_pages WHERE job_id = ?", (job_id,))
+            self._conn.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+            self._conn.commit()
+
+def get_checkpoint_store():
+    """Process-wide checkpoint store shared by all sessions and batch runs."""
+    global _checkpoint_store
+    with _singleton_lock:
+        if _checkpoint_store is None:
+            _checkpoint_store = CheckpointStore(CHECKPOINT_DIR, CHECKPOINT_TTL_SECONDS)
+        return _checkpoint_store
+
+class ResultFile:
+    """
+    Append-only file of one job's chunk results, one JSON line each in the order
+    they complete, plus a small index of where each line starts. Readers page
+    through the results and export them in page order, reading only the lines
+    they need. Appends are safe from several threads.
+    """
+
+    def __init__(self, path, content_type):
+        self.path = path
+        self.index_path = path + ".idx"
+        self.content_type = content_type
+        self._lock = threading.Lock()
+
+    @property
+    def id(self):
+        return os.path.splitext(os.path.basename(self.path))[0]
+
+    def handle(self):
+        """Small picklable reference to this file, for session state (see `OutputStore.open`)."""
+        return {"id": self.id, "content_type": self.content_type}
+
+    def append(self, chunk_result):
+        """Write one chunk result ("pages", "content", "error" and optional "method" and "reason")."""
+        record = {key: chunk_result.get(key) for key in ("pages", "content", "error", "method", "reason")}
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock:
+            with open(self.path, "ab") as f:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(line)
+            with open(self.index_path, "a", encoding="utf-8") as f:
+                f.write(f"{record['pages'][0]} {offset} {len(line)}\n")
+
+    def _entries(self):
+        """(first_page, offset, length) of every result in page order; a rewritten page keeps its newest result."""
+        entries = {}
+        with contextlib.suppress(FileNotFoundError), open(self.index_path, encoding="utf-8") as f:
+            for line in f:
+                first_page, offset, length = (int(value) for value in line.split())
+                entries[first_page] = (first_page, offset, length)
+        return [entries[first_page] for first_page in sorted(entries)]
+
+    def section_count(self):
+        """Number of chunk results written so far."""
+        return len(self._entries())
+
+    def page_count(self):
+        """Number of pages covered by the results written so far."""
+        return sum(len(chunk["pages"]) for chunk in self.iter_sections())
+
+    def iter_sections(self, start=0, count=None):
+        """Yield chunk results in page order, from position `start`, at most `count` of them."""
+        entries = self._entries()[start:None if count is None else start + count]
+        if not entries:
+            return
+        with open(self.path, "rb") as f:
+            for _, offset, length in entries:
+                f.seek(offset)
+                yield json.loads(f.read(length))
+
+    def sections(self, start=0, count=None):
+        """List of chunk results in page order (see `iter_sections`)."""
+        return list(self.iter_sections(start, count))
+
+    def iter_export(self, output_format):
+        """Yield the whole result in `output_format` (see OUTPUT_FORMATS) piece by piece, in page order."""
+        separator = chunk_separator(self.content_type)
+        for position, chunk in enumerate(self.iter_sections()):
+            if output_format == "jsonl":
+                yield json.dumps(chunk, ensure_ascii=False) + "\n"
+            elif output_format == "text":
+                body = chunk["content"] if chunk["error"] is None else f"Error: {chunk['error']}"
+                yield ("\n\n" if position else "") + f"{page_label_text(chunk['pages'])}\n\n{(body or '').strip()}"
+            else:
+                yield (separator if position else "") + format_chunk_section(chunk, self.content_type)
+
+    def write_export(self, output_format, f):
+        """Write the export in `output_format` to the text file object `f` without building it in memory."""
+        for piece in self.iter_export(output_format):
+            f.write(piece)
+
+    def export(self, output_format):
+        """The whole export as UTF-8 bytes, e.g. for a download."""
+        return "".join(self.iter_export(output_format)).encode("utf-8")
+
+class OutputStore:
+    """
+    Directory of per-job ResultFiles. Files are removed `ttl_seconds` after
+    their last write.
+    """
+
+    def __init__(self, directory, ttl_seconds):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self._purge_expired()
+
+    def _purge_expired(self):
+        cutoff = time.time() - self.ttl_seconds
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            with contextlib.suppress(OSError):  # already removed by another process
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+
+    def _path(self, file_id):
+        return os.path.join(self.directory, f"{file_id}.jsonl")
+
+    def create(self, content_type):
+        """A new, empty result file for one job."""
+        self._purge_expired()
+        path = self._path(uuid.uuid4().hex)
+        open(path, "wb").close()
+        return ResultFile(path, content_type)
+
+    def open(self, handle):
+        """The ResultFile for a `ResultFile.handle()`, or None once it has expired or been deleted."""
+        if not handle or not re.fullmatch(r"[0-9a-f]{32}", handle["id"]):
+            return None
+        path = self._path(handle["id"])
+        return ResultFile(path, handle["content_type"]) if os.path.exists(path) else None
+
+    def delete(self, handle):
+        """Remove a result file and its index."""
+        result_file = self.open(handle)
+        if result_file is not None:
+            for path in (result_file.path, result_file.index_path):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+
+def get_output_store():
+    """Process-wide store of per-job result files."""
+    global _output_store
+    with _singleton_lock:
+        if _output_store is None:
+            _output_store = OutputStore(OUTPUT_DIR, OUTPUT_TTL_SECONDS)
+        return _output_store
+
+class PdfDocumentCache:
+    """
+    In-memory cache of parsed PDFs keyed by content hash.
+
+    Up to `max_documents` documents stay open together with their page count
+    and text-layer classifications, and rendered, encoded page images are kept
+    in an LRU capped at `max_page_bytes`. Reruns, content-type switches and
+    rescans of a subset therefore neither re-parse nor re-render. Documents in
+    use are pinned and never closed under a reader. Safe to share across
+    threads; documents are only touched with _FITZ_LOCK held.
+    """
+
+    def __init__(self, max_documents, max_page_bytes):
+        self.max_documents = max_documents
+        self.max_page_bytes = max_page_bytes
+        self._lock = threading.Lock()
+        self._documents = collections.OrderedDict()  # digest -> entry dict
+        self._pages = collections.OrderedDict()  # (digest, page_index, dpi, preprocess signature, clip) -> (bytes, mime)
+        self._page_bytes = 0
+        self._hits = 0
+        self._misses = 0
+
+    def _evict_documents_locked(self):
+        evicted = []
+        for digest in list(self._documents):
+            if len(self._documents) <= self.max_documents:
+                break
+            if self._documents[digest]["pins"] == 0:
+                evicted.append(self._documents.pop(digest))
+        return evicted
+
+    @staticmethod
+    def _close(entries):
+        if entries:
+            with _FITZ_LOCK:
+                for entry in entries:
+                    entry["doc"].close()
+            for entry in entries:
+                if entry["path"]:
+                    with contextlib.suppress(OSError):  # still open in a render worker on Windows
+                        os.remove(entry["path"])
+
+    @contextlib.contextmanager
+    def document(self, pdf_bytes, pdf_digest=None, metrics=None):
+        """
+        Pin the parsed document for `pdf_bytes` for the duration of the block.
+
+        Yields:
+            dict: {"digest", "doc" (fitz.Document, use under _FITZ_LOCK),
+                   "page_count", "text_layers" (page_index -> route), "fingerprints"
+                   (page_index -> fingerprint) and "text_lines" (page_index -> page
+                   size and measured text lines), all guarded by _FITZ_LOCK}
+        """
+        digest = pdf_digest or sha256_hex(pdf_bytes)
+        with self._lock:
+            entry = self._documents.get(digest)
+            if entry is not None:
+                entry["pins"] += 1
+                self._documents.move_to_end(digest)
+        if entry is None:
+            with _FITZ_LOCK, _stage(metrics, "fitz_open"):
+                doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+            opened = {
+                "digest": digest, "doc": doc, "page_count": doc.page_count, "pins": 1, "text_layers": {},
+                "fingerprints": {}, "text_lines": {}, "path": None,
+            }
+            with self._lock:
+                entry = self._documents.get(digest)
+                if entry is None:
+                    entry = self._documents[digest] = opened
+                    duplicate = []
+                else:  # another thread opened it first
+                    entry["pins"] += 1
+                    duplicate = [opened]
+            self._close(duplicate)
+        try:
+            yield entry
+        finally:
+            with self._lock:
+                entry["pins"] -= 1
+                evicted = self._evict_documents_locked()
+            self._close(evicted)
+
+    def file_path(self, entry, pdf_bytes):
+        """
+        Path of a temporary copy of a pinned document, written on first use, so
+        render worker processes can open it themselves instead of receiving the
+        PDF bytes with every task. The file is removed with the document.
+        """
+        if entry["path"] is None:
+            fd, path = tempfile.mkstemp(prefix="ocr-", suffix=".pdf")
+            with os.fdopen(fd, "wb") as f:
+                f.write(pdf_bytes)
+            with self._lock:
+                if entry["path"] is None:
+                    entry["path"], path = path, None
+            if path is not None:  # another thread wrote it first
+                os.remove(path)
+        return entry["path"]
+
+    def get_page(self, key):
+        """Cached (image_bytes, mime_type) for a rendered page, or None."""
+        with self._lock:
+            value = self._pages.get(key)
+            if value is None:
+                self._misses += 1
+                return None
+            self._pages.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def put_page(self, key, image_bytes, mime_type):
+        """Store a rendered page, evicting the least recently used pages beyond the memory cap."""
+        size = len(image_bytes)
+        if size > self.max_page_bytes:
+            return
+        with self._lock:
+            previous = self._pages.pop(key, None)
+            if previous is not None:
+                self._page_bytes -= len(previous[0])
+            self._pages[key] = (image_bytes, mime_type)
+            self._page_bytes += size
+            while self._page_bytes > self.max_page_bytes:
+                _, (evicted_bytes, _) = self._pages.popitem(last=False)
+                self._page_bytes -= len(evicted_bytes)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "documents": len(self._documents),
+                "pages": len(self._pages),
+                "bytes": self._page_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+            }
+
+    def clear(self):
+        """Drop all rendered pages and close every document that is not in use."""
+        with self._lock:
+            self._pages.clear()
+            self._page_bytes = 0
+            evicted = [entry for entry in self._documents.values() if entry["pins"] == 0]
+            for entry in evicted:
+                del self._documents[entry["digest"]]
+        self._close(evicted)
+
+def get_pdf_document_cache():
+    """Process-wide PDF document cache shared by all sessions and batch runs."""
+    global _pdf_document_cache
+    with _singleton_lock:
+        if _pdf_document_cache is None:
+            _pdf_document_cache = PdfDocumentCache(PDF_DOCUMENT_CACHE_MAX_DOCUMENTS, PDF_PAGE_CACHE_MAX_BYTES)
+        return _pdf_document_cache
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent requests. While a call for a key is in
+    flight, later callers with the same key wait for it and share its result
+    (or its exception) instead of making their own upstream request. Nothing
+    is kept once the call finishes; the result cache covers later repeats.
+    If the leading call is interrupted (e.g. a Streamlit rerun stops its
+    script), one of the waiters takes over. Safe to share across threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # key -> {"done": Event, "result", "error", "finished"}
+        self._leaders = 0
+        self._shared = 0
+
+    def do(self, key, fn, on_wait=None, metrics=None):
+        """
+        Run fn() for `key`, or wait for the identical call already in flight.
+
+        Args:
+            on_wait (callable): Optional. Called once, before blocking, when this
+                caller has to wait for another caller's request.
+            metrics (StageMetrics): Optional. Records the wait as "coalesce_wait".
+
+        Returns:
+            tuple: (result, shared), where shared is True when the result came
+            from another caller's request.
+        """
+        waited = False
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                if call is None:
+                    call = self._calls[key] = {"done": threading.Event(), "result": None, "error": None, "finished": False}
+                    self._leaders += 1
+                    break
+            if not waited and on_wait:
+                on_wait()
+            waited = True
+            with _stage(metrics, "coalesce_wait"):
+                call["done"].wait()
+            if call["finished"]:
+                with self._lock:
+                    self._shared += 1
+                if call["error"] is not None:
+                    raise call["error"]
+                return call["result"], True
+            # The leader was interrupted before finishing: try to lead the call ourselves.
+
+        try:
+            call["result"] = fn()
+            call["finished"] = True
+            return call["result"], False
+        except Exception as e:
+            call["error"] = e
+            call["finished"] = True
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+
+    def stats(self):
+        """Return a dict with upstream calls made, calls shared with waiters, and calls in flight."""
+        with self._lock:
+            return {"leaders": self._leaders, "shared": self._shared, "in_flight": len(self._calls)}
+
+def get_single_flight():
+    """Process-wide request coalescer shared by all sessions and batch runs."""
+    global _single_flight
+    with _singleton_lock:
+        if _single_flight is None:
+            _single_flight = SingleFlight()
+        return _single_flight
+
+class RateLimitTimeout(requests.exceptions.RequestException):
+    """A rate-limited request would have to queue longer than the limiter allows."""
+
+class FairRateLimiter:
+    """
+    Token bucket shared by every thread and session in the process: requests
+    are admitted at `rate_per_minute` on average, with bursts of up to `burst`.
+    Waiting requests are admitted round-robin across clients (one per client
+    in turn), so one session's large batch cannot starve another session's
+    single request. A 429 from upstream pauses the whole bucket for the
+    Retry-After period, so queued requests wait it out together instead of
+    all hitting the API and failing. Requests that would have to wait longer
+    than `max_wait_seconds` are rejected up front with RateLimitTimeout.
+    """
+
+    def __init__(self, rate_per_minute, burst, max_wait_seconds):
+        self.rate = rate_per_minute / 60.0  # tokens per second
+        self.burst = burst
+        self.max_wait_seconds = max_wait_seconds
+        self._cond = threading.Condition()
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._queues = collections.OrderedDict()  # client_id -> deque of tickets; the first client is served next
+        self._granted = 0
+        self._rejected = 0
+
+    def _refill_locked(self, now):
+        if now > self._updated:  # _updated is in the future while paused
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def _estimate_locked(self, client_id, ticket, now):
+        """(requests admitted before `ticket`, estimated seconds until it is admitted)."""
+        rounds = self._queues[client_id].index(ticket)
+        position, before_client = 0, True
+        for other_id, other_tickets in self._queues.items():
+            if other_id == client_id:
+                position += rounds
+                before_client = False
+            else:
+                position += min(len(other_tickets), rounds + 1 if before_client else rounds)
+        paused = max(0.0, self._paused_until - now)
+        tokens = 0.0 if paused else self._tokens
+        return position, paused + max(0.0, (position + 1 - tokens) / self.rate)
+
+    def acquire(self, client_id, on_wait=None):
+        """
+        Block until a request for `client_id` may be sent.
+
+        Args:
+            on_wait (callable): Optional. Called from the waiting thread as
+                on_wait(position, eta_seconds) about twice a second while queued
+                (position 0 is next in line), and once as on_wait(None, 0) when
+                the request is admitted after having waited.
+
+        Raises:
+            RateLimitTimeout: The estimated wait exceeds `max_wait_seconds`.
+        """
+        ticket = object()
+        waited = False
+        with self._cond:
+            self._queues.setdefault(client_id, collections.deque()).append(ticket)
+        try:
+            while True:
+                with self._cond:
+                    now = time.monotonic()
+                    self._refill_locked(now)
+                    tickets = self._queues[client_id]
+                    if next(iter(self._queues)) == client_id and tickets[0] is ticket \
+                            and now >= self._paused_until and self._tokens >= 1:
+                        self._tokens -= 1
+                        self._granted += 1
+                        tickets.popleft()
+                        ticket = None
+                        if tickets:
+                            self._queues.move_to_end(client_id)  # back of the line for this client's next request
+                        else:
+                            del self._queues[client_id]
+                        self._cond.notify_all()
+                        break
+                    position, eta = self._estimate_locked(client_id, ticket, now)
+                    if not waited and eta > self.max_wait_seconds:
+                        self._rejected += 1
+                        raise RateLimitTimeout(
+                            f"The shared API key is busy: about {eta:.0f}s of queued requests ahead, more than the "
+                            f"{self.max_wait_seconds:.0f}s limit. Try again shortly or use your own API key."
+                        )
+                if on_wait:
+                    on_wait(position, eta)
+                waited = True
+                with self._cond:
+                    self._cond.wait(min(0.5, max(0.01, eta)))
+        finally:
+            if ticket is not None:  # rejected or interrupted: leave the queue
+                with self._cond:
+                    tickets = self._queues.get(client_id)
+                    if tickets is not None:
+                        tickets.remove(ticket)
+                        if not tickets:
+                            del self._queues[client_id]
+                    self._cond.notify_all()
+        if waited and on_wait:
+            on_wait(None, 0)
+
+    def pause(self, seconds):
+        """Admit nothing for `seconds` (e.g. after a 429) and start refilling from empty."""
+        with self._cond:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + seconds)
+            self._tokens = 0.0
+            self._updated = max(self._updated, self._paused_until)
+            self._cond.notify_all()
+
+    def status(self, client_id):
+        """
+        Queue state for one client.
+
+        Returns:
+            dict: {"waiting": this client's queued requests, "position" and
+                   "eta_seconds" of its next request (None when not queued),
+                   "queued": queued requests across all clients}
+        """
+        with self._cond:
+            now = time.monotonic()
+            self._refill_locked(now)
+            tickets = self._queues.get(client_id)
+            position, eta = self._estimate_locked(client_id, tickets[0], now) if tickets else (None, None)
+            return {
+                "waiting": len(tickets) if tickets else 0,
+                "position": position,
+                "eta_seconds": eta,
+                "queued": sum(len(other) for other in self._queues.values()),
+            }
+
+    def stats(self):
+        """Return a dict with admitted and rejected requests, queued requests and clients, and spare tokens."""
+        with self._cond:
+            self._refill_locked(time.monotonic())
+            return {
+                "granted": self._granted,
+                "rejected": self._rejected,
+                "queued": sum(len(other) for other in self._queues.values()),
+                "clients": len(self._queues),
+                "tokens": self._tokens,
+            }
+
+class RateLimitedKey(str):
+    """
+    An API key whose requests are admitted by a FairRateLimiter on behalf of
+    `client_id`. It is still the plain key string, so it can be handed to any
+    engine call; the HTTP layer throttles every attempt made with it.
+    """
+
+    def __new__(cls, key, limiter, client_id, on_wait=None):
+        api_key = super().__new__(cls, key)
+        api_key.limiter = limiter
+        api_key.client_id = client_id
+        api_key.on_wait = on_wait
+        return api_key
+
+    def acquire(self):
+        self.limiter.acquire(self.client_id, self.on_wait)
+
+    def backoff(self, seconds):
+        self.limiter.pause(seconds)
+
+def get_rate_limiter(name, rate_per_minute, burst, max_wait_seconds):
+    """Process-wide rate limiter registered under `name`, created with these settings on first use."""
+    with _singleton_lock:
+        if name not in _rate_limiters:
+            _rate_limiters[name] = FairRateLimiter(rate_per_minute, burst, max_wait_seconds)
+        return _rate_limiters[name]
+
+class JobCancelled(Exception):
+    """Raised inside a background job once its cancellation was requested."""
+
+class BackgroundJob:
+    """
+    Handle of one job run by JobManager. The job function reports progress,
+    a partial preview and notes through it; the UI reads `snapshot()` from
+    any later script run. Cancellation is cooperative: the function calls
+    `check_cancelled()` between steps.
+    """
+
+    def __init__(self, job_id, owner, kind, label):
+        self.id = job_id
+        self.owner = owner
+        self.kind = kind
+        self.label = label
+        self._lock = threading.Lock()
+        self._cancel = threading.Event()
+        self.status = "queued"  # queued -> running -> done | failed | cancelled
+        self.completed = 0
+        self.total = 0
+        self.progress_text = ""
+        self.partial = ""
+        self.notes = []  # (level, message) for the UI to show with the result
+        self.meta = {}  # values the job shares with the UI besides its result, e.g. which key it used
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def report(self, completed=None, total=None, text=None):
+        """Update the progress counters and/or the progress text."""
+        with self._lock:
+            if completed is not None:
+                self.completed = completed
+            if total is not None:
+                self.total = total
+            if text is not None:
+                self.progress_text = text
+
+    def set_partial(self, text):
+        """Replace the preview of the output produced so far."""
+        with self._lock:
+            self.partial = text
+
+    def note(self, level, message):
+        """Keep a message ("info", "warning", "error", "caption" or "toast") to show with the result."""
+        with self._lock:
+            self.notes.append((level, message))
+
+    def set_meta(self, name, value):
+        """Record a value for the UI that must survive even if the job fails or is cancelled."""
+        with self._lock:
+            self.meta[name] = value
+
+    def cancel(self):
+        self._cancel.set()
+
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def check_cancelled(self):
+        """Raise JobCancelled if cancellation was requested."""
+        if self._cancel.is_set():
+            raise JobCancelled(self.id)
+
+    @property
+    def active(self):
+        return self.status in ("queued", "running")
+
+    def snapshot(self):
+        """Return a consistent copy of the job's state as a dict."""
+        with self._lock:
+            return {
+                "id": self.id, "owner": self.owner, "kind": self.kind, "label": self.label,
+                "status": self.status, "completed": self.completed, "total": self.total,
+                "progress_text": self.progress_text, "partial": self.partial, "notes": list(self.notes), "meta": dict(self.meta),
+                "result": self.result, "error": self.error, "cancel_requested": self._cancel.is_set(),
+                "elapsed_seconds": ((self.finished or time.time()) - self.started) if self.started else 0.0,
+            }
+
+class JobManager:
+    """
+    Runs OCR jobs on a bounded thread pool, independent of any Streamlit
+    script run, so a rerun triggered by a widget does not abandon work in
+    flight. Jobs are kept in memory by ID and owner (a session ID); finished
+    jobs are dropped after `retention_seconds`. Safe to share across threads.
+    """
+
+    def __init__(self, workers, retention_seconds):
+        self.retention_seconds = retention_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max(1, int(workers)), thread_name_prefix="ocr-job")
+        self._lock = threading.Lock()
+        self._jobs = collections.OrderedDict()  # job ID -> BackgroundJob, oldest first
+
+    def submit(self, owner, kind, label, fn):
+        """
+        Queue fn(job) to run in the background.
+
+        Args:
+            owner (str): Who the job belongs to, e.g. a session ID.
+            kind (str): What the job does, so the UI can find it again (e.g. "pdf_scan").
+            label (str): Short description shown while the job runs.
+            fn (callable): Called with the BackgroundJob; its return value becomes the result.
+
+        Returns:
+            BackgroundJob: The queued job.
+        """
+        job = BackgroundJob(uuid.uuid4().hex, owner, kind, label)
+        with self._lock:
+            self._prune_locked()
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, fn)
+        return job
+
+    def _run(self, job, fn):
+        with job._lock:
+            if job._cancel.is_set():
+                job.status, job.finished = "cancelled", time.time()
+                return
+            job.status, job.started = "running", time.time()
+        try:
+            result = fn(job)
+            status, error = "done", None
+        except JobCancelled:
+            result, status, error = None, "cancelled", None
+        except Exception as e:  # reported through the job; nothing else would see it
+            result, status, error = None, "failed", f"{type(e).__name__}: {e}"
+        with job._lock:
+            job.result, job.status, job.error, job.finished = result, status, error, time.time()
+
+    def _prune_locked(self):
+        cutoff = time.time() - self.retention_seconds
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.finished and job.finished < cutoff]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        """Return the job with this ID, or None if it is unknown or was pruned."""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs_for(self, owner, kind=None):
+        """Return `owner`'s jobs (optionally only of `kind`), oldest first."""
+        with self._lock:
+            return [job for job in self._jobs.values() if job.owner == owner and (kind is None or job.kind == kind)]
+
+    def forget(self, job_id):
+        """Drop a finished job once its result was collected."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and not job.active:
+                del self._jobs[job_id]
+
+    def stats(self):
+        """Return a dict with queued, running and finished job counts."""
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+        return {
+            "queued": statuses.count("queued"),
+            "running": statuses.count("running"),
+            "finished": len(statuses) - statuses.count("queued") - statuses.count("running"),
+        }
+
+def get_job_manager():
+    """Process-wide background job runner shared by all sessions."""
+    global _job_manager
+    with _singleton_lock:
+        if _job_manager is None:
+            _job_manager = JobManager(JOB_WORKERS, JOB_RETENTION_SECONDS)
+        return _job_manager
+
+def get_render_pool(workers):
+    """
+    Process-wide pool of `workers` page-rendering processes, created on first
+    use and replaced when the worker count changes (renders already submitted
+    to the old pool still finish). Uses the spawn start method, which is safe
+    alongside threads and behaves the same on every platform.
+    """
+    global _render_pool
+    with _singleton_lock:
+        if _render_pool is None or _render_pool[0] != workers:
+            if _render_pool is not None:
+                _render_pool[1].shutdown(wait=False)
+            _render_pool = (workers, ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")))
+        return _render_pool[1]
+
+def shutdown_render_pool():
+    """
+    Stop the render worker processes, if any. Only needed in processes started
+    by multiprocessing, which join their children at exit without running the
+    executor's own shutdown hook.
+    """
+    global _render_pool
+    with _singleton_lock:
+        pool, _render_pool = _render_pool, None
+    if pool is not None:
+        pool[1].shutdown()
+
+def _percentile(samples, percent):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, round(percent / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+class MetricsRegistry:
+    """
+    Process-wide stage duration histograms and token counters across all runs,
+    rendered in the Prometheus text exposition format. Safe to share across threads.
+    """
+
+    def __init__(self, buckets=METRICS_HISTOGRAM_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._histograms = {}  # stage -> [bucket counts..., +Inf count, sum]
+        self._tokens = collections.Counter()
+        self._runs = collections.Counter()
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self._histograms.setdefault(stage, [0] * (len(self.buckets) + 1) + [0.0])
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[len(self.buckets)] += 1
+            histogram[-1] += seconds
+
+    def add_tokens(self, kind, count):
+        with self._lock:
+            self._tokens[kind] += count
+
+    def count_run(self, kind):
+        with self._lock:
+            self._runs[kind] += 1
+
+    def prometheus_text(self):
+        """All metrics in the Prometheus text format (version 0.0.4)."""
+        lines = [
+            "# HELP ocr_stage_duration_seconds Time spent in each OCR pipeline stage.",
+            "# TYPE ocr_stage_duration_seconds histogram",
+        ]
+        with self._lock:
+            for stage in sorted(self._histograms):
+                histogram = self._histograms[stage]
+                for bound, count in zip(self.buckets, histogram):
+                    lines.append(f'ocr_stage_duration_seconds_bucket{{stage="{stage}",le="{bound:g}"}} {count}')
+                total = histogram[len(self.buckets)]
+                lines.append(f'ocr_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {total}')
+                lines.append(f'ocr_stage_duration_seconds_sum{{stage="{stage}"}} {histogram[-1]:.6f}')
+                lines.append(f'ocr_stage_duration_seconds_count{{stage="{stage}"}} {total}')
+            lines += ["# HELP ocr_tokens_total Tokens reported in the API usage field.", "# TYPE ocr_tokens_total counter"]
+            lines += [f'ocr_tokens_total{{kind="{kind}"}} {count}' for kind, count in sorted(self._tokens.items())]
+            lines += ["# HELP ocr_runs_total Instrumented OCR runs.", "# TYPE ocr_runs_total counter"]
+            lines += [f'ocr_runs_total{{kind="{kind}"}} {count}' for kind, count in sorted(self._runs.items())]
+        return "\n".join(lines) + "\n"
+
+def get_metrics_registry():
+    """Process-wide metrics registry shared by all sessions and runs."""
+    global _metrics_registry
+    with _singleton_lock:
+        if _metrics_registry is None:
+            _metrics_registry = MetricsRegistry()
+        return _metrics_registry
+
+class StageMetrics:
+    """
+    Stage timings and token usage for one run (one scan, one image, one CLI file).
+    Every observation is also added to the process-wide MetricsRegistry.
+    Safe to share with worker threads.
+    """
+
+    def __init__(self, kind, registry=None):
+        self.kind = kind
+        self.registry = registry or get_metrics_registry()
+        self._lock = threading.Lock()
+        self._samples = collections.defaultdict(list)
+        self._tokens = collections.Counter()
+        self._started = time.perf_counter()
+        self.wall_seconds = None
+        self.registry.count_run(kind)
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            self._samples[stage].append(seconds)
+        self.registry.observe(stage, seconds)
+
+    def add_usage(self, usage):
+        """Count tokens from an API response's `usage` field (ignored when absent)."""
+        if not isinstance(usage, dict):
+            return
+        for kind in ("prompt_tokens", "completion_tokens", "total_tokens"):
+            count = usage.get(kind)
+            if isinstance(count, int):
+                with self._lock:
+                    self._tokens[kind] += count
+                self.registry.add_tokens(kind.removesuffix("_tokens"), count)
+
+    def finish(self):
+        """Stop the wall clock and append the run to OCR_METRICS_LOG when it is set."""
+        self.wall_seconds = time.perf_counter() - self._started
+        if METRICS_LOG_PATH:
+            with open(METRICS_LOG_PATH, "a", encoding="utf-8") as f:
+                f.write(json.dumps(self.to_dict()) + "\n")
+        return self
+
+    def stage_summaries(self):
+        """Per-stage counts and latency statistics, in pipeline order."""
+        with self._lock:
+            samples = {stage: list(values) for stage, values in self._samples.items()}
+        order = {stage: i for i, stage in enumerate(METRICS_STAGES)}
+        summaries = {}
+        for stage in sorted(samples, key=lambda name: order.get(name, len(order))):
+            values = samples[stage]
+            summaries[stage] = {
+                "count": len(values),
+                "total_s": round(sum(values), 4),
+                "mean_ms": round(1000 * sum(values) / len(values), 2),
+                "p50_ms": round(1000 * _percentile(values, 50), 2),
+                "p95_ms": round(1000 * _percentile(values, 95), 2),
+                "max_ms": round(1000 * max(values), 2),
+            }
+        return summaries
+
+    @property
+    def tokens(self):
+        with self._lock:
+            return dict(self._tokens)
+
+    def to_dict(self):
+        """JSON-serializable summary of the run."""
+        return {
+            "timestamp": time.time(),
+            "kind": self.kind,
+            "wall_seconds": round(self.wall_seconds, 3) if self.wall_seconds is not None else None,
+            "stages": self.stage_summaries(),
+            "tokens": self.tokens,
+        }
+
+def _stage(metrics, stage):
+    """Time a block into `metrics`, or do nothing when no metrics are collected."""
+    return metrics.time(stage) if metrics is not None else contextlib.nullcontext()
+
+def sha256_hex(data):
+    """Hex SHA-256 digest of raw bytes."""
+    return hashlib.sha256(data).hexdigest()
+
+def pdf_page_digest(pdf_digest, page_index, preprocess_options=None, adaptive_resolution=False):
+    """
+    Content address of one rendered PDF page (document hash, page, render DPI and
+    preprocessing). With `adaptive_resolution`, the DPI and strips follow from the
+    page itself (see `plan_pdf_page_resolutions`), so they are not part of the address.
+    """
+    resolution = "adaptive" if adaptive_resolution else f"dpi{PDF_RENDER_DPI}"
+    return f"{pdf_digest}:page{page_index}:{resolution}:{preprocess_signature(preprocess_options)}"
+
+def result_cache_key(content_digests, model_id, prompt_text):
+    """
+    Build a result-cache key from the input image digests, model ID and prompt text.
+    """
+    material = json.dumps([list(content_digests), model_id, prompt_text])
+    return sha256_hex(material.encode("utf-8"))
+
+def _get_http_session():
+    """
+    Process-wide requests session with a keep-alive connection pool, so repeated
+    calls reuse TCP+TLS connections instead of handshaking every time.
+    Retries are handled by `post_with_retries`, not by the adapter.
+    """
+    global _http_session
+    with _singleton_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=0)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session = session
+        return _http_session
+
+def _retry_after_seconds(response):
+    """Seconds requested by a Retry-After header (delta or HTTP date), or None."""
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+def _retry_delay_seconds(attempt, response=None):
+    """
+    Seconds to wait before retry number `attempt` (0-based). Honors a Retry-After
+    header when present, otherwise uses exponential backoff with full jitter.
+    """
+    delay = _retry_after_seconds(response)
+    if delay is not None:
+        return min(HTTP_BACKOFF_MAX_SECONDS, delay)
+    return random.uniform(0, min(HTTP_BACKOFF_MAX_SECONDS, HTTP_BACKOFF_BASE_SECONDS * (2 ** attempt)))
+
+def post_with_retries(url, headers, data, stream=False, max_attempts=HTTP_MAX_ATTEMPTS, throttle=None):
+    """
+    POST through the shared session, retrying connection errors, timeouts and
+    HTTP_RETRY_STATUS_CODES up to `max_attempts` attempts in total.
+
+    With `throttle` (a RateLimitedKey), every attempt waits for its limiter to
+    admit it, and a 429 pauses the limiter for the Retry-After period instead
+    of sleeping here, so every queued request honors it.
+
+    Returns:
+        requests.Response: The final response. Callers check its status.
+    """
+    session = _get_http_session()
+    timeout = (HTTP_CONNECT_TIMEOUT_SECONDS, HTTP_READ_TIMEOUT_SECONDS)
+    for attempt in range(max_attempts):
+        is_last_attempt = attempt == max_attempts - 1
+        if throttle is not None:
+            throttle.acquire()
+        try:
+            response = session.post(url, headers=headers, data=data, timeout=timeout, stream=stream)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if is_last_attempt:
+                raise
+            time.sleep(_retry_delay_seconds(attempt))
+            continue
+        if throttle is not None and response.status_code == 429:
+            throttle.backoff(_retry_delay_seconds(attempt, response))
+            if not is_last_attempt:
+                response.close()
+                continue
+        if response.status_code not in HTTP_RETRY_STATUS_CODES or is_last_attempt:
+            return response
+        delay = _retry_delay_seconds(attempt, response)
+        response.close()
+        time.sleep(delay)
+
+def _openrouter_headers(api_key, site_url=""):
+    """Request headers for an OpenRouter chat completion call."""
+    return {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
+        "HTTP-Referer": site_url, # Optional. Site URL for rankings on openrouter.ai.
+        "X-Title": "OCR Text Vision Pro", # Optional. Site title for rankings on openrouter.ai.
+    }
+
+def is_auto_model(model_id):
+    """True for the router-backed "Auto" model IDs."""
+    return model_id in (AUTO_MODEL_ID, AUTO_HEDGED_MODEL_ID)
+
+def post_chat_completion(api_key, model_id, messages, site_url="", max_attempts=HTTP_MAX_ATTEMPTS, metrics=None,
+                         response_format=None):
+    """
+    Sends a chat completion request to OpenRouter and returns the decoded JSON.
+
+    Safe to call from worker threads. Transient failures are retried with backoff
+    (see `post_with_retries`); remaining network and decoding errors are raised.
+    Auto model IDs are handed to the model router (see `ModelRouter.post`).
+
+    Args:
+        api_key (str): The OpenRouter API key.
+        model_id (str): The OpenRouter model ID to use, or an Auto model ID.
+        messages (list): A list of message dictionaries for the chat completion API.
+        site_url (str): Optional. Site URL for rankings on openrouter.ai.
+        metrics (StageMetrics): Optional. Receives http_post (upload, inference
+            and download, including retries and any rate limiter wait) and
+            json_decode timings and token usage.
+        response_format (dict): Optional. OpenRouter `response_format`, e.g. a JSON
+            schema for structured output. Not sent for Auto model IDs, since not
+            every model behind the router accepts it.
+
+    Returns:
+        dict: The JSON response from the OpenRouter API.
+    """
+    if is_auto_model(model_id):
+        return get_model_router().post(
+            api_key, messages, site_url, hedge=model_id == AUTO_HEDGED_MODEL_ID, metrics=metrics
+        )
+    request_body = {
+        "model": model_id,
+        "messages": messages,
+    }
+    if response_format is not None:
+        request_body["response_format"] = response_format
+    payload = json.dumps(request_body)
+    with _stage(metrics, "http_post"):
+        response = post_with_retries(
+            OPENROUTER_API_URL, _openrouter_headers(api_key, site_url), payload, max_attempts=max_attempts,
+            throttle=api_key if isinstance(api_key, RateLimitedKey) else None,
+        )
+    response.raise_for_status() # Raise an exception for HTTP errors (4xx or 5xx)
+    with _stage(metrics, "json_decode"):
+        response_json = response.json()
+    if metrics is not None:
+        metrics.add_usage(response_json.get("usage"))
+    return response_json
+
+def stream_chat_completion(api_key, model_id, messages, site_url="", max_attempts=HTTP_MAX_ATTEMPTS, metrics=None):
+    """
+    Streams a chat completion from OpenRouter (`stream: true`), parsing the
+    server-sent events incrementally and yielding content deltas as they arrive.
+
+    Retries only apply before the stream starts; errors mid-stream are raised.
+    Auto model IDs are handed to the model router (see `ModelRouter.stream`).
+    With `metrics`, records http_post (until response headers),
+    time_to_first_token, stream_read and any token usage sent in the stream.
+
+    Yields:
+        str: The next piece of the assistant's reply.
+    """
+    if is_auto_model(model_id):
+        yield from get_model_router().stream(api_key, messages, site_url, metrics=metrics)
+        return
+    payload = json.dumps({
+        "model": model_id,
+        "messages": messages,
+        "stream": True,
+    })
+    started = time.perf_counter()
+    with _stage(metrics, "http_post"):
+        response = post_with_retries(
+            OPENROUTER_API_URL, _openrouter_headers(api_key, site_url), payload, stream=True, max_attempts=max_attempts,
+            throttle=api_key if isinstance(api_key, RateLimitedKey) else None,
+        )
+    first_token = True
+    with response, _stage(metrics, "stream_read"):
+        response.raise_for_status()
+        response.encoding = "utf-8"  # SSE is always UTF-8; requests would guess ISO-8859-1
+        for line in response.iter_lines(decode_unicode=True):
+            # Blank lines separate events; lines starting with ':' are keep-alive comments
+            if not line or not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            event = json.loads(data)
+            if "error" in event:
+                message = event["error"].get("message", "Unknown streaming error") if isinstance(event["error"], dict) else event["error"]
+                raise requests.exceptions.HTTPError(f"Streaming error: {message}")
+            if metrics is not None and event.get("usage"):
+                metrics.add_usage(event["usage"])
+            choices = event.get("choices") or []
+            delta = choices[0].get("delta", {}).get("content") if choices else None
+            if delta:
+                if first_token and metrics is not None:
+                    metrics.observe("time_to_first_token", time.perf_counter() - started)
+                    first_token = False
+                yield delta
+
+def _is_caller_error(error):
+    """
+    401/403 errors come from the API key and RateLimitTimeout from our own
+    limiter, so trying another model cannot help.
+    """
+    if isinstance(error, RateLimitTimeout):
+        return True
+    response = getattr(error, "response", None)
+    return response is not None and response.status_code in (401, 403)
+
+class ModelRouter:
+    """
+    Sends each request to the currently healthiest of `model_ids` and fails over
+    to the next one on errors.
+
+    Health is tracked over the last ROUTER_WINDOW_SIZE requests per model that
+    are younger than ROUTER_SAMPLE_MAX_AGE_SECONDS: models are ranked by p50
+    latency, penalized by their error rate. Models without recent samples are
+    tried first so they get measured, and a model that returned 429 is skipped
+    until its Retry-After (or ROUTER_RATE_LIMIT_COOLDOWN_SECONDS) has passed.
+    Safe to share across threads.
+    """
+
+    def __init__(self, model_ids):
+        self.model_ids = list(model_ids)
+        self._lock = threading.Lock()
+        self._latencies = {model: collections.deque(maxlen=ROUTER_WINDOW_SIZE) for model in self.model_ids}
+        self._outcomes = {model: collections.deque(maxlen=ROUTER_WINDOW_SIZE) for model in self.model_ids}
+        self._rate_limited = dict.fromkeys(self.model_ids, 0)
+        self._cooldown_until = dict.fromkeys(self.model_ids, 0.0)
+
+    def _prune_locked(self, model):
+        cutoff = time.time() - ROUTER_SAMPLE_MAX_AGE_SECONDS
+        for samples in (self._latencies[model], self._outcomes[model]):
+            while samples and samples[0][0] < cutoff:
+                samples.popleft()
+
+    def _error_rate_locked(self, model):
+        outcomes = self._outcomes[model]
+        return sum(1 for _, ok in outcomes if not ok) / len(outcomes) if outcomes else None
+
+    def _percentile_locked(self, model, percent):
+        self._prune_locked(model)
+        samples = sorted(latency for _, latency in self._latencies[model])
+        if not samples:
+            return None
+        rank = max(0, min(len(samples) - 1, round(percent / 100 * len(samples) + 0.5) - 1))
+        return samples[rank]
+
+    def percentile(self, model, percent):
+        """Latency percentile in seconds over recent successful requests, or None."""
+        with self._lock:
+            return self._percentile_locked(model, percent)
+
+    def record_success(self, model, latency_seconds):
+        with self._lock:
+            now = time.time()
+            self._latencies[model].append((now, latency_seconds))
+            self._outcomes[model].append((now, True))
+
+    def record_failure(self, model, error):
+        with self._lock:
+            self._outcomes[model].append((time.time(), False))
+            response = getattr(error, "response", None)
+            if response is not None and response.status_code == 429:
+                self._rate_limited[model] += 1
+                cooldown = _retry_after_seconds(response)
+                self._cooldown_until[model] = time.time() + (
+                    ROUTER_RATE_LIMIT_COOLDOWN_SECONDS if cooldown is None else cooldown
+                )
+
+    def ranked_models(self):
+        """Models from healthiest to least healthy; rate-limited models come last."""
+        now = time.time()
+        with self._lock:
+            def _score(model):
+                p50 = self._percentile_locked(model, 50)
+                error_rate = self._error_rate_locked(model) or 0.0
+                return (self._cooldown_until[model] > now, (p50 or 0.0) * (1 + ROUTER_ERROR_PENALTY * error_rate))
+            return sorted(self.model_ids, key=_score)
+
+    def health(self):
+        """Per-model health rows for display, in routing order."""
+        now = time.time()
+        rows = []
+        for model in self.ranked_models():
+            with self._lock:
+                p50, p95, p99 = (self._percentile_locked(model, percent) for percent in (50, 95, 99))
+                outcomes = self._outcomes[model]
+                error_rate = self._error_rate_locked(model)
+                cooldown = self._cooldown_until[model] - now
+                rows.append({
+                    "Model": model,
+                    "Requests": len(outcomes),
+                    "p50 (s)": f"{p50:.1f}" if p50 is not None else "–",
+                    "p95 (s)": f"{p95:.1f}" if p95 is not None else "–",
+                    "p99 (s)": f"{p99:.1f}" if p99 is not None else "–",
+                    "Errors": f"{error_rate:.0%}" if error_rate is not None else "–",
+                    "429s": self._rate_limited[model],
+                    "Status": f"cooling down {cooldown:.0f}s" if cooldown > 0 else ("ok" if outcomes else "untested"),
+                })
+        return rows
+
+    def _timed_post(self, api_key, model, messages, site_url, metrics=None):
+        started = time.monotonic()
+        try:
+            response_json = post_chat_completion(
+                api_key, model, messages, site_url, max_attempts=ROUTER_ATTEMPTS_PER_MODEL, metrics=metrics
+            )
+        except (requests.exceptions.RequestException, ValueError) as e:
+            if not _is_caller_error(e):
+                self.record_failure(model, e)
+            raise
+        self.record_success(model, time.monotonic() - started)
+        response_json.setdefault("model", model)
+        return response_json
+
+    def post(self, api_key, messages, site_url="", hedge=False, metrics=None):
+        """
+        Non-streaming chat completion with failover. With `hedge`, a second model
+        is started when the first has not answered within its own p95 latency,
+        and whichever succeeds first wins.
+
+        Returns:
+            dict: The JSON response, with "model" naming the model that answered.
+        """
+        candidates = self.ranked_models()
+        executor = ThreadPoolExecutor(max_workers=len(candidates))
+        pending = {}
+        last_error = None
+
+        def _start_next():
+            model = candidates.pop(0)
+            future = executor.submit(self._timed_post, api_key, model, messages, site_url, metrics)
+            pending[future] = (model, time.monotonic())
+
+        try:
+            _start_next()
+            while pending:
+                timeout = None
+                if hedge and candidates and len(pending) == 1:
+                    (model, started), = pending.values()
+                    with self._lock:
+                        self._prune_locked(model)  # count only samples p95 is computed from
+                        p95 = None
+                        if len(self._latencies[model]) >= ROUTER_HEDGE_MIN_SAMPLES:
+                            p95 = self._percentile_locked(model, 95)
+                    if p95 is not None:
+                        timeout = max(0.0, p95 - (time.monotonic() - started))
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    _start_next()  # hedge: the first model is slower than usual
+                    continue
+                for future in done:
+                    pending.pop(future)
+                    try:
+                        return future.result()
+                    except (requests.exceptions.RequestException, ValueError) as e:
+                        if _is_caller_error(e):
+                            raise
+                        last_error = e
+                if not pending and candidates:
+                    _start_next()
+            raise last_error
+        finally:
+            # A losing hedged request finishes in the background and still updates the stats
+            executor.shutdown(wait=False)
+
+    def stream(self, api_key, messages, site_url="", metrics=None):
+        """
+        Streaming chat completion with failover. A model can only be replaced
+        before its first token arrives; errors mid-stream are raised.
+
+        Yields:
+            str: The next piece of the assistant's reply.
+        """
+        last_error = None
+        for model in self.ranked_models():
+            started = time.monotonic()
+            received_text = False
+            try:
+                for delta in stream_chat_completion(
+                    api_key, model, messages, site_url, max_attempts=ROUTER_ATTEMPTS_PER_MODEL, metrics=metrics
+                ):
+                    received_text = True
+                    yield delta
+            except (requests.exceptions.RequestException, ValueError) as e:
+                if _is_caller_error(e):
+                    raise
+                self.record_failure(model, e)
+                if received_text:
+                    raise
+                last_error = e
+                continue
+            self.record_success(model, time.monotonic() - started)
+            return
+        raise last_error
+
+def get_model_router():
+    """Process-wide model router over AVAILABLE_MODELS, so health stats are shared by all sessions."""
+    global _model_router
+    with _singleton_lock:
+        if _model_router is None:
+            _model_router = ModelRouter(AVAILABLE_MODELS.values())
+        return _model_router
+
+def preprocess_signature(options):
+    """Stable string describing preprocessing settings, used in cache keys."""
+    if not options or not options["enabled"]:
+        return "raw"
+    return f"max{options['max_side']}:gray{int(options['grayscale'])}:crop{int(options['autocrop'])}"
+
+def _is_line_art(image):
+    """
+    Heuristic: text, screenshots and diagrams are mostly one flat background colour,
+    photos have a spread-out histogram. Line art is encoded losslessly.
+    """
+    histogram = image.convert("L").resize((256, 256), Image.NEAREST).histogram()
+    background_level = max(range(256), key=histogram.__getitem__)
+    near_background = sum(histogram[max(0, background_level - 8):background_level + 9])
+    return near_background / (256 * 256) >= IMAGE_LINE_ART_BACKGROUND_RATIO
+
+def _is_grayscale_content(image):
+    """True when an RGB image has (almost) no colour, e.g. a scanned black-and-white page."""
+    r, g, b = image.convert("RGB").resize((64, 64), Image.NEAREST).split()
+    channel_spread = ImageChops.add(ImageChops.difference(r, g), ImageChops.difference(g, b))
+    return ImageStat.Stat(channel_spread).mean[0] < 6
+
+def _autocrop_margins(image):
+    """Trim uniform margins, using the top-left pixel as the background colour."""
+    rgb = image.convert("RGB")
+    background = Image.new("RGB", rgb.size, rgb.getpixel((0, 0)))
+    diff = ImageChops.difference(rgb, background).convert("L")
+    bbox = diff.point(lambda value: 255 if value > IMAGE_AUTOCROP_THRESHOLD else 0).getbbox()
+    if not bbox:
+        return image
+    left, top, right, bottom = bbox
+    return image.crop((
+        max(0, left - IMAGE_AUTOCROP_PADDING),
+        max(0, top - IMAGE_AUTOCROP_PADDING),
+        min(image.width, right + IMAGE_AUTOCROP_PADDING),
+        min(image.height, bottom + IMAGE_AUTOCROP_PADDING),
+    ))
+
+def _flatten_alpha(image):
+    """Composite a transparent image onto white, so transparent areas read as background, not black."""
+    rgba = image.convert("RGBA")
+    background = Image.new("RGB", rgba.size, (255, 255, 255))
+    background.paste(rgba, mask=rgba.getchannel("A"))
+    return background
+
+def _line_art_palette_image(image):
+    """
+    Palette version of a text/line-art image for PNG. Grayscale is mapped to
+    IMAGE_LINE_ART_GRAY_LEVELS evenly spaced tones with a lookup table, and
+    color goes through the fast octree quantizer: both keep the bytes of a
+    median-cut quantize at a fraction of its time, which dominated encoding.
+    """
+    if image.mode != "L":
+        return image.quantize(256, method=Image.Quantize.FASTOCTREE)
+    top = IMAGE_LINE_ART_GRAY_LEVELS - 1
+    palette_image = image.point([round(value * top / 255) for value in range(256)]).convert("P")
+    palette_image.putpalette([round(level * 255 / top) for level in range(IMAGE_LINE_ART_GRAY_LEVELS) for _ in range(3)])
+    return palette_image
+
+def preprocess_image(image, options):
+    """
+    Shrink a PIL image for upload: auto-crop margins, downscale to the model's
+    max side, optionally convert to grayscale, and re-encode without EXIF.
+    Line art and text are saved as PNG, photos as JPEG at an adaptive quality.
+
+    Returns:
+        tuple: (encoded bytes, MIME type, final (width, height))
+    """
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ("RGBA", "LA", "P"):
+        image = _flatten_alpha(image)
+    if options["autocrop"]:
+        image = _autocrop_margins(image)
+    if max(image.size) > options["max_side"]:
+        image.thumbnail((options["max_side"], options["max_side"]), Image.LANCZOS)
+    if options["grayscale"]:
+        image = image.convert("L")
+    elif image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    buffer = io.BytesIO()
+    if _is_line_art(image):
+        # Text and line art only need a few tones; a small palette keeps edges exact
+        if image.mode != "L" and _is_grayscale_content(image):
+            image = image.convert("L")
+        _line_art_palette_image(image).save(buffer, format="PNG", bits=4 if image.mode == "L" else 8)
+        return buffer.getvalue(), "image/png", image.size
+    for quality in IMAGE_PHOTO_JPEG_QUALITIES:
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=quality, optimize=True)
+        if buffer.tell() <= IMAGE_PHOTO_TARGET_BYTES:
+            break
+    return buffer.getvalue(), "image/jpeg", image.size
+
+def parse_page_selection(selection_str, total_pages):
+    """
+    Parse a comma-separated page selection string like '1-5, 8, 12, 34' into
+    a sorted list of 0-based page indices. Returns (list, error_msg).
+    """
+    if not selection_str or not selection_str.strip():
+        return [], "Please enter at least one page number."
+    pages = set()
+    for part in selection_str.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        range_match = re.match(r"^(\d+)\s*-\s*(\d+)$", part)
+        if range_match:
+            start, end = int(range_match.group(1)), int(range_match.group(2))
+            if start < 1 or end < 1:
+                return [], f"Page numbers must be positive (got '{part}')."
+            if start > end:
+                return [], f"Invalid range '{part}' — start must be ≤ end."
+            if end > total_pages:
+                return [], f"Page {end} exceeds the PDF's {total_pages} page(s)."
+            pages.update(range(start, end + 1))
+        elif re.match(r"^\d+$", part):
+            p = int(part)
+            if p < 1:
+                return [], "Page numbers must be positive."
+            if p > total_pages:
+                return [], f"Page {p} exceeds the PDF's {total_pages} page(s)."
+            pages.add(p)
+        else:
+            return [], f"Invalid entry '{part}'. Use numbers or ranges like '1-5'."
+    sorted_pages = sorted(pages)
+    indices = [p - 1 for p in sorted_pages]  # convert to 0-based
+    return indices, None
+
+def _render_page_in_worker(pdf_path, page_index, dpi, preprocess_options, clip=None):
+    """
+    Render-pool task: render and encode one page (or the `clip` rectangle of it,
+    in points) of the PDF at `pdf_path`. The document stays open in the worker
+    process for later pages of the same file.
+
+    Returns:
+        tuple: (image_bytes, mime_type, {stage: seconds})
+    """
+    timings = {}
+    doc = _worker_documents.get(pdf_path)
+    if doc is None:
+        started = time.perf_counter()
+        doc = _worker_documents[pdf_path] = fitz.open(pdf_path)
+        timings["fitz_open"] = time.perf_counter() - started
+        while len(_worker_documents) > PDF_RENDER_WORKER_MAX_DOCUMENTS:
+            _worker_documents.popitem(last=False)[1].close()
+    else:
+        _worker_documents.move_to_end(pdf_path)
+    started = time.perf_counter()
+    pix = doc.load_page(page_index).get_pixmap(dpi=dpi, clip=clip)
+    timings["get_pixmap"] = time.perf_counter() - started
+    started = time.perf_counter()
+    if preprocess_options and preprocess_options["enabled"]:
+        image = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+        image_bytes, mime_type, _ = preprocess_image(image, preprocess_options)
+        timings["preprocess"] = time.perf_counter() - started
+    else:
+        image_bytes, mime_type = pix.tobytes("png"), "image/png"
+        timings["tobytes_png"] = time.perf_counter() - started
+    return image_bytes, mime_type, timings
+
+def _page_render_specs(page_indices, page_resolutions=None):
+    """
+    (page_index, dpi, clip) for every image to render: one per page, or one per
+    strip of a page that `page_resolutions` splits (see `plan_pdf_page_resolutions`).
+    """
+    specs = []
+    for idx in page_indices:
+        resolution = (page_resolutions or {}).get(idx)
+        if resolution is None:
+            specs.append((idx, PDF_RENDER_DPI, None))
+        else:
+            specs.extend((idx, resolution["dpi"], clip) for clip in resolution["clips"] or [None])
+    return specs
+
+def _iter_rendered_pages(documents, entry, render_specs, preprocess_options, metrics):
+    """Render pages one at a time in this process; yields (page_index, image_bytes, mime_type)."""
+    preprocess = bool(preprocess_options and preprocess_options["enabled"])
+    signature = preprocess_signature(preprocess_options)
+    for idx, dpi, clip in render_specs:
+        page_key = (entry["digest"], idx, dpi, signature, clip)
+        cached_page = documents.get_page(page_key)
+        if cached_page is not None:
+            image_bytes, mime_type = cached_page
+        else:
+            with _FITZ_LOCK:
+                with _stage(metrics, "get_pixmap"):
+                    pix = entry["doc"].load_page(idx).get_pixmap(dpi=dpi, clip=clip)
+                if preprocess:
+                    image = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+                else:
+                    with _stage(metrics, "tobytes_png"):
+                        image_bytes, mime_type = pix.tobytes("png"), "image/png"
+            if preprocess:
+                with _stage(metrics, "preprocess"):
+                    image_bytes, mime_type, _ = preprocess_image(image, preprocess_options)
+            documents.put_page(page_key, image_bytes, mime_type)
+        yield idx, image_bytes, mime_type
+
+def _iter_rendered_pages_in_pool(documents, entry, pdf_bytes, render_specs, preprocess_options, workers, metrics):
+    """
+    Render pages in the render process pool, keeping up to 2 * `workers` pages
+    in flight, and yield (page_index, image_bytes, mime_type) in page order.
+    """
+    signature = preprocess_signature(preprocess_options)
+    pool = get_render_pool(workers)
+    pending = collections.deque()  # (page_index, page_key, (bytes, mime) or Future)
+
+    def _resolve(item):
+        idx, page_key, page = item
+        if isinstance(page, Future):
+            image_bytes, mime_type, timings = page.result()
+            if metrics:
+                for stage, seconds in timings.items():
+                    metrics.observe(stage, seconds)
+            documents.put_page(page_key, image_bytes, mime_type)
+            page = (image_bytes, mime_type)
+        return (idx, *page)
+
+    try:
+        for idx, dpi, clip in render_specs:
+            page_key = (entry["digest"], idx, dpi, signature, clip)
+            page = documents.get_page(page_key)
+            if page is None:
+                page = pool.submit(
+                    _render_page_in_worker, documents.file_path(entry, pdf_bytes), idx, dpi, preprocess_options, clip
+                )
+            pending.append((idx, page_key, page))
+            while len(pending) > 2 * workers:
+                yield _resolve(pending.popleft())
+        while pending:
+            yield _resolve(pending.popleft())
+    finally:
+        for _, _, page in pending:  # the caller stopped early
+            if isinstance(page, Future):
+                page.cancel()
+
+def iter_pdf_page_data_urls(pdf_bytes, page_indices, preprocess_options=None, metrics=None, pdf_digest=None,
+                            render_workers=None, page_resolutions=None):
+    """
+    Render specific pages of a PDF one at a time, yielding (page_index, data_url)
+    so callers never need to hold more than the pages they are working on.
+    Pages are preprocessed like uploaded images when preprocessing is enabled.
+    The parsed document and the rendered pages come from, and go to, the
+    process-wide PdfDocumentCache.
+    With `metrics`, records fitz_open, get_pixmap, tobytes_png or preprocess,
+    and b64encode timings (time spent waiting for the PyMuPDF lock is excluded).
+    Pass `pdf_digest` when the caller already has the content hash.
+
+    With `render_workers` > 0 (default: PDF_RENDER_WORKERS), pages are rendered
+    and encoded in that many worker processes, which open a temporary copy of
+    the PDF themselves; results are still yielded in page order.
+
+    With `page_resolutions` (see `plan_pdf_page_resolutions`), pages are rendered
+    at their own DPI, and a page split into strips yields one data URL per strip,
+    top to bottom. Other pages are rendered at PDF_RENDER_DPI.
+    """
+    if render_workers is None:
+        render_workers = PDF_RENDER_WORKERS
+    render_specs = _page_render_specs(page_indices, page_resolutions)
+    documents = get_pdf_document_cache()
+    with documents.document(pdf_bytes, pdf_digest, metrics) as entry:
+        if render_workers > 0:
+            pages = _iter_rendered_pages_in_pool(
+                documents, entry, pdf_bytes, render_specs, preprocess_options, render_workers, metrics
+            )
+        else:
+            pages = _iter_rendered_pages(documents, entry, render_specs, preprocess_options, metrics)
+        for idx, image_bytes, mime_type in pages:
+            with _stage(metrics, "b64encode"):
+                b64 = base64.b64encode(image_bytes).decode("utf-8")
+            yield idx, f"data:{mime_type};base64,{b64}"
+
+def pdf_pages_to_data_urls(pdf_bytes, page_indices, preprocess_options=None, metrics=None, pdf_digest=None,
+                           render_workers=None, page_resolutions=None):
+    """
+    Convert specific pages of a PDF to base64 image data URLs.
+    """
+    return [
+        data_url
+        for _, data_url in iter_pdf_page_data_urls(
+            pdf_bytes, page_indices, preprocess_options, metrics, pdf_digest, render_workers, page_resolutions
+        )
+    ]
+
+def _image_coverage(page):
+    """Share of the page area covered by placed images (overlaps are counted once per image)."""
+    page_rect = page.rect
+    page_area = page_rect.width * page_rect.height
+    if not page_area:
+        return 0.0
+    covered = 0.0
+    for info in page.get_image_info():
+        bbox = fitz.Rect(info["bbox"]) & page_rect
+        if not bbox.is_empty:
+            covered += bbox.width * bbox.height
+    return min(1.0, covered / page_area)
+
+def classify_pdf_page(page):
+    """
+    Decide whether a page can be read from its embedded text layer or needs
+    vision OCR. Must be called with _FITZ_LOCK held.
+
+    Returns:
+        tuple: ("text_layer" or "vision", short human-readable reason)
+    """
+    text = page.get_text("text")
+    chars = [ch for ch in text if not ch.isspace()]
+    if len(chars) < PDF_TEXT_LAYER_MIN_CHARS:
+        return "vision", "no usable text layer"
+    unreadable = sum(1 for ch in chars if ch == "\ufffd" or ord(ch) < 32)
+    if 1 - unreadable / len(chars) < PDF_TEXT_LAYER_MIN_READABLE_RATIO:
+        return "vision", "text layer has unmapped glyphs"
+    if any(font[3] in PDF_TEXT_LAYER_OCR_FONTS for font in page.get_fonts()):
+        return "vision", "scan with an OCR text layer"
+    coverage = _image_coverage(page)
+    if coverage > PDF_TEXT_LAYER_MAX_IMAGE_COVERAGE:
+        return "vision", f"images cover {coverage:.0%} of the page"
+    return "text_layer", "born-digital text"
+
+def extract_page_text_layer(page):
+    """
+    Convert a page's text layer to light Markdown: one paragraph per text
+    block, with noticeably larger text turned into headings. Must be called
+    with _FITZ_LOCK held.
+    """
+    blocks = [
+        block for block in page.get_text("dict", sort=True)["blocks"]
+        if block["type"] == 0
+    ]
+    size_weights = {}
+    for block in blocks:
+        for line in block["lines"]:
+            for span in line["spans"]:
+                size = round(span["size"])
+                size_weights[size] = size_weights.get(size, 0) + len(span["text"].strip())
+    body_size = max(size_weights, key=size_weights.get) if size_weights else 0
+
+    paragraphs = []
+    for block in blocks:
+        lines = ["".join(span["text"] for span in line["spans"]).rstrip() for line in block["lines"]]
+        text = "\n".join(line for line in lines if line.strip())
+        if not text:
+            continue
+        block_size = max(span["size"] for line in block["lines"] for span in line["spans"])
+        if body_size and block_size >= body_size * PDF_TEXT_LAYER_HEADING_SCALE and len(text) <= 120:
+            level = "#" if block_size >= body_size * 1.6 else "##"
+            text = f"{level} {' '.join(text.split())}"
+        paragraphs.append(text)
+    return "\n\n".join(paragraphs)
+
+def read_pdf_text_layers(pdf_bytes, page_indices, metrics=None, pdf_digest=None):
+    """
+    Classify the given pages and extract the text layer of the born-digital ones.
+
+    Returns:
+        dict: page_index -> {"method": "text_layer" or "vision", "reason": str,
+              "content": extracted Markdown, or None for vision pages}
+    """
+    pages = {}
+    with get_pdf_document_cache().document(pdf_bytes, pdf_digest, metrics) as entry, _FITZ_LOCK:
+        known = entry["text_layers"]  # classifications are reused across reruns and content types
+        for idx in page_indices:
+            if idx not in known:
+                with _stage(metrics, "text_layer"):
+                    page = entry["doc"].load_page(idx)
+                    method, reason = classify_pdf_page(page)
+                    content = extract_page_text_layer(page) if method == "text_layer" else None
+                if method == "text_layer" and not content.strip():
+                    method, reason, content = "vision", "no usable text layer", None
+                known[idx] = {"method": method, "reason": reason, "content": content}
+            pages[idx] = dict(known[idx])
+    return pages
+
+def fingerprint_page_image(image):
+    """
+    Fingerprint a grayscale ("L") page image for duplicate and blank detection.
+
+    Returns:
+        dict: {"dhash": 256-bit difference hash (int), "size": image size, "blank": bool}
+    """
+    side = PDF_DHASH_SIZE
+    pixels = list(image.resize((side + 1, side), Image.LANCZOS).tobytes())
+    dhash = 0
+    for row in range(side):
+        for col in range(side):
+            position = row * (side + 1) + col
+            dhash = (dhash << 1) | (pixels[position] > pixels[position + 1])
+    histogram = image.histogram()
+    background = max(range(256), key=histogram.__getitem__)
+    ink = sum(histogram[:max(0, background - PDF_BLANK_INK_LEVEL)]) + sum(histogram[background + PDF_BLANK_INK_LEVEL + 1:])
+    return {"dhash": dhash, "size": image.size, "blank": ink / (image.width * image.height) < PDF_BLANK_MAX_INK_RATIO}
+
+def _render_gray(page, long_side):
+    """Grayscale PIL render of a fitz page scaled to `long_side` pixels. Call with _FITZ_LOCK held."""
+    scale = long_side / max(page.rect.width, page.rect.height, 1)
+    pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), colorspace=fitz.csGRAY, alpha=False)
+    return Image.frombytes("L", (pix.width, pix.height), pix.samples)
+
+def fingerprint_pdf_pages(pdf_bytes, page_indices, metrics=None, pdf_digest=None):
+    """
+    Fingerprint pages from small grayscale renders (see `fingerprint_page_image`),
+    which cost a fraction of a full render. Fingerprints are kept with the open
+    document, so reruns and other content types reuse them.
+
+    Returns:
+        dict: page_index -> fingerprint
+    """
+    fingerprints = {}
+    with get_pdf_document_cache().document(pdf_bytes, pdf_digest, metrics) as entry, _FITZ_LOCK:
+        known = entry["fingerprints"]
+        for idx in page_indices:
+            if idx not in known:
+                with _stage(metrics, "fingerprint"):
+                    known[idx] = fingerprint_page_image(_render_gray(entry["doc"].load_page(idx), PDF_FINGERPRINT_SIDE))
+            fingerprints[idx] = known[idx]
+    return fingerprints
+
+def pages_match(image, other):
+    """Whether two page renders show the same content, up to PDF_DUPLICATE_MAX_MISMATCHED_PIXELS."""
+    if image.size != other.size:
+        return False
+    mismatched = sum(ImageChops.difference(image, other).histogram()[PDF_DUPLICATE_PIXEL_DIFF + 1:])
+    return mismatched <= PDF_DUPLICATE_MAX_MISMATCHED_PIXELS
+
+def find_repeated_pages(pdf_bytes, page_indices, metrics=None, pdf_digest=None):
+    """
+    Find blank pages and near-identical repeats among `page_indices`. The first
+    page of each group of near-duplicates is its representative.
+
+    Returns:
+        tuple: (duplicate_of dict mapping each repeated page index to its
+        representative's index, sorted list of blank page indices)
+    """
+    fingerprints = fingerprint_pdf_pages(pdf_bytes, page_indices, metrics, pdf_digest)
+    duplicate_of, blank_pages, representatives = {}, [], []
+    renders = {}  # confirmation renders of pages that had a candidate; dropped once a page is a duplicate
+
+    with get_pdf_document_cache().document(pdf_bytes, pdf_digest, metrics) as entry:
+        def _confirm_render(idx):
+            if idx not in renders:
+                with _FITZ_LOCK, _stage(metrics, "fingerprint"):
+                    renders[idx] = _render_gray(entry["doc"].load_page(idx), PDF_DUPLICATE_CONFIRM_SIDE)
+            return renders[idx]
+
+        for idx in page_indices:
+            fingerprint = fingerprints[idx]
+            if fingerprint["blank"]:
+                blank_pages.append(idx)
+                continue
+            for representative in representatives:
+                candidate = fingerprints[representative]
+                if (
+                    fingerprint["size"] == candidate["size"]
+                    and (fingerprint["dhash"] ^ candidate["dhash"]).bit_count() <= PDF_DUPLICATE_MAX_HASH_DISTANCE
+                    and pages_match(_confirm_render(idx), _confirm_render(representative))
+                ):
+                    duplicate_of[idx] = representative
+                    renders.pop(idx, None)  # only representatives are compared again
+                    break
+            else:
+                representatives.append(idx)
+    return duplicate_of, sorted(blank_pages)
+
+def format_page_reference(page_number, content_type):
+    """A note, in the output format of the content type, that a page repeats `page_number`."""
+    if content_type == "LaTeX Equation Conversion":
+        return f"% Same content as page {page_number}."
+    if content_type == "Code Snippet Extraction":
+        return f"# Same content as page {page_number}."
+    return f"_Same content as page {page_number}._"
+
+def repeated_page_results(duplicate_of, blank_pages, chunk_results, content_type):
+    """
+    Chunk results for pages that were not sent: blank pages come back empty, and
+    each near-duplicate reuses its representative's output when the representative
+    had a request of its own, or else refers to it.
+
+    Args:
+        chunk_results (list): Results of the chunks that were sent (with "pages", "content", "error").
+
+    Returns:
+        list: One chunk result per blank or repeated page.
+    """
+    by_page = {page: chunk for chunk in chunk_results for page in chunk["pages"]}
+    results = [
+        {"pages": [idx + 1], "content": "", "error": None, "sent_bytes": 0, "cached": False,
+         "method": "blank", "reason": "blank page"}
+        for idx in blank_pages
+    ]
+    for idx, representative in duplicate_of.items():
+        source = by_page.get(representative + 1)
+        if source is not None and source["pages"] == [representative + 1]:
+            content, error = source["content"], source["error"]
+        else:
+            content, error = format_page_reference(representative + 1, content_type), None
+        results.append({
+            "pages": [idx + 1], "content": content, "error": error, "sent_bytes": 0, "cached": False,
+            "method": "duplicate", "reason": f"near-duplicate of page {representative + 1}",
+        })
+    return results
+
+def measure_text_lines(image):
+    """
+    Measure the text lines of a grayscale ("L") image from its horizontal ink
+    profile: pixel rows with enough ink belong to a line, empty rows separate lines.
+
+    Returns:
+        dict: {"line_height": median line height in px, or None when fewer than
+        RESOLUTION_MIN_LINES lines were found, "pitch": median distance in px
+        between the tops of consecutive lines (or None), "gaps": centres in px of
+        the empty bands between lines, top to bottom}
+    """
+    histogram = image.histogram()
+    background = max(range(256), key=histogram.__getitem__)
+    ink = image.point([255 if abs(level - background) > PDF_BLANK_INK_LEVEL else 0 for level in range(256)])
+    profile = list(ink.resize((1, image.height), Image.BOX).tobytes())  # mean ink of each pixel row
+    min_ink = 255 * RESOLUTION_ROW_MIN_INK_RATIO
+    lines, gaps = [], []
+    start = gap_start = None
+    for row, value in enumerate(profile + [0]):
+        if value > min_ink and start is None:
+            start = row
+            if gap_start is not None and lines:
+                gaps.append((gap_start + row) / 2)
+        elif value <= min_ink and start is not None:
+            if row - start >= 2:  # thinner runs are rules and specks
+                lines.append((start, row))
+            start, gap_start = None, row
+    if len(lines) < RESOLUTION_MIN_LINES:
+        return {"line_height": None, "pitch": None, "gaps": gaps}
+    return {
+        "line_height": statistics.median(bottom - top for top, bottom in lines),
+        "pitch": statistics.median(lines[i + 1][0] - lines[i][0] for i in range(len(lines) - 1)),
+        "gaps": gaps,
+    }
+
+def _scale_text_lines(text_lines, factor):
+    """`measure_text_lines` result converted to other units (multiplied by `factor`)."""
+    return {
+        "line_height": text_lines["line_height"] and text_lines["line_height"] * factor,
+        "pitch": text_lines["pitch"] and text_lines["pitch"] * factor,
+        "gaps": [gap * factor for gap in text_lines["gaps"]],
+    }
+
+def _last_gap_between(gaps, low, high):
+    """Lowest gap on the page (largest position) within [low, high], or None."""
+    inside = [gap for gap in gaps if low <= gap <= high]
+    return inside[-1] if inside else None
+
+def plan_resolution(width, height, text_lines, max_side, min_scale, max_scale, default_scale, tile=True):
+    """
+    Choose how to send a page or image of `width` x `height` source units, given
+    its text lines measured in the same units (see `measure_text_lines`).
+
+    The scale (output pixels per source unit) brings the typical line to
+    RESOLUTION_TARGET_LINE_PX, within [min_scale, max_scale]. When that is larger
+    than `max_side` but the lines are still readable (RESOLUTION_MIN_LINE_PX)
+    at `max_side`, the whole page is sent at `max_side`. Otherwise, with `tile`,
+    it is cut into full-width strips of at most `max_side` pixels that overlap by
+    RESOLUTION_TILE_OVERLAP_LINES lines, with cuts moved into the gaps between
+    lines where possible. Without text lines, `default_scale` is kept.
+
+    Returns:
+        dict: {"scale": float, "bands": list of (top, bottom) in source units, or
+        None to send the whole page}
+    """
+    line_height = text_lines["line_height"] if text_lines else None
+    if not line_height:
+        return {"scale": default_scale, "bands": None}
+    wanted = min(max(RESOLUTION_TARGET_LINE_PX / line_height, min_scale), max_scale)
+    fit = max_side / max(width, height)
+    if max(width, height) * wanted <= max_side:
+        return {"scale": wanted, "bands": None}
+    if line_height * fit >= RESOLUTION_MIN_LINE_PX or not tile:
+        return {"scale": fit, "bands": None}
+
+    scale = min(wanted, max_side / width)
+    strip = max_side / scale
+    overlap = min(RESOLUTION_TILE_OVERLAP_LINES * (text_lines["pitch"] or 2 * line_height), strip / 8)
+    if (height - overlap) / (strip - overlap) > RESOLUTION_MAX_TILES:
+        strip = (height - overlap) / RESOLUTION_MAX_TILES + overlap
+        scale = max_side / strip
+    bands, top = [], 0.0
+    while top + strip < height and len(bands) < RESOLUTION_MAX_TILES - 1:
+        bottom = _last_gap_between(text_lines["gaps"], top + strip / 2, top + strip) or top + strip
+        bands.append((top, bottom))
+        top = _last_gap_between(text_lines["gaps"], bottom - 2 * overlap, bottom - overlap) or bottom - overlap
+    bands.append((top, height))
+    return {"scale": scale, "bands": [(round(top, 1), round(bottom, 1)) for top, bottom in bands]}
+
+def plan_pdf_page_resolutions(pdf_bytes, page_indices, content_type, max_side, metrics=None, pdf_digest=None):
+    """
+    Adaptive render resolution for PDF pages (see `plan_resolution`): the DPI for
+    each page, and the strips of pages whose print is too small to read at
+    `max_side` pixels. Only content types in RESOLUTION_TILE_CONTENT_TYPES are
+    split. Text lines are measured once per page on a RESOLUTION_PROBE_DPI
+    grayscale render and kept with the open document.
+
+    Returns:
+        dict: page_index -> {"dpi": int, "clips": list of (x0, y0, x1, y1) strips
+        in points, or None to render the whole page}
+    """
+    plans = {}
+    with get_pdf_document_cache().document(pdf_bytes, pdf_digest, metrics) as entry, _FITZ_LOCK:
+        known = entry["text_lines"]
+        for idx in page_indices:
+            if idx not in known:
+                with _stage(metrics, "text_density"):
+                    page = entry["doc"].load_page(idx)
+                    long_side = max(page.rect.width, page.rect.height) * RESOLUTION_PROBE_DPI / 72
+                    text_lines = measure_text_lines(_render_gray(page, long_side))
+                known[idx] = (page.rect.width, page.rect.height, _scale_text_lines(text_lines, 72 / RESOLUTION_PROBE_DPI))
+            width, height, text_lines = known[idx]
+            plan = plan_resolution(
+                width, height, text_lines, max_side, PDF_ADAPTIVE_MIN_DPI / 72, PDF_ADAPTIVE_MAX_DPI / 72,
+                PDF_RENDER_DPI / 72, tile=content_type in RESOLUTION_TILE_CONTENT_TYPES,
+            )
+            plans[idx] = {
+                "dpi": max(1, round(plan["scale"] * 72)),
+                "clips": [(0, top, width, bottom) for top, bottom in plan["bands"]] if plan["bands"] else None,
+            }
+    return plans
+
+def plan_image_resolution(image, content_type, max_side):
+    """
+    Adaptive resolution for an uploaded image, in its own pixels (see
+    `plan_resolution`). Images are never enlarged, and photos are left alone.
+
+    Returns:
+        dict or None: {"scale", "bands"}, or None to send the image as usual.
+    """
+    if not _is_line_art(image):
+        return None
+    probe_scale = min(1.0, RESOLUTION_IMAGE_PROBE_SIDE / max(image.size))
+    probe = image.convert("L")
+    if probe_scale < 1:
+        probe = probe.resize((max(1, round(image.width * probe_scale)), max(1, round(image.height * probe_scale))), Image.BOX)
+    text_lines = _scale_text_lines(measure_text_lines(probe), 1 / probe_scale)
+    return plan_resolution(
+        image.width, image.height, text_lines, max_side, min(1.0, RESOLUTION_IMAGE_MIN_SIDE / max(image.size)), 1.0,
+        1.0, tile=content_type in RESOLUTION_TILE_CONTENT_TYPES,
+    )
+
+def _normalized_line(line):
+    """A line of model output reduced to its words, for comparing two readings of the same line."""
+    return " ".join(line.strip().lstrip("#>*-+|` ").lower().split())
+
+def stitch_strip_texts(texts):
+    """
+    Join the replies for consecutive strips of one page. Lines at the start of a
+    strip that repeat the end of the previous one (read twice in the overlap)
+    are dropped, and code blocks split across strips are joined into one.
+    """
+    texts = [text or "" for text in texts]
+    fences = [_split_code_fence(text) for text in texts]
+    fenced = all(fence is not None for fence, _ in fences)
+    merged = []
+    for text, (_, body) in zip(texts, fences):
+        lines = (body if fenced else text).strip("\n").splitlines()
+        previous = [line for line in merged if line.strip()][-RESOLUTION_STITCH_MAX_LINES:]
+        current = [(position, line) for position, line in enumerate(lines) if line.strip()][:RESOLUTION_STITCH_MAX_LINES]
+        skip = 0
+        for length in range(min(len(previous), len(current)), 0, -1):
+            if all(
+                difflib.SequenceMatcher(None, _normalized_line(old), _normalized_line(new)).ratio()
+                >= RESOLUTION_STITCH_MIN_SIMILARITY
+                for old, (_, new) in zip(previous[-length:], current[:length])
+            ):
+                skip = current[length - 1][0] + 1
+                break
+        merged.extend(lines[skip:])
+    text = "\n".join(merged).strip()
+    return f"{fences[0][0]}\n{text}\n```" if fenced and fences else text
+
+def format_page_ranges(page_numbers):
+    """Compact page list such as "1–3, 7, 9–10"."""
+    ranges = []
+    for page in sorted(page_numbers):
+        if ranges and page == ranges[-1][1] + 1:
+            ranges[-1][1] = page
+        else:
+            ranges.append([page, page])
+    return ", ".join(str(a) if a == b else f"{a}–{b}" for a, b in ranges)
+
+def iter_in_background(iterable, max_buffered):
+    """
+    Run `iterable` in a producer thread and yield its items through a bounded queue.
+    The producer blocks once `max_buffered` items are waiting, which gives the
+    consumer backpressure. Producer exceptions are re-raised in the consumer.
+    """
+    buffer = queue.Queue(maxsize=max(1, int(max_buffered)))
+    stop = threading.Event()
+    end_marker = object()
+
+    def _put(entry):
+        while not stop.is_set():
+            try:
+                buffer.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce():
+        try:
+            for item in iterable:
+                if not _put((item, None)):
+                    return
+        except Exception as e:  # handed over to the consumer
+            _put((end_marker, e))
+            return
+        _put((end_marker, None))
+
+    producer = threading.Thread(target=_produce, name="pdf-render-producer", daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if item is end_marker:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+def chunk_page_indices(page_indices, pages_per_request):
+    """
+    Split page indices into consecutive chunks of at most `pages_per_request` pages.
+    """
+    size = max(1, int(pages_per_request))
+    return [page_indices[i:i + size] for i in range(0, len(page_indices), size)]
+
+def estimate_image_tokens(width, height, model_id):
+    """Rough vision-token cost of one image for `model_id`, from its tiling scheme in MODEL_IMAGE_TOKEN_COST."""
+    tile_side, tokens_per_tile, max_tiles = MODEL_IMAGE_TOKEN_COST.get(model_id, DEFAULT_IMAGE_TOKEN_COST)
+    tiles = -(-width // tile_side) * -(-height // tile_side)
+    if max_tiles:
+        tiles = min(tiles, max_tiles)
+    return tiles * tokens_per_tile
+
+def estimate_pdf_page_sizes(pdf_bytes, page_indices, preprocess_options=None, pdf_digest=None, page_resolutions=None):
+    """
+    Pixel size of each page once rendered at PDF_RENDER_DPI (or its DPI in
+    `page_resolutions`) and downscaled to the model's max side, read from the
+    page geometry without rendering anything.
+
+    Returns:
+        dict: page_index -> (width, height)
+    """
+    preprocess = bool(preprocess_options and preprocess_options["enabled"])
+    sizes = {}
+    with get_pdf_document_cache().document(pdf_bytes, pdf_digest) as entry, _FITZ_LOCK:
+        for idx in page_indices:
+            rect = entry["doc"].load_page(idx).rect
+            dpi = (page_resolutions or {}).get(idx, {}).get("dpi", PDF_RENDER_DPI)
+            width, height = rect.width * dpi / 72, rect.height * dpi / 72
+            if preprocess and max(width, height) > preprocess_options["max_side"]:
+                scale = preprocess_options["max_side"] / max(width, height)
+                width, height = width * scale, height * scale
+            sizes[idx] = (max(1, round(width)), max(1, round(height)))
+    return sizes
+
+def pack_pages_by_budget(page_indices, page_costs, limits, max_pages=PDF_PACK_MAX_PAGES):
+    """
+    Group pages, in order, into chunks whose summed costs stay within `limits`
+    and `max_pages`. A page that exceeds a limit on its own is sent alone.
+
+    Args:
+        page_costs (dict): page_index -> tuple of costs, one per entry of `limits`.
+        limits (tuple): Largest total of each cost per chunk.
+
+    Returns:
+        list: Chunks (lists of page indices).
+    """
+    chunks, current, totals = [], [], [0] * len(limits)
+    for idx in page_indices:
+        costs = page_costs[idx]
+        if current and (
+            len(current) >= max_pages
+            or any(total + cost > limit for total, cost, limit in zip(totals, costs, limits))
+        ):
+            chunks.append(current)
+            current, totals = [], [0] * len(limits)
+        current.append(idx)
+        totals = [total + cost for total, cost in zip(totals, costs)]
+    if current:
+        chunks.append(current)
+    return chunks
+
+def plan_pdf_chunks(pdf_bytes, page_indices, model_id, pages_per_request=None, preprocess_options=None, pdf_digest=None,
+                    page_resolutions=None):
+    """
+    Split pages into request chunks: fixed chunks of `pages_per_request` pages,
+    or, when it is None, chunks packed to the model's image-token and payload
+    budgets in MODEL_REQUEST_BUDGETS. Auto requests may land on any model, so
+    their chunks must fit every model's budget.
+
+    With `page_resolutions`, pages are sized at their own DPI, and every page
+    split into strips is a chunk of its own (its strips are sent separately).
+    """
+    tiled = {idx for idx, resolution in (page_resolutions or {}).items() if resolution["clips"]}
+    if tiled.intersection(page_indices):
+        chunks, run = [], []
+        for idx in list(page_indices) + [None]:
+            if idx is None or idx in tiled:
+                if run:
+                    chunks += plan_pdf_chunks(
+                        pdf_bytes, run, model_id, pages_per_request, preprocess_options, pdf_digest, page_resolutions
+                    )
+                    run = []
+                if idx is not None:
+                    chunks.append([idx])
+            else:
+                run.append(idx)
+        return chunks
+    if pages_per_request:
+        return chunk_page_indices(page_indices, pages_per_request)
+    if model_id in (AUTO_MODEL_ID, AUTO_HEDGED_MODEL_ID):
+        models = list(AVAILABLE_MODELS.values())
+    else:
+        models = [model_id]
+    budgets = [MODEL_REQUEST_BUDGETS.get(model, DEFAULT_REQUEST_BUDGET) for model in models]
+    preprocess = bool(preprocess_options and preprocess_options["enabled"])
+    bytes_per_pixel = PDF_PACK_BYTES_PER_PIXEL if preprocess else PDF_PACK_RAW_BYTES_PER_PIXEL
+    sizes = estimate_pdf_page_sizes(pdf_bytes, page_indices, preprocess_options, pdf_digest, page_resolutions)
+    page_costs = {
+        idx: tuple(estimate_image_tokens(width, height, model) for model in models) + (width * height * bytes_per_pixel,)
+        for idx, (width, height) in sizes.items()
+    }
+    limits = tuple(budget["image_tokens"] for budget in budgets) + (min(budget["payload_bytes"] for budget in budgets),)
+    return pack_pages_by_budget(page_indices, page_costs, limits)
+
+def request_image_strips(api_key, model_id, prompt_text, data_urls, metrics=None):
+    """
+    OCR the strips of one page or image (see `plan_resolution`), one request per
+    strip with up to RESOLUTION_TILE_MAX_IN_FLIGHT at a time, and stitch the
+    replies top to bottom (see `stitch_strip_texts`). Raises like
+    `post_chat_completion` when any strip fails.
+    """
+    count = len(data_urls)
+
+    def _request_strip(position):
+        strip_prompt = RESOLUTION_STRIP_PROMPT.format(position=position + 1, count=count)
+        messages = [{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": f"{prompt_text}\n\n{strip_prompt}"},
+                {"type": "image_url", "image_url": {"url": data_urls[position]}},
+            ],
+        }]
+        response_json = post_chat_completion(api_key, model_id, messages, metrics=metrics)
+        return response_json['choices'][0]['message']['content']
+
+    with ThreadPoolExecutor(max_workers=min(count, RESOLUTION_TILE_MAX_IN_FLIGHT)) as executor:
+        texts = list(executor.map(_request_strip, range(count)))
+    with _stage(metrics, "stitch"):
+        return stitch_strip_texts(texts)
+
+def request_pdf_chunk(api_key, model_id, prompt_text, page_numbers, data_urls, partial_texts=None, metrics=None,
+                      flight_key=None):
+    """
+    Send one chunk of rendered PDF pages to the model in a single request.
+    A chunk with more images than pages is one page split into strips, which
+    are sent with `request_image_strips` instead (not streamed).
+    Runs in a worker thread, so errors are captured in the result instead of raised.
+
+    Args:
+        partial_texts (dict): Optional. When given, the reply is streamed and the
+            text received so far is kept in partial_texts[first_page_number].
+        flight_key (str): Optional. Joins an identical request already in flight
+            (see `SingleFlight`) instead of sending a new one.
+
+    Returns:
+        dict: {"pages": [...1-based page numbers...], "content": str or None,
+               "error": str or None, "sent_bytes": int, "shared": bool, "strips": int}
+    """
+    sent_bytes = sum(len(url) for url in data_urls)
+    strips = len(data_urls) if len(data_urls) > len(page_numbers) else 1
+    content_parts = [{"type": "text", "text": prompt_text}]
+    for url in data_urls:
+        content_parts.append({"type": "image_url", "image_url": {"url": url}})
+    messages = [{"role": "user", "content": content_parts}]
+
+    def _request():
+        if strips > 1:
+            return request_image_strips(api_key, model_id, prompt_text, data_urls, metrics)
+        if partial_texts is None:
+            response_json = post_chat_completion(api_key, model_id, messages, metrics=metrics)
+            return response_json['choices'][0]['message']['content']
+        content = ""
+        for delta in stream_chat_completion(api_key, model_id, messages, metrics=metrics):
+            content += delta
+            partial_texts[page_numbers[0]] = content
+        return content
+
+    try:
+        if flight_key is None:
+            content, shared = _request(), False
+        else:
+            content, shared = get_single_flight().do(flight_key, _request, metrics=metrics)
+        return {
+            "pages": page_numbers, "content": content, "error": None, "sent_bytes": 0 if shared else sent_bytes,
+            "shared": shared, "strips": strips,
+        }
+    except requests.exceptions.RequestException as e:
+        error = f"API Error: {e}"
+    except json.JSONDecodeError:
+        error = "Failed to decode JSON response from API."
+    except (KeyError, IndexError, TypeError):
+        error = "Unexpected response format from API."
+    finally:
+        if partial_texts is not None:
+            partial_texts.pop(page_numbers[0], None)
+    return {
+        "pages": page_numbers, "content": None, "error": error, "sent_bytes": sent_bytes, "shared": False, "strips": strips,
+    }
+
+def iter_pdf_chunks(pdf_bytes, chunks, preprocess_options=None, metrics=None, pdf_digest=None, render_workers=None,
+                    page_resolutions=None):
+    """
+    Yield (page_numbers, data_urls) for each chunk of page indices, rendering
+    each chunk only when it is requested. A page split into strips by
+    `page_resolutions` contributes one data URL per strip.
+    """
+    page_iter = iter_pdf_page_data_urls(
+        pdf_bytes, [idx for chunk in chunks for idx in chunk], preprocess_options, metrics, pdf_digest, render_workers,
+        page_resolutions,
+    )
+    for chunk in chunks:
+        data_urls = [next(page_iter)[1] for _ in _page_render_specs(chunk, page_resolutions)]
+        yield [idx + 1 for idx in chunk], data_urls
+
+def scan_pdf_pages_concurrently(api_key, model_id, prompt_text, pdf_bytes, chunks,
+                                 max_in_flight, on_chunk_done=None, on_stream_update=None,
+                                 preprocess_options=None, metrics=None, pdf_digest=None, flight_keys=None,
+                                 render_workers=None, page_resolutions=None):
+    """
+    Scan PDF page chunks (lists of 0-based page indices, one request each), with
+    at most `max_in_flight` requests running at the same time.
+
+    Pages are rendered by a single producer thread (PyMuPDF calls are serialized,
+    unless `render_workers` moves rendering to worker processes) that runs at
+    most PDF_RENDER_PREFETCH_CHUNKS chunks ahead of the request stage, so peak
+    memory is bounded by the batch size rather than the document.
+
+    Args:
+        on_chunk_done (callable): Optional. Called from the calling thread as
+            on_chunk_done(completed_count, total_count, chunk_result) after each
+            chunk finishes, in completion order.
+        on_stream_update (callable): Optional. When given, replies are streamed and
+            on_stream_update({first_page_number: text_so_far}) is called from the
+            calling thread every PDF_STREAM_PREVIEW_INTERVAL_SECONDS while waiting.
+        preprocess_options (dict): Optional. Settings from `_image_preprocessing_options`.
+        metrics (StageMetrics): Optional. Collects rendering and request stage timings.
+        flight_keys (dict): Optional. {first_page_number: key}; chunks with a key
+            join identical requests already in flight (see `request_pdf_chunk`).
+        render_workers (int): Optional. Render processes (see `iter_pdf_page_data_urls`).
+        page_resolutions (dict): Optional. Per-page DPI and strips (see `plan_pdf_page_resolutions`).
+
+    Returns:
+        list: Chunk results (see `request_pdf_chunk`) in page order.
+    """
+    max_in_flight = max(1, int(max_in_flight))
+    total = len(chunks)
+    results = {}
+    in_flight = {}
+    partial_texts = {} if on_stream_update else None
+    wait_timeout = PDF_STREAM_PREVIEW_INTERVAL_SECONDS if on_stream_update else None
+
+    def _collect():
+        done, _ = wait(in_flight, timeout=wait_timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            result = future.result()
+            results[in_flight.pop(future)] = result
+            if on_chunk_done:
+                on_chunk_done(len(results), total, result)
+        if on_stream_update:
+            on_stream_update(dict(partial_texts))
+
+    rendered_chunks = iter_in_background(
+        iter_pdf_chunks(pdf_bytes, chunks, preprocess_options, metrics, pdf_digest, render_workers, page_resolutions),
+        PDF_RENDER_PREFETCH_CHUNKS,
+    )
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        for position, (page_numbers, data_urls) in enumerate(rendered_chunks):
+            while len(in_flight) >= max_in_flight:
+                _collect()
+            future = executor.submit(
+                request_pdf_chunk, api_key, model_id, prompt_text, page_numbers, data_urls, partial_texts, metrics,
+                (flight_keys or {}).get(page_numbers[0]),
+            )
+            in_flight[future] = position
+        while in_flight:
+            _collect()
+    return [results[position] for position in sorted(results)]
+
+def page_label_text(page_numbers):
+    """Plain "Page 3" / "Pages 3–5" / "Pages 3, 7" label for a chunk's page numbers."""
+    if len(page_numbers) == 1:
+        return f"Page {page_numbers[0]}"
+    if page_numbers[-1] - page_numbers[0] == len(page_numbers) - 1:
+        return f"Pages {page_numbers[0]}–{page_numbers[-1]}"
+    return "Pages " + ", ".join(str(page) for page in page_numbers)
+
+def format_page_label(page_numbers, content_type):
+    """
+    Build a page-boundary label that fits the output format of the content type.
+    """
+    label = page_label_text(page_numbers)
+    if content_type == "LaTeX Equation Conversion":
+        return f"% --- {label} ---"
+    if content_type == "Code Snippet Extraction":
+        return f"# --- {label} ---"
+    return f"### 📄 {label}"
+
+def chunk_separator(content_type):
+    """Text placed between the labelled sections of a merged result."""
+    return "\n\n" if content_type in ("LaTeX Equation Conversion", "Code Snippet Extraction") else "\n\n---\n\n"
+
+def format_chunk_section(chunk, content_type):
+    """One chunk's output under its page label; a failed chunk shows its error message."""
+    if chunk["error"] is None:
+        body = chunk["content"] or ""
+    else:
+        comment_prefix = {"LaTeX Equation Conversion": "% ", "Code Snippet Extraction": "# "}.get(content_type, "")
+        body = f"{comment_prefix}Error: {chunk['error']}"
+    return f"{format_page_label(chunk['pages'], content_type)}\n\n{body.strip()}"
+
+def merge_chunk_results(chunk_results, content_type):
+    """
+    Merge per-chunk outputs into one result string with page-boundary labels.
+    Failed chunks are kept in place with their error message.
+    """
+    return chunk_separator(content_type).join(format_chunk_section(chunk, content_type) for chunk in chunk_results)
+
+def _max_image_side(model_id, preprocess_options=None):
+    """Longest image side worth sending to `model_id`, from the preprocessing settings when given."""
+    if preprocess_options:
+        return preprocess_options["max_side"]
+    return MODEL_MAX_IMAGE_SIDE.get(model_id, DEFAULT_MAX_IMAGE_SIDE)
+
+def default_preprocess_options(model_id, enabled=True, grayscale=False, autocrop=True):
+    """Preprocessing settings for `model_id`, as accepted by `preprocess_image`."""
+    return {
+        "enabled": enabled,
+        "grayscale": grayscale,
+        "autocrop": autocrop,
+        "max_side": MODEL_MAX_IMAGE_SIDE.get(model_id, DEFAULT_MAX_IMAGE_SIDE),
+    }
+
+def encode_image_bytes(image_bytes, mime_type, preprocess_options=None, metrics=None):
+    """
+    Turn raw image bytes into a base64 data URL, preprocessing them first when
+    preprocessing is enabled. With `metrics`, records preprocess and b64encode timings.
+
+    Returns:
+        tuple: (data URL string, stats dict with original/sent bytes and (width, height) sizes)
+    """
+    original_bytes = image_bytes
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        original_size = sent_size = image.size
+        if preprocess_options and preprocess_options["enabled"]:
+            with _stage(metrics, "preprocess"):
+                processed_bytes, processed_type, sent_size = preprocess_image(image, preprocess_options)
+            # Keep the original if re-encoding didn't help and there was nothing to strip or shrink
+            if len(processed_bytes) < len(original_bytes) or sent_size != original_size or image.getexif():
+                image_bytes, mime_type = processed_bytes, processed_type
+            else:
+                sent_size = original_size
+    stats = {
+        "original_bytes": len(original_bytes),
+        "sent_bytes": len(image_bytes),
+        "original_size": original_size,
+        "sent_size": sent_size,
+    }
+    with _stage(metrics, "b64encode"):
+        base64_image = base64.b64encode(image_bytes).decode("utf-8")
+    return f"data:{mime_type};base64,{base64_image}", stats
+
+def encode_image_strips(image_bytes, mime_type, content_type, preprocess_options=None, metrics=None):
+    """
+    Like `encode_image_bytes`, but sized by the image's text (see
+    `plan_image_resolution`): large print is reduced, and print too small to
+    read at the model's max side is cut into strips.
+
+    Returns:
+        tuple: (list of data URLs, one per strip, top to bottom; stats dict as
+        from `encode_image_bytes`, plus "strips")
+    """
+    options = preprocess_options or default_preprocess_options(None, enabled=False)
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image = ImageOps.exif_transpose(image)
+        with _stage(metrics, "text_density"):
+            plan = plan_image_resolution(image, content_type, options["max_side"])
+        if plan is None or (plan["bands"] is None and plan["scale"] >= 1):
+            data_url, stats = encode_image_bytes(image_bytes, mime_type, preprocess_options, metrics)
+            return [data_url], {**stats, "strips": 1}
+        if image.mode in ("1", "P"):  # palette images would be resized without interpolation
+            image = image.convert("RGBA")
+        parts = [image.crop((0, round(top), image.width, round(bottom))) for top, bottom in plan["bands"] or [(0, image.height)]]
+        data_urls, sent_bytes, sent_sizes = [], 0, []
+        for part in parts:
+            part = part.resize(
+                (max(1, round(part.width * plan["scale"])), max(1, round(part.height * plan["scale"]))), Image.LANCZOS
+            )
+            with _stage(metrics, "preprocess"):
+                if options["enabled"]:
+                    part_bytes, part_type, part_size = preprocess_image(part, options)
+                else:
+                    buffer = io.BytesIO()
+                    _flatten_alpha(part).save(buffer, format="PNG")
+                    part_bytes, part_type, part_size = buffer.getvalue(), "image/png", part.size
+            with _stage(metrics, "b64encode"):
+                data_urls.append(f"data:{part_type};base64,{base64.b64encode(part_bytes).decode('utf-8')}")
+            sent_bytes += len(part_bytes)
+            sent_sizes.append(part_size)
+        stats = {
+            "original_bytes": len(image_bytes),
+            "sent_bytes": sent_bytes,
+            "original_size": image.size,
+            "sent_size": (max(width for width, _ in sent_sizes), sum(height for _, height in sent_sizes)),
+            "strips": len(parts),
+        }
+    return data_urls, stats
+
+def pdf_page_count(pdf_bytes, pdf_digest=None):
+    """Number of pages in a PDF document (parsed once, then served from the PdfDocumentCache)."""
+    with get_pdf_document_cache().document(pdf_bytes, pdf_digest) as entry:
+        return entry["page_count"]
+
+def estimate_tokens(text):
+    """Cheap token estimate for budgeting, without a model-specific tokenizer."""
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+def _summarize_turns(turns, max_tokens):
+    """
+    Condense dropped chat turns into a short recap, newest first until the
+    recap budget is used up. Extractive, so it costs no extra API call.
+    """
+    lines = []
+    used = 0
+    for msg in reversed(turns):
+        snippet = " ".join(msg["content"].split())
+        if len(snippet) > CHAT_SUMMARY_SNIPPET_CHARS:
+            snippet = snippet[:CHAT_SUMMARY_SNIPPET_CHARS].rstrip() + "…"
+        line = f"- {msg['role'].capitalize()}: {snippet}"
+        used += estimate_tokens(line)
+        if used > max_tokens:
+            break
+        lines.append(line)
+    if not lines:
+        return None
+    omitted = len(turns) - len(lines)
+    header = "Summary of earlier turns in this conversation about the image"
+    if omitted:
+        header += f" ({omitted} older message(s) omitted)"
+    return header + ":\n" + "\n".join(reversed(lines))
+
+def build_chat_messages(conversation, image_data_url, max_context_tokens=CHAT_CONTEXT_MAX_TOKENS,
+                        summary_max_tokens=CHAT_SUMMARY_MAX_TOKENS):
+    """
+    Build API messages for an image chat while keeping the request size flat
+    as the chat grows.
+
+    The first user message carries the image and is always kept, as is the
+    newest message. Other turns are kept newest first while they fit in
+    `max_context_tokens`; the rest are condensed into a recap sent as a system
+    message. The image itself is not counted against the budget.
+
+    Returns:
+        tuple: (messages list for the chat completion API, number of condensed turns)
+    """
+    if not conversation:
+        return [], 0
+    first, rest = conversation[0], conversation[1:]
+    budget = max_context_tokens - estimate_tokens(first["content"])
+    kept = []
+    for index in range(len(rest) - 1, -1, -1):
+        cost = estimate_tokens(rest[index]["content"])
+        if kept and cost > budget:
+            break
+        kept.append(rest[index])
+        budget -= cost
+    kept.reverse()
+    dropped = rest[:len(rest) - len(kept)]
+    # Keep user/assistant alternation after the first user message; the recap
+    # still covers a question whose turn is cut here
+    if dropped and len(kept) > 1 and kept[0]["role"] == "user":
+        dropped.append(kept.pop(0))
+
+    messages = []
+    summary = _summarize_turns(dropped, summary_max_tokens) if dropped else None
+    if summary:
+        messages.append({"role": "system", "content": summary})
+    messages.append({
+        "role": "user",
+        "content": [
+            {"type": "text", "text": first["content"]},
+            {"type": "image_url", "image_url": {"url": image_data_url}},
+        ],
+    })
+    messages.extend({"role": msg["role"], "content": msg["content"]} for msg in kept)
+    return messages, len(dropped)
+
+def image_cache_digests(image_bytes, preprocess_options=None, adaptive_resolution=False):
+    """Content digests of an image request for `result_cache_key`."""
+    digests = [sha256_hex(image_bytes), preprocess_signature(preprocess_options)]
+    if adaptive_resolution:
+        digests.append("adaptive")
+    return digests
+
+def ocr_image(api_key, model_id, image_bytes, mime_type, content_type, preprocess_options=None, cache=None,
+              metrics=None, adaptive_resolution=False):
+    """
+    Run one image through the model with the prompt for `content_type`.
+    Identical requests already in flight (same image, settings, model and
+    prompt) are joined instead of being sent again.
+
+    Args:
+        cache (ResultCache): Optional. Checked before and updated after the call.
+        metrics (StageMetrics): Optional. Collects encoding and request stage timings.
+        adaptive_resolution (bool): Optional. Size the image by its text, splitting
+            it into strips when needed (see `encode_image_strips`).
+
+    Returns:
+        dict: {"content": str, "cached": bool, "shared": bool, "stats": payload stats or None}
+    """
+    prompt_text = IMAGE_PROMPTS[content_type]
+    cache_key = result_cache_key(
+        image_cache_digests(image_bytes, preprocess_options, adaptive_resolution), model_id, prompt_text
+    )
+    cached_result = cache.get(cache_key) if cache else None
+    if cached_result is not None:
+        return {"content": cached_result, "cached": True, "shared": False, "stats": None}
+
+    def _request():
+        if adaptive_resolution:
+            data_urls, stats = encode_image_strips(image_bytes, mime_type, content_type, preprocess_options, metrics)
+            if len(data_urls) > 1:
+                return request_image_strips(api_key, model_id, prompt_text, data_urls, metrics), stats
+            image_data_url = data_urls[0]
+        else:
+            image_data_url, stats = encode_image_bytes(image_bytes, mime_type, preprocess_options, metrics)
+        messages = [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt_text},
+                    {"type": "image_url", "image_url": {"url": image_data_url}},
+                ],
+            }
+        ]
+        response_json = post_chat_completion(api_key, model_id, messages, metrics=metrics)
+        return response_json['choices'][0]['message']['content'], stats
+
+    (content, stats), shared = get_single_flight().do(cache_key, _request, metrics=metrics)
+    if cache and content:
+        cache.put(cache_key, content)
+    return {"content": content, "cached": False, "shared": shared, "stats": stats}
+
+def _ocr_batch_item(api_key, model_id, index, image, content_type, preprocess_options, metrics, adaptive_resolution):
+    """
+    OCR one image of a batch. Runs in a worker thread, so errors are captured in
+    the result instead of raised and one bad image does not stop the batch.
+    """
+    name, image_bytes, mime_type = image
+    started = time.perf_counter()
+    result = {"content": None, "stats": None, "shared": False}
+    error = None
+    try:
+        result = ocr_image(
+            api_key, model_id, image_bytes, mime_type, content_type, preprocess_options, metrics=metrics,
+            adaptive_resolution=adaptive_resolution,
+        )
+    except requests.exceptions.RequestException as e:
+        error = f"API Error: {e}"
+    except json.JSONDecodeError:
+        error = "Failed to decode JSON response from API."
+    except (KeyError, IndexError, TypeError):
+        error = "Unexpected response format from API."
+    except Image.UnidentifiedImageError:
+        error = "Not a readable image file."
+    except (OSError, ValueError) as e:  # truncated or corrupt image
+        error = f"Could not read image: {e}"
+    if error is None and not result["content"]:
+        error = "The model returned an empty response."
+    return {
+        "index": index, "name": name, "content": result["content"], "error": error, "cached": False,
+        "shared": result["shared"], "stats": result["stats"], "seconds": time.perf_counter() - started,
+    }
+
+def ocr_image_batch(get_api_key, model_id, images, content_type, max_in_flight=IMAGE_BATCH_DEFAULT_MAX_IN_FLIGHT,
+                    preprocess_options=None, cache=None, on_item_done=None, metrics=None, adaptive_resolution=False):
+    """
+    OCR many images with the prompt for `content_type`, with at most
+    `max_in_flight` requests (and image encodings) running at the same time, so
+    a batch takes about len(images) / max_in_flight request latencies.
+
+    Cached images are reported first and never consume an API key;
+    `get_api_key` is only called when at least one image has to go to the model,
+    with the number of images that will, since each is its own request.
+
+    Args:
+        get_api_key (callable): Called as get_api_key(request_count); returns the API key to use, or None.
+        images (list): (name, image_bytes, mime_type) tuples.
+        cache (ResultCache): Optional. Checked before and updated after each image.
+        on_item_done (callable): Optional. Called from the calling thread as
+            on_item_done(completed_count, total_count, item_result) after each
+            image finishes, in completion order.
+        metrics (StageMetrics): Optional. Collects encoding and request stage timings.
+        adaptive_resolution (bool): Optional. See `ocr_image`.
+
+    Returns:
+        list or None: Item results in upload order, each a dict with "index",
+        "name", "content", "error", "cached", "shared", "stats" and "seconds", or None when
+        no API key was available.
+    """
+    prompt_text = IMAGE_PROMPTS[content_type]
+    total = len(images)
+    results = {}
+
+    def _done(result):
+        results[result["index"]] = result
+        if on_item_done:
+            on_item_done(len(results), total, result)
+
+    cache_keys = {}
+    for index, (name, image_bytes, _) in enumerate(images):
+        cache_keys[index] = result_cache_key(
+            image_cache_digests(image_bytes, preprocess_options, adaptive_resolution), model_id, prompt_text
+        )
+        cached_result = cache.get(cache_keys[index]) if cache else None
+        if cached_result is not None:
+            _done({
+                "index": index, "name": name, "content": cached_result, "error": None, "cached": True,
+                "shared": False, "stats": None, "seconds": 0.0,
+            })
+    pending = [index for index in range(total) if index not in results]
+
+    if pending:
+        api_key = get_api_key(len(pending))
+        if not api_key:
+            return None
+        with ThreadPoolExecutor(max_workers=max(1, int(max_in_flight))) as executor:
+            futures = [
+                executor.submit(
+                    _ocr_batch_item, api_key, model_id, index, images[index], content_type, preprocess_options, metrics,
+                    adaptive_resolution,
+                )
+                for index in pending
+            ]
+            for future in as_completed(futures):
+                result = future.result()
+                if cache and result["error"] is None:
+                    cache.put(cache_keys[result["index"]], result["content"])
+                _done(result)
+    return [results[index] for index in range(total)]
+
+def _batch_result_record(result, content_type, model_id):
+    return {
+        "file": result["name"], "content_type": content_type, "model": model_id,
+        "content": result["content"], "cached": result["cached"], "error": result["error"],
+    }
+
+def batch_results_to_jsonl(results, content_type, model_id):
+    """One JSON record per image, in the same shape as the CLI's JSONL output."""
+    return "".join(
+        json.dumps(_batch_result_record(result, content_type, model_id), ensure_ascii=False) + "\n"
+        for result in results
+    )
+
+def _split_code_fence(text):
+    """(opening fence line, body) when the whole text is one fenced code block, else (None, text)."""
+    lines = text.strip().splitlines()
+    if len(lines) >= 2 and lines[0].startswith("```") and lines[-1].strip() == "```":
+        return lines[0], "\n".join(lines[1:-1])
+    return None, text
+
+def batch_results_to_markdown(results, content_type):
+    """
+    All results in one Markdown document, one section per image. Code and
+    LaTeX replies are fenced unless the model already fenced them.
+    """
+    fence = IMAGE_BATCH_FENCE_LANGUAGES.get(content_type)
+    sections = []
+    for result in results:
+        if result["error"] is not None:
+            body = f"Error: {result['error']}"
+        elif fence and _split_code_fence(result["content"])[0] is None:
+            body = f"```{fence}\n{result['content'].strip()}\n```"
+        else:
+            body = result["content"].strip()
+        sections.append(f"## {result['name']}\n\n{body}\n")
+    return "\n".join(sections)
+
+def batch_result_file(content, content_type):
+    """
+    (file extension, file content) of one result in the ZIP export. A reply
+    that is one code block in a language from CODE_FENCE_EXTENSIONS is saved
+    without its fence under that language's extension; LaTeX is saved as .tex
+    and anything else as Markdown.
+    """
+    fence, body = _split_code_fence(content)
+    language = fence[3:].strip().lower() if fence else ""
+    if content_type in IMAGE_BATCH_FENCE_LANGUAGES and language in CODE_FENCE_EXTENSIONS:
+        return CODE_FENCE_EXTENSIONS[language], body + "\n"
+    if content_type in IMAGE_BATCH_FILE_EXTENSIONS and fence is None:
+        return IMAGE_BATCH_FILE_EXTENSIONS[content_type], content
+    return ".md", content
+
+def batch_results_to_zip(results, content_type, model_id):
+    """
+    ZIP archive with one file per successful image (named after the upload and
+    numbered, since uploads can share a name, see `batch_result_file`) plus a
+    results.jsonl manifest.
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for result in results:
+            if result["error"] is None:
+                stem = os.path.splitext(os.path.basename(result["name"]))[0] or "image"
+                extension, text = batch_result_file(result["content"], content_type)
+                archive.writestr(f"{result['index'] + 1:03d}_{stem}{extension}", text)
+        archive.writestr("results.jsonl", batch_results_to_jsonl(results, content_type, model_id))
+    return buffer.getvalue()
+
+_FIELD_LINE_PATTERN = re.compile(r"^\s*([A-Za-z_][\w.-]*)\s*(\?)?\s*:\s*([A-Za-z]+)\s*(?:#\s*(.*))?$")
+_JSON_SCHEMA_TYPES = {"string": "string", "number": "number", "integer": "integer", "boolean": "boolean", "array": "list"}
+
+def parse_field_schema(schema_text):
+    """
+    Parse the fields for structured extraction. Either one field per line,
+    `name: type`, with `?` after the name for optional fields and an optional
+    `# description`:
+
+        invoice_number: string  # as printed
+        total: number
+        due_date?: date
+
+    or a JSON Schema object with "properties" (and optional "required").
+    Types are STRUCTURED_FIELD_TYPES.
+
+    Returns:
+        tuple: (list of {"name", "type", "required", "description"} dicts, or None;
+                error message or None)
+    """
+    schema_text = (schema_text or "").strip()
+    if not schema_text:
+        return None, "Enter at least one field to extract."
+    fields = []
+    if schema_text.startswith("{"):
+        try:
+            schema = json.loads(schema_text)
+        except json.JSONDecodeError as e:
+            return None, f"The JSON schema is not valid JSON: {e}"
+        properties = schema.get("properties") if isinstance(schema, dict) else None
+        if not isinstance(properties, dict) or not properties:
+            return None, 'A JSON schema needs a "properties" object with at least one field.'
+        required = set(schema.get("required", properties))
+        for name, spec in properties.items():
+            spec = spec if isinstance(spec, dict) else {}
+            json_type = spec.get("type", "string")
+            if isinstance(json_type, list):  # ["string", "null"]
+                json_type = next((t for t in json_type if t != "null"), "string")
+            field_type = "date" if spec.get("format") == "date" else _JSON_SCHEMA_TYPES.get(json_type)
+            if field_type is None:
+                return None, f"Field '{name}' has unsupported type '{json_type}'."
+            fields.append({
+                "name": name, "type": field_type, "required": name in required,
+                "description": spec.get("description", ""),
+            })
+    else:
+        for line_number, line in enumerate(schema_text.splitlines(), start=1):
+            if not line.strip():
+                continue
+            match = _FIELD_LINE_PATTERN.match(line)
+            if not match:
+                return None, f"Line {line_number}: expected 'name: type', got '{line.strip()}'."
+            name, optional, field_type, description = match.groups()
+            field_type = field_type.lower()
+            if field_type not in STRUCTURED_FIELD_TYPES:
+                return None, f"Line {line_number}: unknown type '{field_type}' (use {', '.join(STRUCTURED_FIELD_TYPES)})."
+            fields.append({"name": name, "type": field_type, "required": not optional, "description": description or ""})
+    names = [field["name"] for field in fields]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        return None, f"Duplicate field name(s): {', '.join(duplicates)}."
+    return fields, None
+
+def fields_json_schema(fields):
+    """JSON Schema of the reply object; optional fields may be null."""
+    properties = {}
+    for field in fields:
+        if field["type"] == "list":
+            spec = {"type": "array", "items": {"type": "string"}}
+        elif field["type"] == "date":
+            spec = {"type": "string", "description": "Date as YYYY-MM-DD"}
+        else:
+            spec = {"type": field["type"]}
+        if not field["required"]:
+            spec["type"] = [spec["type"], "null"]
+        if field["description"]:
+            spec["description"] = "; ".join(filter(None, (field["description"], spec.get("description"))))
+        properties[field["name"]] = spec
+    return {
+        "type": "object", "properties": properties, "required": [field["name"] for field in fields],
+        "additionalProperties": False,
+    }
+
+def _field_lines(fields):
+    return "\n".join(
+        f"- {field['name']} ({field['type']}, {'required' if field['required'] else 'optional'})"
+        + (f": {field['description']}" if field["description"] else "")
+        for field in fields
+    )
+
+def structured_prompt(fields, instructions=""):
+    """Prompt asking for `fields` as one JSON object, with the user's extra instructions if any."""
+    instructions = instructions.strip()
+    return STRUCTURED_PROMPT.format(
+        field_lines=_field_lines(fields), instructions=f"\n\nAdditional instructions: {instructions}" if instructions else ""
+    )
+
+def parse_json_object(text):
+    """The JSON object in a model reply (bare, or inside a code fence or prose), or None."""
+    if not text:
+        return None
+    start, end = text.find("{"), text.rfind("}")
+    if start < 0 or end < start:
+        return None
+    try:
+        value = json.loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+    return value if isinstance(value, dict) else None
+
+def _coerce_field_value(value, field_type):
+    """
+    The value as `field_type`, accepting the usual near misses ("1,234.50",
+    "yes", a float that is a whole number). Returns (value, problem or None).
+    """
+    if field_type == "string":
+        if isinstance(value, (dict, list)):
+            return None, "expected text"
+        return str(value), None
+    if field_type in ("number", "integer"):
+        number = value
+        if isinstance(value, str):
+            cleaned = re.sub(r"[\s,$€£¥]", "", value)
+            if not re.fullmatch(r"[-+]?(\d+(\.\d*)?|\.\d+)", cleaned):
+                return None, f"expected a {field_type}"
+            number = float(cleaned)
+        if isinstance(number, bool) or not isinstance(number, (int, float)):
+            return None, f"expected a {field_type}"
+        if field_type == "integer":
+            return (int(number), None) if float(number).is_integer() else (None, "expected a whole number")
+        return number, None
+    if field_type == "boolean":
+        if isinstance(value, bool):
+            return value, None
+        lowered = str(value).strip().lower()
+        if lowered in ("true", "yes", "y", "1"):
+            return True, None
+        if lowered in ("false", "no", "n", "0"):
+            return False, None
+        return None, "expected true or false"
+    if field_type == "date":
+        try:
+            return datetime.date.fromisoformat(str(value).strip()).isoformat(), None
+        except ValueError:
+            return None, "expected a date as YYYY-MM-DD"
+    if not isinstance(value, list):  # list
+        return None, "expected a JSON array"
+    return [item if isinstance(item, str) else json.dumps(item, ensure_ascii=False) for item in value], None
+
+def validate_structured_fields(data, fields):
+    """
+    Check a parsed reply against `fields`.
+
+    Returns:
+        tuple: ({name: value} for every field, None where missing or invalid;
+                {name: problem} for required fields that are missing and any
+                field whose value has the wrong type)
+    """
+    values, problems = {}, {}
+    data = data if isinstance(data, dict) else {}
+    for field in fields:
+        value = data.get(field["name"])
+        if value is None or value == "" or value == []:
+            values[field["name"]] = None
+            if field["required"]:
+                problems[field["name"]] = "missing"
+            continue
+        values[field["name"]], problem = _coerce_field_value(value, field["type"])
+        if problem:
+            problems[field["name"]] = f"{problem}, got {json.dumps(value, ensure_ascii=False)[:80]}"
+    return values, problems
+
+def _rejects_response_format(response):
+    """Whether an HTTP 400 response is about the response_format itself, not the payload or other parameters."""
+    body = (response.text or "").lower()
+    return "response_format" in body or "json_schema" in body
+
+def _request_structured_reply(api_key, model_id, content_parts, fields, metrics=None):
+    """
+    One structured request: the reply JSON is constrained to `fields` with a
+    JSON schema `response_format`, or asked for by the prompt alone for Auto
+    model IDs (the router does not send it) and after an HTTP 400. A model
+    whose 400 names the response_format is remembered for the process; any
+    other 400 falls back for this request only.
+    """
+    messages = [{"role": "user", "content": content_parts}]
+    with _singleton_lock:
+        use_response_format = not is_auto_model(model_id) and model_id not in _models_without_response_format
+    if use_response_format:
+        response_format = {
+            "type": "json_schema",
+            "json_schema": {"name": "extracted_fields", "strict": True, "schema": fields_json_schema(fields)},
+        }
+        try:
+            response_json = post_chat_completion(
+                api_key, model_id, messages, metrics=metrics, response_format=response_format
+            )
+            return response_json['choices'][0]['message']['content']
+        except requests.exceptions.HTTPError as e:
+            if e.response is None or e.response.status_code != 400:
+                raise
+            if _rejects_response_format(e.response):
+                with _singleton_lock:
+                    _models_without_response_format.add(model_id)
+    response_json = post_chat_completion(api_key, model_id, messages, metrics=metrics)
+    return response_json['choices'][0]['message']['content']
+
+def extract_structured_fields(api_key, model_id, data_urls, fields, instructions="", metrics=None):
+    """
+    Extract `fields` from the document images in `data_urls` as validated
+    values. Fields that come back missing or invalid are asked for again, up to
+    STRUCTURED_MAX_REPAIR_ROUNDS times, in a small follow-up request for just
+    those fields: invalid values are corrected from the earlier reply, and the
+    images are attached again only when a required field was missing.
+    Raises like `post_chat_completion`.
+
+    Returns:
+        dict: {"values": {name: value or None}, "problems": {name: problem} still
+               unresolved, "repaired": [names fixed by follow-ups], "requests": int}
+    """
+    image_parts = [{"type": "image_url", "image_url": {"url": url}} for url in data_urls]
+    prompt_text = structured_prompt(fields, instructions)
+    reply = _request_structured_reply(api_key, model_id, [{"type": "text", "text": prompt_text}, *image_parts], fields, metrics)
+    values, problems = validate_structured_fields(parse_json_object(reply), fields)
+    requests_sent, repaired = 1, []
+    for _ in range(STRUCTURED_MAX_REPAIR_ROUNDS):
+        if not problems:
+            break
+        retry_fields = [field for field in fields if field["name"] in problems]
+        repair_text = STRUCTURED_REPAIR_PROMPT.format(
+            problem_lines="\n".join(f"- {name}: {problem}" for name, problem in problems.items()),
+            field_lines=_field_lines(retry_fields),
+        )
+        content_parts = [{"type": "text", "text": repair_text}]
+        if "missing" in problems.values():
+            content_parts += image_parts
+        reply = _request_structured_reply(api_key, model_id, content_parts, retry_fields, metrics)
+        requests_sent += 1
+        retry_values, retry_problems = validate_structured_fields(parse_json_object(reply), retry_fields)
+        for name in problems:
+            if name not in retry_problems:
+                values[name] = retry_values[name]
+                repaired.append(name)
+        problems = retry_problems
+    return {"values": values, "problems": problems, "repaired": repaired, "requests": requests_sent}
+
+def structured_document_digests(document_bytes, mime_type, preprocess_options=None, page_indices=None):
+    """Content digests of a document (image or PDF pages) for `result_cache_key`."""
+    if mime_type != "application/pdf":
+        return image_cache_digests(document_bytes, preprocess_options)
+    pdf_digest = sha256_hex(document_bytes)
+    if page_indices is None:
+        page_indices = range(pdf_page_count(document_bytes, pdf_digest))
+    return [pdf_page_digest(pdf_digest, idx, preprocess_options) for idx in page_indices]
+
+def structured_document_data_urls(document_bytes, mime_type, model_id, preprocess_options=None, page_indices=None,
+                                  metrics=None):
+    """
+    Data URLs of a document for structured extraction: the image itself, or
+    the PDF's pages (all, or `page_indices`). Raises ValueError when the pages
+    do not fit one request to `model_id`.
+    """
+    if mime_type != "application/pdf":
+        data_url, _ = encode_image_bytes(document_bytes, mime_type, preprocess_options, metrics)
+        return [data_url]
+    pdf_digest = sha256_hex(document_bytes)
+    if page_indices is None:
+        page_indices = list(range(pdf_page_count(document_bytes, pdf_digest)))
+    if len(plan_pdf_chunks(document_bytes, page_indices, model_id, None, preprocess_options, pdf_digest)) > 1:
+        raise ValueError(f"{len(page_indices)} pages do not fit in one request to this model; select fewer pages.")
+    return pdf_pages_to_data_urls(document_bytes, page_indices, preprocess_options, metrics, pdf_digest)
+
+def _structured_cache_key(document_bytes, mime_type, model_id, fields, instructions, preprocess_options, page_indices=None):
+    digests = structured_document_digests(document_bytes, mime_type, preprocess_options, page_indices)
+    return result_cache_key(digests, model_id, "structured:" + structured_prompt(fields, instructions))
+
+def extract_structured_document(api_key, model_id, document_bytes, mime_type, fields, instructions="",
+                                preprocess_options=None, cache=None, metrics=None, page_indices=None):
+    """
+    `extract_structured_fields` for one image or PDF. Complete results (no
+    unresolved problems) are served from and stored in `cache`, so a cached
+    document is not rendered or encoded again.
+
+    Returns:
+        dict: As `extract_structured_fields`, plus a "cached" flag.
+    """
+    cache_key = _structured_cache_key(document_bytes, mime_type, model_id, fields, instructions, preprocess_options,
+                                      page_indices)
+    cached_values = cache.get(cache_key) if cache else None
+    if cached_values is not None:
+        return {"values": json.loads(cached_values), "problems": {}, "repaired": [], "requests": 0, "cached": True}
+    data_urls = structured_document_data_urls(document_bytes, mime_type, model_id, preprocess_options, page_indices,
+                                              metrics)
+    result = extract_structured_fields(api_key, model_id, data_urls, fields, instructions, metrics)
+    if cache and not result["problems"]:
+        cache.put(cache_key, json.dumps(result["values"], ensure_ascii=False))
+    return {**result, "cached": False}
+
+def _structured_batch_item(api_key, model_id, index, document, fields, instructions, preprocess_options, cache,
+                           metrics):
+    """
+    Extract fields from one document of a batch. Runs in a worker thread, so
+    errors are captured in the result instead of raised.
+    """
+    name, document_bytes, mime_type = document
+    started = time.perf_counter()
+    result = {"values": None, "problems": {}, "repaired": [], "requests": 0, "cached": False}
+    error = None
+    try:
+        result = extract_structured_document(
+            api_key, model_id, document_bytes, mime_type, fields, instructions, preprocess_options, cache, metrics
+        )
+    except requests.exceptions.RequestException as e:
+        error = f"API Error: {e}"
+    except json.JSONDecodeError:
+        error = "Failed to decode JSON response from API."
+    except (KeyError, IndexError, TypeError):
+        error = "Unexpected response format from API."
+    except Image.UnidentifiedImageError:
+        error = "Not a readable image file."
+    except (OSError, ValueError, RuntimeError) as e:  # corrupt file (PyMuPDF raises RuntimeErrors), or too many PDF pages
+        error = f"Could not read document: {e}"
+    return {"index": index, "name": name, **result, "error": error, "seconds": time.perf_counter() - started}
+
+def extract_structured_batch(get_api_key, model_id, documents, fields, instructions="",
+                             max_in_flight=IMAGE_BATCH_DEFAULT_MAX_IN_FLIGHT, preprocess_options=None, cache=None,
+                             on_item_done=None, metrics=None):
+    """
+    Structured extraction over many documents (images or PDFs), with at most
+    `max_in_flight` documents in progress at the same time. Cached documents
+    are reported first and never consume an API key; `get_api_key` is only
+    called when at least one document has to go to the model, with the number
+    of documents that will.
+
+    Args:
+        get_api_key (callable): Called as get_api_key(request_count); returns the API key to use, or None.
+        documents (list): (name, document_bytes, mime_type) tuples.
+        cache (ResultCache): Optional. Complete results are served from and stored in it.
+        on_item_done (callable): Optional. Called from the calling thread as
+            on_item_done(completed_count, total_count, item_result) in completion order.
+
+    Returns:
+        list or None: Item results in upload order, each a dict with "index",
+        "name", "values", "problems", "repaired", "requests", "error", "cached"
+        and "seconds", or None when no API key was available.
+    """
+    total = len(documents)
+    results = {}
+
+    def _done(result):
+        results[result["index"]] = result
+        if on_item_done:
+            on_item_done(len(results), total, result)
+
+    for index, (name, document_bytes, mime_type) in enumerate(documents):
+        if not cache:
+            break
+        try:
+            cache_key = _structured_cache_key(document_bytes, mime_type, model_id, fields, instructions, preprocess_options)
+        except (OSError, ValueError, RuntimeError):  # unreadable; the worker reports it
+            continue
+        cached_values = cache.get(cache_key)
+        if cached_values is not None:
+            _done({
+                "index": index, "name": name, "values": json.loads(cached_values), "problems": {}, "repaired": [],
+                "requests": 0, "cached": True, "error": None, "seconds": 0.0,
+            })
+    pending = [index for index in range(total) if index not in results]
+
+    if pending:
+        api_key = get_api_key(len(pending))
+        if not api_key:
+            return None
+        with ThreadPoolExecutor(max_workers=max(1, int(max_in_flight))) as executor:
+            futures = [
+                executor.submit(
+                    _structured_batch_item, api_key, model_id, index, documents[index], fields, instructions,
+                    preprocess_options, cache, metrics,
+                )
+                for index in pending
+            ]
+            for future in as_completed(futures):
+                _done(future.result())
+    return [results[index] for index in range(total)]
+
+def structured_result_record(result, model_id):
+    """One JSON record per document, in the same shape as the CLI's `--fields` output."""
+    return {
+        "file": result["name"], "model": model_id, "values": result["values"], "problems": result["problems"],
+        "repaired": result["repaired"], "requests": result["requests"], "cached": result["cached"],
+        "error": result["error"],
+    }
+
+def structured_results_to_jsonl(results, model_id):
+    """One JSON record per document."""
+    return "".join(
+        json.dumps(structured_result_record(result, model_id), ensure_ascii=False) + "\n" for result in results
+    )
+
+def structured_results_to_csv(results, fields):
+    """
+    One row per document and one column per field; lists are joined with "; ".
+    Unresolved problems and errors go in the last two columns.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["file", *(field["name"] for field in fields), "problems", "error"])
+    for result in results:
+        values = result["values"] or {}
+        row = [result["name"]]
+        for field in fields:
+            value = values.get(field["name"])
+            row.append("; ".join(value) if isinstance(value, list) else "" if value is None else value)
+        row.append("; ".join(f"{name}: {problem}" for name, problem in result["problems"].items()))
+        row.append(result["error"] or "")
+        writer.writerow(row)
+    return buffer.getvalue()
+
+def ocr_pdf(get_api_key, model_id, pdf_bytes, content_type, page_indices, pages_per_request=PDF_DEFAULT_PAGES_PER_REQUEST,
+            max_in_flight=PDF_DEFAULT_MAX_IN_FLIGHT, preprocess_options=None, cache=None, checkpoints=None,
+            on_chunk_done=None, on_stream_update=None, text_layer=False, metrics=None, pdf_digest=None,
+            render_workers=None, skip_repeated_pages=False, adaptive_resolution=False, output=None):
+    """
+    Scan PDF pages in batches of `pages_per_request` with the prompt for `content_type`.
+    With pages_per_request=None, batches are packed to the model's request budget
+    instead (see `plan_pdf_chunks`).
+
+    With `text_layer`, born-digital pages are read locally from the PDF's text
+    layer (for content types in PDF_TEXT_LAYER_CONTENT_TYPES) and only scanned
+    or image-heavy pages are sent to the model.
+
+    With `skip_repeated_pages`, blank pages are not sent, and of each group of
+    near-identical pages only the first is sent (see `find_repeated_pages`).
+
+    With `adaptive_resolution`, each page sent to the model is rendered at a DPI
+    chosen from its text, and dense pages are split into strips that are OCR'd
+    concurrently and stitched (see `plan_pdf_page_resolutions`). Such a page is
+    always a batch of its own.
+
+    With `checkpoints`, batches finished by an earlier run of the same job are
+    reused and only the missing pages are scanned; every new batch is
+    checkpointed as soon as it completes. Cached batches are served without
+    rendering anything. `get_api_key` is only called when at least one batch has
+    to go to the model, so cache hits never consume an API key; if it returns
+    None the scan is aborted.
+
+    Args:
+        get_api_key (callable): Returns the API key to use, or None.
+        cache (ResultCache): Optional. Checked before and updated after each batch.
+        checkpoints (CheckpointStore): Optional. Enables resumable jobs.
+        on_chunk_done, on_stream_update: See `scan_pdf_pages_concurrently`.
+        text_layer (bool): Optional. Enables the local text-layer fast path.
+        metrics (StageMetrics): Optional. Collects per-stage timings and token usage.
+        pdf_digest (str): Optional. sha256_hex(pdf_bytes), when the caller already has it.
+        render_workers (int): Optional. Render processes (see `iter_pdf_page_data_urls`).
+        output (ResultFile): Optional. Every chunk result is appended to it as soon
+            as it is known, so long scans never have to be held or merged in memory.
+
+    Returns:
+        list or None: Chunk results in page order, each with a "cached" flag and a
+        "method" of "text_layer", "vision", "blank" or "duplicate" (plus a "reason"
+        for the path taken when `text_layer` or `skip_repeated_pages` is on, and
+        the number of "strips" of pages that were split), or None when no API key
+        was available.
+    """
+    prompt_text = PDF_PROMPTS[content_type]
+    pdf_digest = pdf_digest or sha256_hex(pdf_bytes)
+
+    chunk_results = {}
+    page_routes = {}
+
+    def _settle(chunk_result):
+        """Label a finished chunk with the path it took and append it to `output`."""
+        if chunk_result.setdefault("method", "vision") == "vision" and page_routes:
+            chunk_result["reason"] = "; ".join(sorted({page_routes[page - 1]["reason"] for page in chunk_result["pages"]}))
+        if output is not None:
+            output.append(chunk_result)
+
+    if text_layer and content_type in PDF_TEXT_LAYER_CONTENT_TYPES:
+        page_routes = read_pdf_text_layers(pdf_bytes, page_indices, metrics, pdf_digest)
+        for idx, route in page_routes.items():
+            if route["method"] == "text_layer":
+                chunk_results[idx] = {
+                    "pages": [idx + 1], "content": route["content"], "error": None, "sent_bytes": 0,
+                    "cached": False, "method": "text_layer", "reason": route["reason"],
+                }
+                _settle(chunk_results[idx])
+    vision_indices = [idx for idx in page_indices if idx not in chunk_results]
+    duplicate_of, blank_pages = {}, []
+    if skip_repeated_pages:
+        duplicate_of, blank_pages = find_repeated_pages(pdf_bytes, vision_indices, metrics, pdf_digest)
+        vision_indices = [idx for idx in vision_indices if idx not in duplicate_of and idx not in blank_pages]
+
+    job_id = None
+    if checkpoints:
+        job_id = checkpoints.job_id(pdf_digest, model_id, prompt_text, preprocess_options, adaptive_resolution)
+        for chunk_result in checkpoints.completed_chunks(job_id, vision_indices):
+            chunk_results[chunk_result["pages"][0] - 1] = chunk_result
+            _settle(chunk_result)
+    done_pages = {page - 1 for chunk_result in chunk_results.values() for page in chunk_result["pages"]}
+    remaining_indices = [idx for idx in vision_indices if idx not in done_pages]
+    page_resolutions = None
+    if adaptive_resolution:
+        page_resolutions = plan_pdf_page_resolutions(
+            pdf_bytes, remaining_indices, content_type, _max_image_side(model_id, preprocess_options), metrics, pdf_digest
+        )
+    chunks = plan_pdf_chunks(
+        pdf_bytes, remaining_indices, model_id, pages_per_request, preprocess_options, pdf_digest, page_resolutions
+    )
+
+    cache_keys = {
+        chunk[0] + 1: result_cache_key(
+            [pdf_page_digest(pdf_digest, idx, preprocess_options, adaptive_resolution) for idx in chunk],
+            model_id, prompt_text,
+        )
+        for chunk in chunks
+    }
+    for chunk in chunks:
+        cached_result = cache.get(cache_keys[chunk[0] + 1]) if cache else None
+        if cached_result is not None:
+            chunk_results[chunk[0]] = {
+                "pages": [idx + 1 for idx in chunk], "content": cached_result, "error": None,
+                "sent_bytes": 0, "cached": True,
+            }
+            _settle(chunk_results[chunk[0]])
+            if checkpoints:
+                checkpoints.record_chunk(job_id, chunk_results[chunk[0]]["pages"], cached_result)
+    pending_chunks = [chunk for chunk in chunks if chunk[0] not in chunk_results]
+
+    if pending_chunks:
+        api_key = get_api_key()
+        if not api_key:
+            return None
+        if checkpoints:
+            checkpoints.start_job(job_id, pdf_digest, model_id, content_type)
+
+        def _chunk_done(completed, total, chunk_result):
+            chunk_result["cached"] = False
+            if chunk_result["error"] is None and chunk_result["content"]:
+                if cache:
+                    cache.put(cache_keys[chunk_result["pages"][0]], chunk_result["content"])
+                if checkpoints:
+                    checkpoints.record_chunk(job_id, chunk_result["pages"], chunk_result["content"])
+            _settle(chunk_result)
+            if on_chunk_done:
+                on_chunk_done(completed, total, chunk_result)
+
+        for chunk_result in scan_pdf_pages_concurrently(
+            api_key, model_id, prompt_text, pdf_bytes, pending_chunks, max_in_flight,
+            on_chunk_done=_chunk_done, on_stream_update=on_stream_update, preprocess_options=preprocess_options,
+            metrics=metrics, pdf_digest=pdf_digest, flight_keys=cache_keys, render_workers=render_workers,
+            page_resolutions=page_resolutions,
+        ):
+            chunk_results[chunk_result["pages"][0] - 1] = chunk_result
+
+    for chunk_result in repeated_page_results(duplicate_of, blank_pages, list(chunk_results.values()), content_type):
+        chunk_results[chunk_result["pages"][0] - 1] = chunk_result
+        _settle(chunk_result)
+    ordered_results = [chunk_results[first_index] for first_index in sorted(chunk_results)]
+    if checkpoints:
+        failed = any(chunk_result["error"] is not None for chunk_result in ordered_results)
+        checkpoints.finish_job(job_id, "incomplete" if failed else "complete")
+    return ordered_results
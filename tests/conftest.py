@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+# The engine is a top-level module next to the app, not an installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def make_pdf():
+    """Build a born-digital PDF in memory; each entry of `pages` is a page's lines of text (empty for a blank page)."""
+    import fitz  # PyMuPDF
+
+    def _make_pdf(pages, fontsize=11):
+        doc = fitz.open()
+        for lines in pages:
+            page = doc.new_page()
+            for number, line in enumerate(lines):
+                page.insert_text((36, 48 + number * fontsize * 1.3), line, fontsize=fontsize)
+        return doc.tobytes()
+
+    return _make_pdf
@@ -0,0 +1,60 @@
+"""CheckpointStore: resumable PDF batches."""
+import time
+
+from ocr_engine import CheckpointStore
+
+
+def test_job_id_depends_on_everything_that_changes_the_output():
+    options = {"enabled": True, "grayscale": False, "autocrop": True, "max_side": 1024}
+    job_id = CheckpointStore.job_id("pdf", "model", "prompt", options)
+    assert job_id == CheckpointStore.job_id("pdf", "model", "prompt", dict(options))
+    assert job_id != CheckpointStore.job_id("other-pdf", "model", "prompt", options)
+    assert job_id != CheckpointStore.job_id("pdf", "other-model", "prompt", options)
+    assert job_id != CheckpointStore.job_id("pdf", "model", "other prompt", options)
+    assert job_id != CheckpointStore.job_id("pdf", "model", "prompt", {**options, "grayscale": True})
+
+
+def test_recorded_chunks_come_back_in_page_order(tmp_path):
+    store = CheckpointStore(str(tmp_path), ttl_seconds=60)
+    store.start_job("job", "pdf", "model", "General Text Extraction")
+    store.record_chunk("job", [3, 4], "pages three and four")
+    store.record_chunk("job", [1, 2], "pages one and two")
+    chunks = store.completed_chunks("job")
+    assert [(chunk["pages"], chunk["content"]) for chunk in chunks] == [
+        ([1, 2], "pages one and two"), ([3, 4], "pages three and four"),
+    ]
+    assert all(chunk["cached"] and chunk["error"] is None for chunk in chunks)
+
+
+def test_only_chunks_inside_the_selection_are_resumed(tmp_path):
+    store = CheckpointStore(str(tmp_path), ttl_seconds=60)
+    store.start_job("job", "pdf", "model", "General Text Extraction")
+    store.record_chunk("job", [1, 2], "a")
+    store.record_chunk("job", [3, 4], "b")
+    assert [chunk["pages"] for chunk in store.completed_chunks("job", page_indices=[0, 1, 2])] == [[1, 2]]
+
+
+def test_recording_a_chunk_again_replaces_it(tmp_path):
+    store = CheckpointStore(str(tmp_path), ttl_seconds=60)
+    store.start_job("job", "pdf", "model", "General Text Extraction")
+    store.record_chunk("job", [1], "first try")
+    store.record_chunk("job", [1], "second try")
+    assert [chunk["content"] for chunk in store.completed_chunks("job")] == ["second try"]
+
+
+def test_discard_and_finish(tmp_path):
+    store = CheckpointStore(str(tmp_path), ttl_seconds=60)
+    store.start_job("job", "pdf", "model", "General Text Extraction")
+    store.record_chunk("job", [1], "a")
+    store.finish_job("job", "incomplete")
+    assert len(store.completed_chunks("job")) == 1  # finishing keeps the checkpoints
+    store.discard_job("job")
+    assert store.completed_chunks("job") == []
+
+
+def test_expired_jobs_are_purged_on_open(tmp_path):
+    store = CheckpointStore(str(tmp_path), ttl_seconds=0.05)
+    store.start_job("job", "pdf", "model", "General Text Extraction")
+    store.record_chunk("job", [1], "a")
+    time.sleep(0.1)
+    assert CheckpointStore(str(tmp_path), ttl_seconds=0.05).completed_chunks("job") == []
@@ -0,0 +1,122 @@
+"""ocr_image_batch and its Markdown/ZIP exports, against a fake chat endpoint."""
+import io
+import json
+import zipfile
+
+import pytest
+from PIL import Image, ImageDraw
+
+import ocr_engine
+from ocr_engine import (
+    ResultCache,
+    batch_result_file,
+    batch_results_to_markdown,
+    batch_results_to_zip,
+    ocr_image_batch,
+)
+
+MODEL_ID = list(ocr_engine.AVAILABLE_MODELS.values())[0]
+
+
+def image_bytes(label):
+    image = Image.new("RGB", (300, 200), "white")
+    ImageDraw.Draw(image).text((20, 80), label, fill="black")
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def requests_sent(monkeypatch):
+    sent = []
+
+    def _post_chat_completion(api_key, model_id, messages, site_url="", **kwargs):
+        sent.append(api_key)
+        return {"choices": [{"message": {"content": f"text {len(sent)}"}}]}
+
+    monkeypatch.setattr(ocr_engine, "post_chat_completion", _post_chat_completion)
+    return sent
+
+
+def test_results_keep_upload_order(requests_sent):
+    images = [(f"{name}.png", image_bytes(name), "image/png") for name in ("a", "b", "c")]
+    done = []
+    results = ocr_image_batch(
+        lambda request_count: "key", MODEL_ID, images, "General Text Extraction", max_in_flight=3,
+        on_item_done=lambda completed, total, result: done.append((completed, total)),
+    )
+    assert [result["name"] for result in results] == ["a.png", "b.png", "c.png"]
+    assert all(result["error"] is None and result["content"] for result in results)
+    assert done == [(1, 3), (2, 3), (3, 3)]
+    assert requests_sent == ["key"] * 3
+
+
+def test_cached_images_do_not_ask_for_a_key(requests_sent, tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=1 << 20, ttl_seconds=60)
+    images = [("a.png", image_bytes("a"), "image/png"), ("b.png", image_bytes("b"), "image/png")]
+    ocr_image_batch(lambda request_count: "key", MODEL_ID, images[:1], "General Text Extraction", cache=cache)
+    key_requests = []
+
+    def _get_api_key(request_count):
+        key_requests.append(request_count)
+        return "key"
+
+    results = ocr_image_batch(_get_api_key, MODEL_ID, images, "General Text Extraction", cache=cache)
+    assert key_requests == [1]  # one key use per image that goes to the model
+    assert [result["cached"] for result in results] == [True, False]
+
+    key_requests.clear()
+    ocr_image_batch(_get_api_key, MODEL_ID, images, "General Text Extraction", cache=cache)
+    assert key_requests == []
+
+
+def test_no_key_returns_none(requests_sent):
+    images = [("a.png", image_bytes("a"), "image/png")]
+    assert ocr_image_batch(lambda request_count: None, MODEL_ID, images, "General Text Extraction") is None
+    assert requests_sent == []
+
+
+def test_unreadable_image_fails_alone(requests_sent):
+    images = [("a.png", image_bytes("a"), "image/png"), ("broken.png", b"not an image", "image/png")]
+    preprocess_options = ocr_engine.default_preprocess_options(MODEL_ID)
+    results = ocr_image_batch(
+        lambda request_count: "key", MODEL_ID, images, "General Text Extraction", preprocess_options=preprocess_options,
+    )
+    assert results[0]["error"] is None
+    assert results[1]["error"] and results[1]["content"] is None
+
+
+def test_markdown_export_does_not_fence_fenced_replies_twice():
+    results = [
+        {"index": 0, "name": "a.png", "content": "```js\nlet x = 1;\n```", "error": None},
+        {"index": 1, "name": "b.png", "content": "x = 1", "error": None},
+        {"index": 2, "name": "c.png", "content": None, "error": "API Error: 500"},
+    ]
+    markdown = batch_results_to_markdown(results, "Code Snippet Extraction")
+    assert "## a.png\n\n```js\nlet x = 1;\n```\n" in markdown
+    assert "## b.png\n\n```python\nx = 1\n```\n" in markdown
+    assert "## c.png\n\nError: API Error: 500\n" in markdown
+
+
+@pytest.mark.parametrize("content, content_type, expected", [
+    ("```javascript\nlet x = 1;\n```", "Code Snippet Extraction", (".js", "let x = 1;\n")),
+    ("x = 1", "Code Snippet Extraction", (".md", "x = 1")),
+    ("\\frac{a}{b}", "LaTeX Equation Conversion", (".tex", "\\frac{a}{b}")),
+    ("```latex\n\\frac{a}{b}\n```", "LaTeX Equation Conversion", (".tex", "\\frac{a}{b}\n")),
+    ("```python\nx\n```", "General Text Extraction", (".md", "```python\nx\n```")),
+])
+def test_zip_file_extension_follows_the_reply(content, content_type, expected):
+    assert batch_result_file(content, content_type) == expected
+
+
+def test_zip_has_one_file_per_success_and_a_manifest():
+    results = [
+        {"index": 0, "name": "scan.png", "content": "```python\nx = 1\n```", "error": None, "cached": False},
+        {"index": 1, "name": "scan.png", "content": None, "error": "API Error: 500", "cached": False},
+        {"index": 2, "name": "dir/other.jpg", "content": "y = 2", "error": None, "cached": True},
+    ]
+    with zipfile.ZipFile(io.BytesIO(batch_results_to_zip(results, "Code Snippet Extraction", MODEL_ID))) as archive:
+        assert archive.namelist() == ["001_scan.py", "003_other.md", "results.jsonl"]
+        assert archive.read("001_scan.py") == b"x = 1\n"
+        records = [json.loads(line) for line in archive.read("results.jsonl").decode().splitlines()]
+    assert [record["error"] for record in records] == [None, "API Error: 500", None]
@@ -0,0 +1,94 @@
+"""JobManager and BackgroundJob: background OCR jobs that outlive a script run."""
+import threading
+import time
+
+from ocr_engine import JobManager
+
+
+def wait_until_finished(job, timeout=5):
+    deadline = time.monotonic() + timeout
+    while job.active:
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+    return job.snapshot()
+
+
+def test_result_progress_notes_and_meta():
+    manager = JobManager(workers=2, retention_seconds=60)
+
+    def _work(job):
+        job.set_meta("api_calls", 1)
+        job.report(1, 2, "halfway")
+        job.set_partial("partial text")
+        job.note("caption", "a note")
+        return "final text"
+
+    snapshot = wait_until_finished(manager.submit("session", "pdf_scan", "Scanning...", _work))
+    assert snapshot["status"] == "done" and snapshot["result"] == "final text"
+    assert (snapshot["completed"], snapshot["total"], snapshot["progress_text"]) == (1, 2, "halfway")
+    assert snapshot["partial"] == "partial text" and snapshot["notes"] == [("caption", "a note")]
+    assert snapshot["meta"] == {"api_calls": 1}
+
+
+def test_exception_marks_the_job_failed_and_keeps_meta():
+    manager = JobManager(workers=1, retention_seconds=60)
+
+    def _work(job):
+        job.set_meta("api_calls", 1)
+        raise ValueError("bad page")
+
+    snapshot = wait_until_finished(manager.submit("session", "pdf_scan", "Scanning...", _work))
+    assert snapshot["status"] == "failed" and snapshot["error"] == "ValueError: bad page"
+    assert snapshot["meta"] == {"api_calls": 1}
+
+
+def test_cancel_while_running():
+    manager = JobManager(workers=1, retention_seconds=60)
+    running = threading.Event()
+
+    def _work(job):
+        running.set()
+        while True:
+            job.check_cancelled()
+            time.sleep(0.005)
+
+    job = manager.submit("session", "answer", "Waiting...", _work)
+    assert running.wait(5)
+    job.cancel()
+    snapshot = wait_until_finished(job)
+    assert snapshot["status"] == "cancelled" and snapshot["cancel_requested"]
+
+
+def test_job_cancelled_before_it_starts_never_runs():
+    manager = JobManager(workers=1, retention_seconds=60)
+    release, ran = threading.Event(), []
+    first = manager.submit("session", "answer", "First", lambda job: release.wait(5))
+    second = manager.submit("session", "answer", "Second", lambda job: ran.append(job.id))
+    assert second.snapshot()["status"] == "queued"
+    second.cancel()
+    release.set()
+    wait_until_finished(first)
+    assert wait_until_finished(second)["status"] == "cancelled"
+    assert ran == []
+
+
+def test_jobs_are_found_by_owner_and_kind_and_forgotten():
+    manager = JobManager(workers=2, retention_seconds=60)
+    scan = manager.submit("alice", "pdf_scan", "Scanning...", lambda job: None)
+    answer = manager.submit("alice", "answer", "Waiting...", lambda job: None)
+    manager.submit("bob", "pdf_scan", "Scanning...", lambda job: None)
+    assert manager.jobs_for("alice") == [scan, answer]
+    assert manager.jobs_for("alice", "pdf_scan") == [scan]
+    wait_until_finished(scan)
+    manager.forget(scan.id)
+    assert manager.get(scan.id) is None
+    assert manager.get(answer.id) is answer
+
+
+def test_finished_jobs_are_pruned_after_retention():
+    manager = JobManager(workers=1, retention_seconds=0.05)
+    old = manager.submit("session", "answer", "Old", lambda job: None)
+    wait_until_finished(old)
+    time.sleep(0.1)
+    manager.submit("session", "answer", "New", lambda job: None)
+    assert manager.get(old.id) is None
@@ -0,0 +1,119 @@
+"""ModelRouter: ranking by health, failover, 429 cool-down and hedging, against a fake chat endpoint."""
+import threading
+import time
+
+import pytest
+import requests
+
+import ocr_engine
+from ocr_engine import ModelRouter
+
+
+def http_error(status, headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    return requests.exceptions.HTTPError(f"{status} Error", response=response)
+
+
+@pytest.fixture
+def replies(monkeypatch):
+    """Per-model behavior of the fake endpoint: a reply string, an exception, or (delay, reply)."""
+    behavior, calls = {}, []
+
+    def _post_chat_completion(api_key, model_id, messages, site_url="", **kwargs):
+        calls.append(model_id)
+        outcome = behavior[model_id]
+        if isinstance(outcome, tuple):
+            delay, outcome = outcome
+            time.sleep(delay)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return {"choices": [{"message": {"content": outcome}}]}
+
+    monkeypatch.setattr(ocr_engine, "post_chat_completion", _post_chat_completion)
+    return behavior, calls
+
+
+def record(router, model, latency, count=ocr_engine.ROUTER_HEDGE_MIN_SAMPLES):
+    for _ in range(count):
+        router.record_success(model, latency)
+
+
+def test_untested_models_first_then_fastest():
+    router = ModelRouter(["slow", "fast", "new"])
+    record(router, "slow", 3.0)
+    record(router, "fast", 1.0)
+    assert router.ranked_models() == ["new", "fast", "slow"]
+
+
+def test_errors_push_a_model_down():
+    router = ModelRouter(["a", "b"])
+    record(router, "a", 1.0)
+    record(router, "b", 1.5)
+    for _ in range(5):
+        router.record_failure("a", http_error(500))
+    assert router.ranked_models() == ["b", "a"]
+
+
+def test_fails_over_to_the_next_model(replies):
+    behavior, calls = replies
+    router = ModelRouter(["a", "b"])
+    behavior.update({"a": http_error(500), "b": "from b"})
+    response = router.post("key", [])
+    assert response["model"] == "b" and response["choices"][0]["message"]["content"] == "from b"
+    assert calls == ["a", "b"]
+
+
+def test_auth_errors_are_not_retried_on_other_models(replies):
+    behavior, calls = replies
+    router = ModelRouter(["a", "b"])
+    behavior.update({"a": http_error(401), "b": "from b"})
+    with pytest.raises(requests.exceptions.HTTPError):
+        router.post("key", [])
+    assert calls == ["a"]
+
+
+def test_rate_limited_model_cools_down(replies):
+    behavior, _ = replies
+    router = ModelRouter(["a", "b"])
+    behavior.update({"a": http_error(429, {"Retry-After": "60"}), "b": "from b"})
+    assert router.post("key", [])["model"] == "b"
+    assert router.ranked_models() == ["b", "a"]
+    row = next(row for row in router.health() if row["Model"] == "a")
+    assert row["429s"] == 1 and row["Status"].startswith("cooling down")
+
+
+def test_hedges_when_the_first_model_is_slower_than_its_p95(replies):
+    behavior, calls = replies
+    router = ModelRouter(["a", "b"])
+    record(router, "a", 0.01)
+    record(router, "b", 0.02)
+    behavior.update({"a": (1.0, "from a"), "b": "from b"})
+    started = time.monotonic()
+    assert router.post("key", [], hedge=True)["model"] == "b"
+    assert time.monotonic() - started < 0.9
+    assert calls == ["a", "b"]
+
+
+def test_no_hedge_on_samples_that_went_stale_during_the_request(replies, monkeypatch):
+    behavior, calls = replies
+    router = ModelRouter(["a", "b", "c"])
+    monkeypatch.setattr(ocr_engine, "ROUTER_SAMPLE_MAX_AGE_SECONDS", 0.2)
+    record(router, "b", 0.01)
+    record(router, "c", 0.02)
+    # "a" is untested, so it goes first; by the time it fails, b's samples are too old to give a p95
+    behavior.update({"a": (0.3, http_error(500)), "b": (0.2, "from b"), "c": "from c"})
+    assert router.post("key", [], hedge=True)["model"] == "b"
+    assert calls == ["a", "b"]
+
+
+def test_concurrent_records_are_consistent():
+    router = ModelRouter(["a"])
+    threads = [threading.Thread(target=record, args=(router, "a", 0.5, 20)) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert router.health()[0]["Requests"] == ocr_engine.ROUTER_WINDOW_SIZE
+    assert router.percentile("a", 50) == 0.5
@@ -0,0 +1,22 @@
+"""parse_page_selection: the Tab 3 and CLI page selection syntax."""
+import pytest
+
+from ocr_engine import parse_page_selection
+
+
+def test_ranges_and_single_pages():
+    assert parse_page_selection("1-3, 5", 10) == ([0, 1, 2, 4], None)
+
+
+def test_sorts_and_deduplicates():
+    assert parse_page_selection("4, 1-2, 2", 5) == ([0, 1, 3], None)
+
+
+def test_ignores_empty_parts():
+    assert parse_page_selection("1,,3,", 5) == ([0, 2], None)
+
+
+@pytest.mark.parametrize("selection", ["", "0", "5-2", "12", "3-11", "a", "1-x"])
+def test_errors(selection):
+    indices, error = parse_page_selection(selection, 10)
+    assert indices == [] and error
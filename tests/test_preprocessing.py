@@ -0,0 +1,99 @@
+"""
+Image preprocessing before upload: cropping, downscaling, grayscale and the
+PNG/JPEG choice, on small images drawn in memory.
+"""
+import base64
+import io
+import random
+
+from PIL import Image, ImageDraw
+
+from ocr_engine import encode_image_bytes, preprocess_image
+
+OPTIONS = {"enabled": True, "grayscale": False, "autocrop": True, "max_side": 1024}
+
+
+def text_image(mode="RGB", size=(800, 600), background="white"):
+    """Dark "text" bars on a flat background, i.e. line art."""
+    image = Image.new(mode, size, background)
+    draw = ImageDraw.Draw(image)
+    for row in range(10):
+        draw.rectangle((100, 100 + row * 40, 700, 106 + row * 40), fill="black")
+    return image
+
+
+def photo_image(size=(640, 480)):
+    """Colour noise, so no single background colour dominates."""
+    rng = random.Random(7)
+    return Image.frombytes("RGB", size, bytes(rng.randrange(256) for _ in range(size[0] * size[1] * 3)))
+
+
+def png_bytes(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def decode(data):
+    return Image.open(io.BytesIO(data))
+
+
+def test_line_art_is_cropped_and_saved_as_png():
+    data, mime_type, size = preprocess_image(text_image(), OPTIONS)
+    assert mime_type == "image/png"
+    assert size[0] < 800 and size[1] < 600  # white margins trimmed
+    assert decode(data).size == size
+
+
+def test_photo_is_saved_as_jpeg():
+    data, mime_type, size = preprocess_image(photo_image(), OPTIONS)
+    assert mime_type == "image/jpeg"
+    assert decode(data).format == "JPEG" and size == (640, 480)
+
+
+def test_large_image_is_downscaled_to_max_side():
+    _, _, size = preprocess_image(text_image(size=(4000, 3000)), {**OPTIONS, "autocrop": False})
+    assert max(size) == 1024
+
+
+def test_grayscale_option():
+    data, _, _ = preprocess_image(photo_image(), {**OPTIONS, "grayscale": True})
+    assert decode(data).mode == "L"
+
+
+def test_transparent_text_stays_readable_in_grayscale():
+    # Black text on a fully transparent background must come out dark on white, not black on black
+    image = Image.new("RGBA", (400, 300), (0, 0, 0, 0))
+    ImageDraw.Draw(image).rectangle((50, 100, 350, 120), fill=(0, 0, 0, 255))
+    for mode in ("RGBA", "LA", "P"):
+        source = image if mode == "RGBA" else image.convert(mode)
+        data, mime_type, _ = preprocess_image(source, {**OPTIONS, "grayscale": True, "autocrop": False})
+        result = decode(data).convert("L")
+        assert mime_type == "image/png", mode
+        assert result.getpixel((10, 10)) > 200, mode  # background
+        assert result.getpixel((200, 110)) < 60, mode  # text
+
+
+def test_transparent_image_is_flattened_onto_white():
+    image = Image.new("RGBA", (400, 300), (0, 0, 0, 0))
+    ImageDraw.Draw(image).rectangle((50, 100, 350, 120), fill=(0, 0, 255, 255))
+    data, _, size = preprocess_image(image, OPTIONS)
+    result = decode(data).convert("RGB")
+    assert size[0] < 400  # cropped to the content, not to the black behind the transparency
+    assert result.getpixel((0, 0)) == (255, 255, 255)
+
+
+def test_encode_returns_a_data_url_and_payload_stats():
+    image_bytes = png_bytes(text_image())
+    data_url, stats = encode_image_bytes(image_bytes, "image/png", OPTIONS)
+    header, payload = data_url.split(",", 1)
+    assert header == "data:image/png;base64"
+    assert len(base64.b64decode(payload)) == stats["sent_bytes"]
+    assert stats["original_bytes"] == len(image_bytes) and stats["original_size"] == (800, 600)
+
+
+def test_encode_without_preprocessing_sends_the_original():
+    image_bytes = png_bytes(photo_image())
+    data_url, stats = encode_image_bytes(image_bytes, "image/png")
+    assert base64.b64decode(data_url.split(",", 1)[1]) == image_bytes
+    assert stats["sent_bytes"] == stats["original_bytes"]
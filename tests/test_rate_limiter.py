@@ -0,0 +1,90 @@
+"""FairRateLimiter: token bucket with round-robin admission across clients."""
+import threading
+import time
+
+import pytest
+
+from ocr_engine import FairRateLimiter, RateLimitedKey, RateLimitTimeout
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_burst_is_admitted_at_once():
+    limiter = FairRateLimiter(rate_per_minute=60, burst=3, max_wait_seconds=30)
+    started = time.monotonic()
+    for _ in range(3):
+        limiter.acquire("a")
+    assert time.monotonic() - started < 0.1
+    assert limiter.stats()["granted"] == 3
+
+
+def test_requests_beyond_the_burst_wait_for_tokens():
+    limiter = FairRateLimiter(rate_per_minute=600, burst=1, max_wait_seconds=30)  # one token per 0.1 s
+    limiter.acquire("a")
+    positions = []
+    started = time.monotonic()
+    limiter.acquire("a", on_wait=lambda position, eta: positions.append(position))
+    assert time.monotonic() - started >= 0.05
+    assert positions[0] == 0 and positions[-1] is None  # shown as next in line, then admitted
+
+
+def test_rejects_up_front_when_the_wait_is_too_long():
+    limiter = FairRateLimiter(rate_per_minute=6, burst=1, max_wait_seconds=1)  # one token per 10 s
+    limiter.acquire("a")
+    with pytest.raises(RateLimitTimeout):
+        limiter.acquire("a")
+    assert limiter.stats()["rejected"] == 1
+    assert limiter.status("a")["waiting"] == 0  # the rejected request left the queue
+
+
+def test_clients_are_served_round_robin():
+    limiter = FairRateLimiter(rate_per_minute=300, burst=1, max_wait_seconds=30)  # one token per 0.2 s
+    limiter.acquire("warm-up")
+    admitted, lock = [], threading.Lock()
+
+    def _request(client_id):
+        limiter.acquire(client_id)
+        with lock:
+            admitted.append(client_id)
+
+    threads = []
+    for client_id in ["a", "a", "a", "b"]:
+        threads.append(threading.Thread(target=_request, args=(client_id,)))
+        threads[-1].start()
+        wait_for(lambda: limiter.stats()["queued"] + len(admitted) == len(threads))
+    for thread in threads:
+        thread.join()
+    assert admitted[:2] == ["a", "b"]  # b's single request is not stuck behind a's batch
+
+
+def test_pause_holds_every_client():
+    limiter = FairRateLimiter(rate_per_minute=6000, burst=5, max_wait_seconds=30)
+    limiter.pause(0.2)
+    started = time.monotonic()
+    limiter.acquire("a")
+    assert time.monotonic() - started >= 0.15
+
+
+def test_status_of_a_queued_client():
+    limiter = FairRateLimiter(rate_per_minute=60, burst=1, max_wait_seconds=30)
+    limiter.acquire("a")
+    thread = threading.Thread(target=limiter.acquire, args=("b",))
+    thread.start()
+    wait_for(lambda: limiter.status("b")["waiting"] == 1)
+    status = limiter.status("b")
+    assert status["position"] == 0 and 0 < status["eta_seconds"] <= 1
+    assert limiter.status("a") == {"waiting": 0, "position": None, "eta_seconds": None, "queued": 1}
+    thread.join()
+
+
+def test_rate_limited_key_is_still_the_key():
+    limiter = FairRateLimiter(rate_per_minute=60, burst=2, max_wait_seconds=30)
+    api_key = RateLimitedKey("sk-test", limiter, "a")
+    assert api_key == "sk-test" and f"Bearer {api_key}" == "Bearer sk-test"
+    api_key.acquire()
+    assert limiter.stats()["granted"] == 1
@@ -0,0 +1,33 @@
+"""find_repeated_pages and fingerprint_page_image: blank and repeated PDF pages."""
+from PIL import Image, ImageDraw
+
+from ocr_engine import find_repeated_pages, fingerprint_page_image
+
+
+def test_repeated_and_blank_pages(make_pdf):
+    form = ["Account statement", "Total: 100.00", "Thank you"]
+    pdf = make_pdf([form, [], form, ["A different page entirely"], form])
+    duplicate_of, blank_pages = find_repeated_pages(pdf, list(range(5)))
+    assert duplicate_of == {2: 0, 4: 0}
+    assert blank_pages == [1]
+
+
+def test_filled_in_copy_is_not_a_repeat(make_pdf):
+    pdf = make_pdf([["Account statement", "Total: 100.00"], ["Account statement", "Total: 900.00"]])
+    assert find_repeated_pages(pdf, [0, 1]) == ({}, [])
+
+
+def test_only_selected_pages_are_compared(make_pdf):
+    form = ["Account statement", "Total: 100.00"]
+    pdf = make_pdf([form, ["Cover letter"], form])
+    assert find_repeated_pages(pdf, [1, 2]) == ({}, [])
+
+
+def test_fingerprint_of_blank_and_text_pages():
+    blank = Image.new("L", (600, 800), 255)
+    page = blank.copy()
+    ImageDraw.Draw(page).rectangle((50, 50, 550, 70), fill=0)
+    assert fingerprint_page_image(blank)["blank"]
+    fingerprint = fingerprint_page_image(page)
+    assert not fingerprint["blank"] and fingerprint["size"] == (600, 800)
+    assert fingerprint == fingerprint_page_image(page.copy())
@@ -0,0 +1,43 @@
+"""pack_pages_by_budget and plan_pdf_chunks: how PDF pages are grouped into requests."""
+import ocr_engine
+from ocr_engine import PDF_PACK_MAX_PAGES, pack_pages_by_budget, plan_pdf_chunks
+
+MODEL_ID = list(ocr_engine.AVAILABLE_MODELS.values())[0]
+
+
+def test_pack_keeps_page_order_within_limits():
+    costs = {idx: (4, 1) for idx in range(6)}
+    assert pack_pages_by_budget(range(6), costs, (10, 100)) == [[0, 1], [2, 3], [4, 5]]
+
+
+def test_pack_applies_every_limit():
+    costs = {idx: (1, 30) for idx in range(4)}
+    assert pack_pages_by_budget(range(4), costs, (100, 60)) == [[0, 1], [2, 3]]
+
+
+def test_pack_sends_oversized_page_alone():
+    costs = {0: (1,), 1: (50,), 2: (1,)}
+    assert pack_pages_by_budget([0, 1, 2], costs, (10,)) == [[0], [1], [2]]
+
+
+def test_pack_caps_pages_per_chunk():
+    chunks = pack_pages_by_budget(range(25), {idx: (0,) for idx in range(25)}, (1,))
+    assert [len(chunk) for chunk in chunks] == [PDF_PACK_MAX_PAGES, PDF_PACK_MAX_PAGES, 5]
+
+
+def test_plan_chunks_fixed_size(make_pdf):
+    pdf = make_pdf([["page"]] * 5)
+    assert plan_pdf_chunks(pdf, list(range(5)), MODEL_ID, pages_per_request=2) == [[0, 1], [2, 3], [4]]
+
+
+def test_plan_chunks_by_budget_covers_every_page_in_order(make_pdf):
+    pdf = make_pdf([["page"]] * 23)
+    chunks = plan_pdf_chunks(pdf, list(range(23)), MODEL_ID)
+    assert [idx for chunk in chunks for idx in chunk] == list(range(23))
+    assert all(len(chunk) <= PDF_PACK_MAX_PAGES for chunk in chunks)
+
+
+def test_plan_chunks_keeps_a_selection_in_order(make_pdf):
+    pdf = make_pdf([["page"]] * 6)
+    chunks = plan_pdf_chunks(pdf, [1, 3, 5], MODEL_ID)
+    assert [idx for chunk in chunks for idx in chunk] == [1, 3, 5]
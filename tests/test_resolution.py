@@ -0,0 +1,103 @@
+"""Resolution planning, dense-print strips and stitching the strip replies back together."""
+import fitz  # PyMuPDF
+
+import ocr_engine
+from ocr_engine import (
+    RESOLUTION_MAX_TILES,
+    plan_pdf_chunks,
+    plan_pdf_page_resolutions,
+    plan_resolution,
+    stitch_strip_texts,
+)
+
+MODEL_ID = list(ocr_engine.AVAILABLE_MODELS.values())[0]
+
+
+def dense_print_pdf():
+    """One scanned page of 3-pt print: too small to read when the page is sent whole."""
+    source = fitz.open()
+    page = source.new_page()
+    y = 20
+    while y < 820:
+        page.insert_text((20, y), "tiny print " * 30, fontsize=3)
+        y += 4
+    scanned = fitz.open()
+    scanned.new_page().insert_image(scanned[0].rect, pixmap=page.get_pixmap(dpi=200))
+    return scanned.tobytes()
+
+
+# --- plan_resolution ---
+
+def test_without_text_keeps_default_scale():
+    assert plan_resolution(600, 800, None, 2048, 1.0, 4.0, 2.0) == {"scale": 2.0, "bands": None}
+
+
+def test_scales_readable_page_whole():
+    text_lines = {"line_height": 11, "pitch": 14, "gaps": []}
+    plan = plan_resolution(600, 800, text_lines, 2048, 1.0, 4.0, 1.5)
+    assert plan == {"scale": ocr_engine.RESOLUTION_TARGET_LINE_PX / 11, "bands": None}
+
+
+def test_splits_small_print_into_overlapping_strips():
+    gaps = [8 + 4 * row for row in range(200)]
+    text_lines = {"line_height": 3, "pitch": 4, "gaps": gaps}
+    plan = plan_resolution(600, 800, text_lines, 2048, 1.0, 10.0, 2.0)
+    bands = plan["bands"]
+    assert 1 < len(bands) <= RESOLUTION_MAX_TILES
+    assert bands[0][0] == 0 and bands[-1][1] == 800
+    assert all(next_top < bottom for (_, bottom), (next_top, _) in zip(bands, bands[1:]))
+    assert all((bottom - top) * plan["scale"] <= 2048 + 1 for top, bottom in bands)
+
+
+def test_without_tiling_fits_max_side():
+    text_lines = {"line_height": 3, "pitch": 4, "gaps": []}
+    plan = plan_resolution(600, 800, text_lines, 2048, 1.0, 10.0, 2.0, tile=False)
+    assert plan == {"scale": 2048 / 800, "bands": None}
+
+
+# --- PDF pages ---
+
+def test_readable_pages_are_not_split(make_pdf):
+    pdf = make_pdf([["Line of ordinary text"] * 20] * 2)
+    resolutions = plan_pdf_page_resolutions(pdf, [0, 1], "General Text Extraction", 2048)
+    assert all(resolution["clips"] is None for resolution in resolutions.values())
+
+
+def test_stripped_pages_get_a_chunk_of_their_own(make_pdf):
+    pdf = make_pdf([["page"]] * 4)
+    resolutions = {idx: {"dpi": 150, "clips": None} for idx in range(4)}
+    resolutions[1]["clips"] = [(0, 0, 612, 400), (0, 380, 612, 792)]
+    assert plan_pdf_chunks(pdf, list(range(4)), MODEL_ID, None, None, None, resolutions) == [[0], [1], [2, 3]]
+
+
+def test_dense_single_page_is_split_but_planned_as_one_chunk():
+    # A caller deciding between one request and batches must look at the clips,
+    # not only at the number of chunks
+    pdf = dense_print_pdf()
+    resolutions = plan_pdf_page_resolutions(pdf, [0], "General Text Extraction", 2048)
+    assert len(resolutions[0]["clips"]) > 1
+    assert plan_pdf_chunks(pdf, [0], MODEL_ID, None, None, None, resolutions) == [[0]]
+
+
+# --- stitch_strip_texts ---
+
+def test_stitch_drops_lines_read_twice_in_the_overlap():
+    first = "Invoice number 1234\nPayment terms thirty days\nTotal amount due 56.00"
+    second = "Payment terms thirty days\nTotal amount due 56.00\nThank you for your business"
+    assert stitch_strip_texts([first, second]) == (
+        "Invoice number 1234\nPayment terms thirty days\nTotal amount due 56.00\nThank you for your business"
+    )
+
+
+def test_stitch_keeps_strips_without_overlap():
+    assert stitch_strip_texts(["First section heading", "Entirely different closing text", None]) == (
+        "First section heading\nEntirely different closing text"
+    )
+
+
+def test_stitch_joins_code_blocks_split_across_strips():
+    first = "```python\ntotal = price * quantity\nprint(total)\n```"
+    second = "```python\nprint(total)\nreturn total\n```"
+    assert stitch_strip_texts([first, second]) == (
+        "```python\ntotal = price * quantity\nprint(total)\nreturn total\n```"
+    )
@@ -0,0 +1,69 @@
+"""ResultCache: hits and misses, expiry, size-bounded LRU eviction and persistence."""
+import time
+
+from ocr_engine import ResultCache, result_cache_key
+
+
+def test_miss_then_hit(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=1024, ttl_seconds=60)
+    assert cache.get("k") is None
+    cache.put("k", "extracted text")
+    assert cache.get("k") == "extracted text"
+    assert cache.stats() == {"entries": 1, "bytes": len("extracted text"), "hits": 1, "misses": 1}
+
+
+def test_put_replaces_an_entry(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=1024, ttl_seconds=60)
+    cache.put("k", "old")
+    cache.put("k", "new")
+    assert cache.get("k") == "new"
+    assert cache.stats()["entries"] == 1
+
+
+def test_expired_entries_are_misses(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=1024, ttl_seconds=0.05)
+    cache.put("k", "text")
+    time.sleep(0.1)
+    assert cache.get("k") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_least_recently_used_entries_are_evicted_first(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=10, ttl_seconds=60)
+    cache.put("a", "aaaa")
+    time.sleep(0.01)
+    cache.put("b", "bbbb")
+    time.sleep(0.01)
+    assert cache.get("a") == "aaaa"  # "b" is now the least recently used
+    time.sleep(0.01)
+    cache.put("c", "cccc")
+    assert cache.get("b") is None
+    assert cache.get("a") == "aaaa" and cache.get("c") == "cccc"
+    assert cache.stats()["bytes"] <= 10
+
+
+def test_size_counts_utf8_bytes(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=1024, ttl_seconds=60)
+    cache.put("k", "äöü")
+    assert cache.stats()["bytes"] == 6
+
+
+def test_entries_survive_a_new_instance(tmp_path):
+    ResultCache(str(tmp_path), max_bytes=1024, ttl_seconds=60).put("k", "text")
+    assert ResultCache(str(tmp_path), max_bytes=1024, ttl_seconds=60).get("k") == "text"
+
+
+def test_clear_removes_entries_and_counters(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=1024, ttl_seconds=60)
+    cache.put("k", "text")
+    cache.get("k")
+    cache.clear()
+    assert cache.stats() == {"entries": 0, "bytes": 0, "hits": 0, "misses": 0}
+
+
+def test_cache_key_depends_on_content_model_and_prompt():
+    key = result_cache_key(["digest"], "model-a", "prompt")
+    assert key == result_cache_key(["digest"], "model-a", "prompt")
+    assert key != result_cache_key(["other"], "model-a", "prompt")
+    assert key != result_cache_key(["digest"], "model-b", "prompt")
+    assert key != result_cache_key(["digest"], "model-a", "another prompt")
@@ -0,0 +1,95 @@
+"""SingleFlight: identical concurrent calls share one upstream request."""
+import threading
+
+import pytest
+
+from ocr_engine import SingleFlight
+
+
+def start_waiter(flight, key, fn, outcomes):
+    waiting = threading.Event()
+
+    def _run():
+        try:
+            outcomes.append(flight.do(key, fn, on_wait=waiting.set))
+        except Exception as e:
+            outcomes.append(e)
+
+    thread = threading.Thread(target=_run)
+    thread.start()
+    assert waiting.wait(5)
+    return thread
+
+
+def test_waiter_shares_the_leaders_result():
+    flight = SingleFlight()
+    release, calls, outcomes = threading.Event(), [], []
+
+    def _request():
+        calls.append(1)
+        assert release.wait(5)
+        return "reply"
+
+    leader = threading.Thread(target=lambda: outcomes.append(flight.do("k", _request)))
+    leader.start()
+    while flight.stats()["in_flight"] == 0:
+        pass
+    waiter = start_waiter(flight, "k", _request, outcomes)
+    release.set()
+    leader.join()
+    waiter.join()
+    assert sorted(outcomes, key=lambda outcome: outcome[1]) == [("reply", False), ("reply", True)]
+    assert calls == [1]
+    assert flight.stats() == {"leaders": 1, "shared": 1, "in_flight": 0}
+
+
+def test_waiter_gets_the_leaders_error():
+    flight = SingleFlight()
+    release, outcomes = threading.Event(), []
+
+    def _request():
+        assert release.wait(5)
+        raise ValueError("upstream failed")
+
+    leader = threading.Thread(target=lambda: pytest.raises(ValueError, flight.do, "k", _request))
+    leader.start()
+    while flight.stats()["in_flight"] == 0:
+        pass
+    waiter = start_waiter(flight, "k", _request, outcomes)
+    release.set()
+    leader.join()
+    waiter.join()
+    assert isinstance(outcomes[0], ValueError)
+
+
+def test_different_keys_and_later_calls_are_not_shared():
+    flight = SingleFlight()
+    assert flight.do("a", lambda: 1) == (1, False)
+    assert flight.do("b", lambda: 2) == (2, False)
+    assert flight.do("a", lambda: 3) == (3, False)  # nothing is kept once a call finishes
+    assert flight.stats() == {"leaders": 3, "shared": 0, "in_flight": 0}
+
+
+def test_waiter_takes_over_when_the_leader_is_interrupted():
+    flight = SingleFlight()
+    release, outcomes = threading.Event(), []
+
+    def _interrupted():
+        assert release.wait(5)
+        raise KeyboardInterrupt  # like a Streamlit rerun stopping the leading script run
+
+    def _lead():
+        try:
+            flight.do("k", _interrupted)
+        except KeyboardInterrupt:
+            pass
+
+    leader = threading.Thread(target=_lead)
+    leader.start()
+    while flight.stats()["in_flight"] == 0:
+        pass
+    waiter = start_waiter(flight, "k", lambda: "retried", outcomes)
+    release.set()
+    leader.join()
+    waiter.join()
+    assert outcomes == [("retried", False)]
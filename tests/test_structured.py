@@ -0,0 +1,158 @@
+"""Structured extraction: field schemas, validation, the response_format fallback and batches."""
+import io
+import json
+
+import pytest
+import requests
+from PIL import Image
+
+import ocr_engine
+from ocr_engine import (
+    ResultCache,
+    extract_structured_batch,
+    parse_field_schema,
+    parse_json_object,
+    validate_structured_fields,
+)
+
+MODEL_ID = list(ocr_engine.AVAILABLE_MODELS.values())[0]
+FIELDS, _ = parse_field_schema("invoice_number: string\ntotal: number")
+
+
+def http_error(status, body):
+    response = requests.Response()
+    response.status_code = status
+    response._content = body.encode()
+    return requests.exceptions.HTTPError(f"{status} Error", response=response)
+
+
+def image_bytes(color):
+    buffer = io.BytesIO()
+    Image.new("RGB", (200, 100), color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def endpoint(monkeypatch):
+    """Fake chat endpoint: `endpoint["reject"]` is raised for response_format requests; calls are recorded."""
+    state = {"reject": None, "calls": []}
+
+    def _post_chat_completion(api_key, model_id, messages, site_url="", **kwargs):
+        state["calls"].append("response_format" if kwargs.get("response_format") else "prompt")
+        if kwargs.get("response_format") and state["reject"] is not None:
+            raise state["reject"]
+        return {"choices": [{"message": {"content": '{"invoice_number": "A-1", "total": "12.50"}'}}]}
+
+    monkeypatch.setattr(ocr_engine, "post_chat_completion", _post_chat_completion)
+    monkeypatch.setattr(ocr_engine, "_models_without_response_format", set())
+    return state
+
+
+# --- parse_field_schema / validate_structured_fields ---
+
+def test_field_lines():
+    fields, error = parse_field_schema("invoice_number: string  # as printed\ndue_date?: date")
+    assert error is None
+    assert fields == [
+        {"name": "invoice_number", "type": "string", "required": True, "description": "as printed"},
+        {"name": "due_date", "type": "date", "required": False, "description": ""},
+    ]
+
+
+def test_field_json_schema():
+    schema = '{"properties": {"total": {"type": "number"}, "tags": {"type": "array"}}, "required": ["total"]}'
+    fields, error = parse_field_schema(schema)
+    assert error is None
+    assert [(field["name"], field["type"], field["required"]) for field in fields] == [
+        ("total", "number", True), ("tags", "list", False),
+    ]
+
+
+@pytest.mark.parametrize("text", ["", "total: money", "total: number\ntotal: string", "not a field"])
+def test_field_schema_errors(text):
+    fields, error = parse_field_schema(text)
+    assert fields is None and error
+
+
+@pytest.mark.parametrize("value, field_type, expected", [
+    ("1,234.50", "number", 1234.5),
+    ("$12", "number", 12.0),
+    (3.0, "integer", 3),
+    ("yes", "boolean", True),
+    ("0", "boolean", False),
+    ("2024-03-04", "date", "2024-03-04"),
+    (42, "string", "42"),
+    (["a", {"b": 1}], "list", ["a", '{"b": 1}']),
+])
+def test_coerce_near_misses(value, field_type, expected):
+    assert ocr_engine._coerce_field_value(value, field_type) == (expected, None)
+
+
+@pytest.mark.parametrize("value, field_type", [
+    ("twelve", "number"), (True, "number"), (2.5, "integer"), ("maybe", "boolean"),
+    ("03/04/2024", "date"), ({"a": 1}, "string"), ("a, b", "list"),
+])
+def test_coerce_rejects(value, field_type):
+    coerced, problem = ocr_engine._coerce_field_value(value, field_type)
+    assert coerced is None and problem
+
+
+def test_validate_reports_missing_required_and_invalid_fields():
+    fields, _ = parse_field_schema("total: number\nnote?: string\ndue: date")
+    values, problems = validate_structured_fields({"total": "abc", "note": ""}, fields)
+    assert values == {"total": None, "note": None, "due": None}
+    assert set(problems) == {"total", "due"} and problems["due"] == "missing"
+
+
+def test_json_object_in_a_fenced_reply():
+    assert parse_json_object('Here you go:\n```json\n{"total": 1}\n```') == {"total": 1}
+    assert parse_json_object("[1, 2]") is None and parse_json_object("no json") is None
+
+
+# --- response_format fallback ---
+
+def test_response_format_rejection_is_remembered(endpoint):
+    endpoint["reject"] = http_error(400, '{"error": "response_format json_schema is not supported"}')
+    assert ocr_engine._request_structured_reply("key", "model-x", [], FIELDS)
+    assert ocr_engine._request_structured_reply("key", "model-x", [], FIELDS)
+    assert endpoint["calls"] == ["response_format", "prompt", "prompt"]
+
+
+def test_other_bad_requests_fall_back_once(endpoint):
+    endpoint["reject"] = http_error(400, '{"error": "image too large"}')
+    ocr_engine._request_structured_reply("key", "model-x", [], FIELDS)
+    endpoint["reject"] = None
+    ocr_engine._request_structured_reply("key", "model-x", [], FIELDS)
+    assert endpoint["calls"] == ["response_format", "prompt", "response_format"]
+
+
+def test_auto_models_use_the_prompt(endpoint):
+    ocr_engine._request_structured_reply("key", ocr_engine.AUTO_MODEL_ID, [], FIELDS)
+    assert endpoint["calls"] == ["prompt"]
+
+
+# --- extract_structured_batch ---
+
+def test_batch_asks_for_one_key_use_per_uncached_document(endpoint, tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=1 << 20, ttl_seconds=60)
+    documents = [(f"{color}.png", image_bytes(color), "image/png") for color in ("white", "gray", "black")]
+    extract_structured_batch(lambda request_count: "key", MODEL_ID, documents[:1], FIELDS, cache=cache)
+    key_requests = []
+
+    def _get_api_key(request_count):
+        key_requests.append(request_count)
+        return "key"
+
+    results = extract_structured_batch(_get_api_key, MODEL_ID, documents, FIELDS, cache=cache)
+    assert key_requests == [2]
+    assert [result["cached"] for result in results] == [True, False, False]
+    assert all(result["values"] == {"invoice_number": "A-1", "total": 12.5} for result in results)
+    assert json.loads(cache.get(ocr_engine._structured_cache_key(
+        documents[1][1], "image/png", MODEL_ID, FIELDS, "", None,
+    ))) == {"invoice_number": "A-1", "total": 12.5}
+
+
+def test_batch_without_key_returns_none(endpoint):
+    documents = [("a.png", image_bytes("white"), "image/png")]
+    assert extract_structured_batch(lambda request_count: None, MODEL_ID, documents, FIELDS) is None
+    assert endpoint["calls"] == []